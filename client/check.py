@@ -4,6 +4,9 @@ import json
 import os
 
 import h5py
+import numpy as np
+
+from sf_daq_broker.utils.pulseids import expected_pulse_ids
 
 
 def run():
@@ -64,12 +67,7 @@ def check_consistency(run_file=None, rate_multiplicator=0):
         directory_name = parameters["directory_name"]
         full_directory = f"{full_directory}{directory_name}"
 
-    #TODO: make this check possible for different from 100Hz case (not straitforward - start_pulse_id can be not alligned properly with the rate)
-    # this is case for 100Hz:
-    expected_pulse_id = []
-    for p in range(start_pulse_id,stop_pulse_id+1):
-        if p%rate_multiplicator == 0:
-            expected_pulse_id.append(p)
+    expected_pulse_id = expected_pulse_ids(start_pulse_id, stop_pulse_id, rate_multiplicator)
     expected_number_measurements = len(expected_pulse_id)
 
 
@@ -89,24 +87,16 @@ def check_consistency(run_file=None, rate_multiplicator=0):
                         if channel not in channels_inside_file:
                             problems.append(f"channel {channel} requested but not present in cameras file")
                         else:
-                            pulse_id_raw     = bsread_h5py[f"/data/{channel}/pulse_id"][:]
-                            is_data_present = bsread_h5py[f"/data/{channel}/is_data_present"][:]
-                            # pulse_id = pulse_id_raw[is_data_present]
-                            pulse_id = []
-                            for n_p,p in enumerate(pulse_id_raw):
-                                if p%rate_multiplicator == 0 and is_data_present[n_p]:
-                                    pulse_id.append(p)
+                            pulse_id_raw     = bsread_h5py[f"/data/{channel}/pulse_id"][:].ravel()
+                            is_data_present = bsread_h5py[f"/data/{channel}/is_data_present"][:].ravel().astype(bool)
+                            pulse_id = pulse_id_raw[(pulse_id_raw % rate_multiplicator == 0) & is_data_present]
                             n_pulse_id = len(pulse_id)
                             if n_pulse_id != expected_number_measurements:
                                 problems.append(f"{channel} number of pulse_id is different from expected : {n_pulse_id} vs {expected_number_measurements}")
                             else:
                                 if pulse_id[0] != expected_pulse_id[0] or pulse_id[-1] != expected_pulse_id[-1]:
                                     problems.append(f"{channel} start/stop pulse_id are not the one which are requested (requested : {expected_pulse_id[0]},{expected_pulse_id[-1]}, got: {pulse_id[0]},{pulse_id[-1]}) ")
-                                pulse_id_check = True # this is for 100Hz only #TODO: to make for different rate
-                                for i in range(n_pulse_id):
-                                    if pulse_id[i] != expected_pulse_id[i]:
-                                        pulse_id_check = False
-                                        #print(channel, i, pulse_id[i], expected_pulse_id[i])
+                                pulse_id_check = np.array_equal(pulse_id, expected_pulse_id)
                                 if not pulse_id_check:
                                     problems.append(f"{channel} pulse_id are not monotonic")
                 bsread_h5py.close()
@@ -126,17 +116,14 @@ def check_consistency(run_file=None, rate_multiplicator=0):
                     if camera not in cameras_inside_file:
                         problems.append(f"camera {camera} requested but not present in cameras file")
                     else:
-                        pulse_id      = cameras_h5py[f"/{camera}/pulse_id"][:]
+                        pulse_id      = cameras_h5py[f"/{camera}/pulse_id"][:].ravel()
                         n_pulse_id = len(pulse_id)
                         if n_pulse_id != expected_number_measurements:
                             problems.append(f"{camera} number of pulse_id is different from expected : {n_pulse_id} vs {expected_number_measurements}")
                         else:
                             if expected_pulse_id[0] != pulse_id[0] or expected_pulse_id[-1] != pulse_id[-1]:
                                 problems.append(f"{camera} start/stop pulse_id are not the one which are requested")
-                            pulse_id_check = True # this is for 100Hz only #TODO: to make for different rate
-                            for i in range(n_pulse_id):
-                                if pulse_id[i] != expected_pulse_id[i]:
-                                    pulse_id_check = False
+                            pulse_id_check = np.array_equal(pulse_id, expected_pulse_id)
                             if not pulse_id_check:
                                 problems.append(f"{camera} pulse_id are not monotonic")
                         n_images_corrupted = 0
@@ -162,7 +149,7 @@ def check_consistency(run_file=None, rate_multiplicator=0):
             else:
                 try:
                     detector_h5py = h5py.File(detector_file,"r")
-                    pulse_id      = detector_h5py[f"/data/{detector}/pulse_id"][:]
+                    pulse_id      = detector_h5py[f"/data/{detector}/pulse_id"][:].ravel()
                     n_pulse_id = len(pulse_id)
                     # in case of converted data, frame_index, is_good_frame and daq_rec may be missing
                     if f"data/{detector}/frame_index" in detector_h5py.keys():
@@ -170,9 +157,9 @@ def check_consistency(run_file=None, rate_multiplicator=0):
                     else:
                         frame_index = [0] * n_pulse_id
                     if f"/data/{detector}/is_good_frame" in detector_h5py.keys():
-                        is_good_frame = detector_h5py[f"/data/{detector}/is_good_frame"][:]
+                        is_good_frame = detector_h5py[f"/data/{detector}/is_good_frame"][:].ravel()
                     else:
-                        is_good_frame = [1] * n_pulse_id
+                        is_good_frame = np.ones(n_pulse_id)
                     if f"/data/{detector}/daq_rec" in detector_h5py.keys():
                         daq_rec       = detector_h5py[f"/data/{detector}/daq_rec"][:]
                     else:
@@ -187,16 +174,10 @@ def check_consistency(run_file=None, rate_multiplicator=0):
                             problems.append(f"{detector} start/stop pulse_id are not the one which are requested")
                     #TODO: check on NANs for pulse_ids
                         frame_index_check = True
-                        n_frames_bad   = 0
-                        pulse_id_check = True # this is for 100Hz only #TODO: to make for different rate
-                        for i in range(n_pulse_id):
-                            if is_good_frame[i] != 1:
-                                n_frames_bad += 1
-                            else:
-                                #if frame_index[i] != (frame_index[0]+i):
-                                #    frame_index_check = False
-                                if pulse_id[i] != expected_pulse_id[i]:
-                                    pulse_id_check = False
+                        # the pulse IDs of the bad frames are not checked
+                        is_good = (is_good_frame == 1)
+                        n_frames_bad = n_pulse_id - np.count_nonzero(is_good)
+                        pulse_id_check = np.array_equal(pulse_id[is_good], expected_pulse_id[is_good])
                         if not frame_index_check:
                             problems.append(f"{detector} frame_index is not monotonic")
                         if n_frames_bad != 0:
@@ -7,7 +7,7 @@ import bottle
 from sf_daq_broker import config
 from sf_daq_broker.broker_manager import BrokerManager
 from sf_daq_broker.rabbitmq import broker_config, BrokerClient
-from sf_daq_broker.rest_api import register_rest_api
+from sf_daq_broker.rest_api import register_rest_api, run_server
 
 
 _logger = logging.getLogger(__name__)
@@ -36,16 +36,17 @@ def run():
 
     parser.add_argument("--broker_url", default=broker_config.DEFAULT_BROKER_URL, help="RabbitMQ broker URL")
     parser.add_argument("--rest_port", default=config.DEFAULT_BROKER_REST_PORT, type=int, help="REST-API port")
+    parser.add_argument("--rest_threads", default=config.DEFAULT_REST_THREADS, type=int, help="number of REST-API requests handled at once (0: single-threaded server)")
     parser.add_argument("--log_level", default=config.DEFAULT_LOG_LEVEL, choices=["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG"], help="log level")
 
     clargs = parser.parse_args()
 
     logging.basicConfig(level=clargs.log_level, format=config.LOG_FORMAT)
 
-    start_server(clargs.broker_url, clargs.rest_port)
+    start_server(clargs.broker_url, clargs.rest_port, clargs.rest_threads)
 
 
-def start_server(broker_url, rest_port):
+def start_server(broker_url, rest_port, rest_threads=config.DEFAULT_REST_THREADS):
     _logger.info(f"starting sf-daq broker on {broker_url}")
 
     broker_client = BrokerClient(broker_url=broker_url)
@@ -61,7 +62,10 @@ def start_server(broker_url, rest_port):
     hostname = socket.gethostname()
     _logger.info(f"starting sf-daq broker REST-API on {hostname}:{rest_port}")
 
-    bottle.run(app=app, host=hostname, port=rest_port)
+    try:
+        run_server(app, hostname, rest_port, rest_threads)
+    finally:
+        manager.stop()
 
 
 
@@ -1,13 +1,19 @@
 import os
+import re
 import string
 from datetime import datetime
+from functools import partial
+from glob import glob
 from shutil import copyfile
 
 from sf_daq_broker import config
 from sf_daq_broker.detector.utils import get_configured_detectors, get_streamvis_address
 from sf_daq_broker.detector.detector_config import DETECTOR_DESC
+from sf_daq_broker.detector.liveness import LivenessMonitor
 from sf_daq_broker.rabbitmq import broker_config
-from sf_daq_broker.utils import get_writer_request, get_beamline, get_pulse_id_pvname, json_save, json_load, dueto, parse_det_name
+from sf_daq_broker.utils import get_counter, get_writer_request, get_beamline, get_pulse_id_pvname, json_save, json_load, dueto
+from sf_daq_broker.utils.pulseids import align_pulse_ids
+from sf_daq_broker.utils.scan_journal import ScanInfoMaterializer, append_scan_step, is_outdated
 from . import validate
 
 
@@ -28,6 +34,16 @@ class BrokerManager:
 
     def __init__(self, broker_client):
         self.broker_client = broker_client
+        self.liveness_monitor = LivenessMonitor()
+        self.scan_info_materializer = ScanInfoMaterializer(config.SCAN_INFO_INTERVAL)
+
+
+    def stop(self):
+        """
+        stops the background threads, scan.json of the runs with new scan steps is written before
+        """
+        self.liveness_monitor.stop()
+        self.scan_info_materializer.stop()
 
 
     def close_pgroup_writing(self, request, remote_ip):
@@ -47,6 +63,8 @@ class BrokerManager:
         with open(f"{daq_directory}/CLOSED", "x"):
             pass
 
+        self.materialize_scan_info(path_to_pgroup)
+
         return f"{pgroup} closed for writing"
 
 
@@ -132,6 +150,11 @@ class BrokerManager:
 
         validate.pgroup_is_not_closed(daq_directory, path_to_pgroup)
 
+        if increment_run_number:
+            # the previous run is finished
+            last_run_number = get_run_number(daq_directory, increment_run_number=False)
+            self.materialize_scan_info(path_to_pgroup, f"run{last_run_number:04}*")
+
         run_number = get_run_number(daq_directory, increment_run_number=increment_run_number)
         action = "advanced" if increment_run_number else "retrieved"
 
@@ -143,6 +166,15 @@ class BrokerManager:
         return res
 
 
+    def materialize_scan_info(self, path_to_pgroup, run_pattern="run*"):
+        """
+        writes scan.json of the runs in path_to_pgroup matching run_pattern, if it is not up to date
+        """
+        meta_directories = glob(f"{path_to_pgroup}{run_pattern}/meta")
+        meta_directories = [d for d in meta_directories if is_outdated(d)]
+        self.scan_info_materializer.flush(meta_directories)
+
+
     def power_on_detector(self, request, remote_ip):
         detector_name, beamline = validate.get_validated_detector_name_and_beamline(request, remote_ip)
 
@@ -153,9 +185,7 @@ class BrokerManager:
             "writer_type": broker_config.TAG_DETECTOR_POWER_ON
         }
 
-        self.broker_client.open()
         self.broker_client.send(request_power_on, broker_config.TAG_DETECTOR_POWER_ON)
-        self.broker_client.close()
 
         return f"request to power on detector {detector_name} sent, wait a few minutes"
 
@@ -166,42 +196,7 @@ class BrokerManager:
         beamline = get_beamline(remote_ip)
         allowed_detectors_beamline = get_configured_detectors(beamline)
 
-        buffer_location = "/gpfs/photonics/swissfel/buffer"
-        time_now = datetime.now()
-
-        missing_detectors = []
-        running_detectors = []
-        limping_detectors = {}
-
-        for detector in allowed_detectors_beamline:
-            n_modules = parse_det_name(detector).T
-
-            running_modules = []
-            missing_modules = []
-
-            for i_module in range(n_modules):
-                module_buffer_file = f"{buffer_location}/{detector}/M{i_module:02}/LATEST"
-
-                if not os.path.exists(module_buffer_file):
-                    missing_modules.append(i_module)
-                    continue
-
-                time_file = datetime.fromtimestamp(os.path.getmtime(module_buffer_file))
-                delta_time = time_now - time_file
-                if delta_time.total_seconds() < 30:
-                    running_modules.append(i_module)
-                else:
-                    missing_modules.append(i_module)
-
-            if not running_modules:
-                missing_detectors.append(detector)
-            elif not missing_modules:
-                running_detectors.append(detector)
-            else:
-                limping_detectors[detector] = {
-                    "running_modules": running_modules,
-                    "missing_modules": missing_modules
-                }
+        running_detectors, limping_detectors, missing_detectors, snapshot_time = self.liveness_monitor.get_status(allowed_detectors_beamline)
 
         res = {
             "status": "ok",
@@ -209,7 +204,8 @@ class BrokerManager:
             "detectors": running_detectors, #TODO: remove; kept for backwards compatibility
             "missing_detectors": missing_detectors,
             "running_detectors": running_detectors,
-            "limping_detectors": limping_detectors
+            "limping_detectors": limping_detectors,
+            "snapshot_time": str(datetime.fromtimestamp(snapshot_time))
         }
         return res
 
@@ -248,6 +244,14 @@ class BrokerManager:
 
         rate_multiplicator = request.get("rate_multiplicator", 1)
         pedestalmode = request.get("pedestalmode", False)
+        pedestal_streaming = request.get("pedestal_streaming", False)
+        validate.pedestal_streaming(pedestal_streaming)
+
+        pedestal_workers = request.get("pedestal_workers", 1)
+        validate.pedestal_workers(pedestal_workers)
+
+        pedestal_accumulator = request.get("pedestal_accumulator", "float64")
+        validate.pedestal_accumulator(pedestal_accumulator)
 
         detectors = list(request["detectors"])
         validate.detectors(detectors)
@@ -290,6 +294,9 @@ class BrokerManager:
             "output_file": None,
             "output_file_prefix": f"{full_path}/{pedestal_name}",
             "path_to_pgroup": path_to_pgroup,
+            "pedestal_accumulator": pedestal_accumulator,
+            "pedestal_streaming": pedestal_streaming,
+            "pedestal_workers": pedestal_workers,
             "pedestalmode": pedestalmode,
             "rate_multiplicator": rate_multiplicator,
             "request_time": str(request_time),
@@ -303,9 +310,7 @@ class BrokerManager:
             "writer_type": broker_config.TAG_DETECTOR_PEDESTAL
         }
 
-        self.broker_client.open()
         self.broker_client.send(pedestal_request, broker_config.TAG_DETECTOR_PEDESTAL)
-        self.broker_client.close()
 
         time_to_wait = PEDESTAL_FRAMES / 100 * rate_multiplicator + 10
 
@@ -382,6 +387,10 @@ class BrokerManager:
             allowed_detectors_beamline = get_configured_detectors(beamline)
             validate.all_detector_names_in_allowed_detectors_beamline(detectors, allowed_detectors_beamline, beamline)
 
+        for detector_params in request_detectors.values():
+            if "segment_frames" in detector_params:
+                validate.segment_frames(detector_params["segment_frames"])
+
         if "channels_list" in request:
             request["channels_list"] = list(dict.fromkeys(request["channels_list"]))
 
@@ -422,6 +431,9 @@ class BrokerManager:
 
         os.makedirs(output_data_directory, exist_ok=True)
 
+        # all write requests of the acquisition are sent together in the end
+        write_requests = []
+
         def send_write_request(tag, channels, filename_suffix):
             if not channels:
                 return
@@ -441,14 +453,7 @@ class BrokerManager:
                 run_log_file
             )
 
-            try:
-                self.broker_client.send(write_request, tag)
-            except Exception as e:
-                with open(write_request["run_log_file"], "a") as log_file:
-                    log_file.write(f"Cannot send request to writer {dueto(e)}")
-                raise
-
-        self.broker_client.open()
+            write_requests.append((write_request, tag))
 
         send_write_request(
             f"epics_{beamline}",
@@ -469,13 +474,7 @@ class BrokerManager:
         )
 
         if "detectors" in request:
-            det_start_pulse_id = 0
-            det_stop_pulse_id = stop_pulse_id
-            for p in range(start_pulse_id, stop_pulse_id+1):
-                if p % rate_multiplicator == 0:
-                    det_stop_pulse_id = p
-                    if det_start_pulse_id == 0:
-                        det_start_pulse_id = p
+            det_start_pulse_id, det_stop_pulse_id = align_pulse_ids(start_pulse_id, stop_pulse_id, rate_multiplicator)
 
             request_detector = {}
 
@@ -496,24 +495,28 @@ class BrokerManager:
                 request_detector["selected_pulse_ids"] = request["selected_pulse_ids"]
 
             for detector in request["detectors"]:
-                request_detector_send = request_detector
+                request_detector_send = dict(request_detector)
                 request_detector_send["detector_name"] = detector
                 request_detector_send["detectors"] = {}
                 request_detector_send["detectors"][detector] = request["detectors"][detector]
                 send_write_request(
                     broker_config.TAG_DETECTOR_RETRIEVE,
-                    request_detector,
+                    request_detector_send,
                     detector
                 )
 
-        self.broker_client.close()
+        try:
+            unrouted = self.broker_client.send_batch(write_requests)
+        except Exception as e:
+            for write_request, _tag in write_requests:
+                with open(write_request["run_log_file"], "a") as log_file:
+                    log_file.write(f"Cannot send request to writer {dueto(e)}")
+            raise
 
-        each_scan_fields = [
-            "scan_readbacks",
-            "scan_step_info",
-            "scan_values",
-            "scan_readbacks_raw"
-        ]
+        # the other requests were delivered, thus, the acquisition is recorded nevertheless
+        for write_request, tag in unrouted:
+            with open(write_request["run_log_file"], "a") as log_file:
+                log_file.write(f"Cannot send request to writer (no writer receives {tag} requests)")
 
         default_scan_info = {
             "scan_name": "dummy",
@@ -529,30 +532,8 @@ class BrokerManager:
 
         request_scan_info = request.get("scan_info", default_scan_info)
 
-        scan_info_file = f"{meta_directory}/scan.json"
-        if not os.path.exists(scan_info_file):
-            scan_info = {
-                "scan_files": [],
-                "pulseIds": []
-            }
-            scan_info["scan_parameters"] = {}
-            for scan_key in request_scan_info:
-                if scan_key not in each_scan_fields:
-                    scan_info["scan_parameters"][scan_key] = request_scan_info[scan_key]
-            for scan_step_field in each_scan_fields:
-                scan_info[scan_step_field] = []
-        else:
-            scan_info = json_load(scan_info_file)
-
-        for scan_step_field in each_scan_fields:
-            scan_info[scan_step_field].append(
-                request_scan_info.get(scan_step_field, [])
-            )
-
-        scan_info["scan_files"].append(output_files_list)
-        scan_info["pulseIds"].append([start_pulse_id, stop_pulse_id])
-
-        json_save(scan_info, scan_info_file)
+        append_scan_step(meta_directory, request_scan_info, output_files_list, [start_pulse_id, stop_pulse_id])
+        self.scan_info_materializer.mark(meta_directory)
 
         res = {
             "status": "ok",
@@ -562,6 +543,9 @@ class BrokerManager:
             "unique_acquisition_number": str(unique_acq),
             "files": output_files_list
         }
+        if unrouted:
+            unrouted_tags = ", ".join(tag for _write_request, tag in unrouted)
+            res["message"] += f", but no writer received: {unrouted_tags}"
         return res
 
 
@@ -588,34 +572,29 @@ def get_run_number(daq_directory=None, file_run="LAST_RUN", increment_run_number
     if daq_directory is None:
         return None
 
-    last_run_file = daq_directory + "/" + file_run
-    if not os.path.exists(last_run_file):
-        with open(last_run_file, "w") as run_file:
-            run_file.write("0")
-
-    with open(last_run_file, "r") as run_file:
-        last_run = int(run_file.read())
+    counter = get_counter(f"{daq_directory}/{file_run}")
 
     if not increment_run_number:
-        current_run = last_run
-    else:
-        current_run = last_run + 1
-
-        with open(last_run_file, "w") as run_file:
-            run_file.write(str(current_run))
+        return counter.get()
 
-    return current_run
+    return counter.increment()
 
 
-def get_current_step_in_scan(meta_directory=None):
+def get_current_step_in_scan(meta_directory=None, file_acq=".LAST_ACQ"):
+    """
+    the next acquisition number of the run, the last one is kept in meta_directory/file_acq
+    (for runs started before that file existed, it is initialized from the number of saved acquisitions)
+    """
     if meta_directory is None:
         return None
 
-    dirlist = os.listdir(meta_directory)
-    number_files = len(dirlist)
+    initial = partial(count_acquisition_files, meta_directory)
+    counter = get_counter(f"{meta_directory}/{file_acq}", initial=initial)
+    return counter.increment()
+
 
-    current_step = 1 if number_files == 0 else number_files
-    return current_step
+def count_acquisition_files(meta_directory):
+    return sum(1 for fname in os.listdir(meta_directory) if re.fullmatch(r"acq\d{4,}\.json", fname))
 
 
 
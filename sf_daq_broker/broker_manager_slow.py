@@ -3,6 +3,7 @@ import os
 import shutil
 from datetime import datetime
 from glob import glob
+from threading import Lock
 
 import numpy as np
 
@@ -28,6 +29,17 @@ PARAMETER_NAMES = [
 
 class DetectorManager:
 
+    def __init__(self):
+        # the REST server handles requests concurrently, these serialize the ones that change the same state
+        self.locks = {}
+        self.locks_lock = Lock()
+
+
+    def lock(self, name):
+        with self.locks_lock:
+            return self.locks.setdefault(name, Lock())
+
+
     def get_jfctrl_monitor(self, request, remote_ip):
         detector_name = validate.get_validated_detector_name(request, remote_ip)
 
@@ -120,21 +132,23 @@ class DetectorManager:
 
         new_parameters = {n: parameters.get(n) for n in PARAMETER_NAMES}
 
-        trigger = Trigger(beamline)
-        trigger.stop()
+        # the trigger is shared by the detectors of the beamline
+        with self.lock(f"trigger:{beamline}"):
+            trigger = Trigger(beamline)
+            trigger.stop()
 
-        changed_parameters = {}
-        for name, new_value in new_parameters.items():
-            if new_value is None:
-                continue
-            old_value = getattr(detector, name)
-            if old_value == new_value:
-                continue
-            changed_parameters[name] = (old_value, new_value)
-            setattr(detector, name, new_value)
-            _logger.info(f'changed parameter "{name}" from "{old_value}" to "{new_value}"')
+            changed_parameters = {}
+            for name, new_value in new_parameters.items():
+                if new_value is None:
+                    continue
+                old_value = getattr(detector, name)
+                if old_value == new_value:
+                    continue
+                changed_parameters[name] = (old_value, new_value)
+                setattr(detector, name, new_value)
+                _logger.info(f'changed parameter "{name}" from "{old_value}" to "{new_value}"')
 
-        trigger.start()
+            trigger.start()
 
         res = {
             "status": "ok",
@@ -163,12 +177,13 @@ class DetectorManager:
 
         validate.allowed_detector_modules(detector_name, modules, number_modules)
 
-        if target_state == "on":
-            detector.power_on_modules(modules)
-        elif target_state == "off":
-            detector.power_off_modules(modules)
-        else:
-            raise ValueError(f'detector modules power state can either be "on" or "off", but requested is: {target_state}')
+        with self.lock(f"detector:{detector_name}"):
+            if target_state == "on":
+                detector.power_on_modules(modules)
+            elif target_state == "off":
+                detector.power_off_modules(modules)
+            else:
+                raise ValueError(f'detector modules power state can either be "on" or "off", but requested is: {target_state}')
 
         res = {
             "status": "ok",
@@ -262,20 +277,23 @@ class DetectorManager:
         path = "/gpfs/photonics/swissfel/buffer/dap/custom_dap_scripts"
         ssh_key = "/gpfs/photonics/swissfel/buffer/dap/key_custom_dap_script"
         git = GitRepo(url, path, ssh_key=ssh_key)
-        git.update()
 
-        fn = os.path.join(path, name)
+        # the working copy is shared by all uploads
+        with self.lock("custom_dap_scripts"):
+            git.update()
 
-        try:
-            write_to_file(code, fn)
-            func = load_proc_from_file(fn)
-            test_run(func)
-        except:
-            _logger.exception(f'uploading custom DAP script "{name}" failed')
-            git.clean()
-            raise
+            fn = os.path.join(path, name)
+
+            try:
+                write_to_file(code, fn)
+                func = load_proc_from_file(fn)
+                test_run(func)
+            except:
+                _logger.exception(f'uploading custom DAP script "{name}" failed')
+                git.clean()
+                raise
 
-        git.commit(name)
+            git.commit(name)
 
         res = {
             "status": "ok",
@@ -307,37 +325,39 @@ class DetectorManager:
 
         dap_config_file = f"/gpfs/photonics/swissfel/buffer/dap/config/pipeline_parameters.{detector_name}.json"
 
-        if not os.path.exists(dap_config_file):
-            _logger.info(f"DAP config file {dap_config_file} does not exist -- creating an empty one")
-            json_save({}, dap_config_file)
+        # the config file is read, changed and written back
+        with self.lock(f"dap_config:{detector_name}"):
+            if not os.path.exists(dap_config_file):
+                _logger.info(f"DAP config file {dap_config_file} does not exist -- creating an empty one")
+                json_save({}, dap_config_file)
 
-        new_parameters = request["parameters"]
+            new_parameters = request["parameters"]
 
-        dap_config = json_load(dap_config_file)
+            dap_config = json_load(dap_config_file)
 
-        changed_parameters = {}
-        for name, new_value in new_parameters.items():
-            old_value = dap_config.get(name, None)
-            if old_value == new_value:
-                continue
-            changed_parameters[name] = (old_value, new_value)
-            dap_config[name] = new_value
+            changed_parameters = {}
+            for name, new_value in new_parameters.items():
+                old_value = dap_config.get(name, None)
+                if old_value == new_value:
+                    continue
+                changed_parameters[name] = (old_value, new_value)
+                dap_config[name] = new_value
 
-        if changed_parameters:
-            backup_directory = "/gpfs/photonics/swissfel/buffer/dap/config/backup"
-            os.makedirs(backup_directory, exist_ok=True)
+            if changed_parameters:
+                backup_directory = "/gpfs/photonics/swissfel/buffer/dap/config/backup"
+                os.makedirs(backup_directory, exist_ok=True)
 
-            timestamp = datetime.now().strftime(CONFIG_FILENAME_TIME_FORMAT)
+                timestamp = datetime.now().strftime(CONFIG_FILENAME_TIME_FORMAT)
 
-            dap_config_file_backup = f"{backup_directory}/pipeline_parameters.{detector_name}.json.{timestamp}"
+                dap_config_file_backup = f"{backup_directory}/pipeline_parameters.{detector_name}.json.{timestamp}"
 
-            shutil.copyfile(dap_config_file, dap_config_file_backup)
+                shutil.copyfile(dap_config_file, dap_config_file_backup)
 
-            try:
-                json_save(dap_config, dap_config_file)
-            except Exception as e:
-                shutil.copyfile(dap_config_file_backup, dap_config_file)
-                raise RuntimeError(f"could not update DAP configuration {dueto(e)}") from e
+                try:
+                    json_save(dap_config, dap_config_file)
+                except Exception as e:
+                    shutil.copyfile(dap_config_file_backup, dap_config_file)
+                    raise RuntimeError(f"could not update DAP configuration {dueto(e)}") from e
 
         res = {
             "status": "ok",
@@ -6,7 +6,7 @@ import bottle
 
 from sf_daq_broker import config
 from sf_daq_broker.broker_manager_slow import DetectorManager
-from sf_daq_broker.rest_api import register_rest_api
+from sf_daq_broker.rest_api import register_rest_api, run_server
 
 
 _logger = logging.getLogger(__name__)
@@ -37,16 +37,17 @@ def run():
     parser = argparse.ArgumentParser(description="detector settings server")
 
     parser.add_argument("--rest_port", default=config.DEFAULT_BROKER_SLOW_REST_PORT, type=int, help="REST-API port")
+    parser.add_argument("--rest_threads", default=config.DEFAULT_REST_THREADS, type=int, help="number of REST-API requests handled at once (0: single-threaded server)")
     parser.add_argument("--log_level", default=config.DEFAULT_LOG_LEVEL, choices=["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG"], help="log level")
 
     clargs = parser.parse_args()
 
     logging.basicConfig(level=clargs.log_level, format=config.LOG_FORMAT)
 
-    start_server(clargs.rest_port)
+    start_server(clargs.rest_port, clargs.rest_threads)
 
 
-def start_server(rest_port):
+def start_server(rest_port, rest_threads=config.DEFAULT_REST_THREADS):
     _logger.info("starting detector settings server")
 
     app = bottle.Bottle()
@@ -57,7 +58,7 @@ def start_server(rest_port):
     hostname = socket.gethostname()
     _logger.info(f"starting detector settings server REST-API on {hostname}:{rest_port}")
 
-    bottle.run(app=app, host=hostname, port=rest_port)
+    run_server(app, hostname, rest_port, rest_threads)
 
 
 
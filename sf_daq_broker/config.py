@@ -2,13 +2,71 @@
 #DEFAULT_QUEUE_LENGTH = 100
 DEFAULT_BROKER_REST_PORT = 10002
 DEFAULT_BROKER_SLOW_REST_PORT = 10003
+DEFAULT_REST_THREADS = 8
 #DEFAULT_EPICS_WRITER_URL = "http://localhost:10200/notify"
 DEFAULT_LOG_LEVEL = "INFO"
 
 LOG_FORMAT = "[%(levelname)s] %(message)s"
 
+# upper bounds of the wait before the retrieval, the readiness of the data is polled every READINESS_POLL_INTERVAL seconds
 BSDATA_RETRIEVAL_DELAY = 60
 DETECTOR_RETRIEVAL_DELAY = 10
+READINESS_POLL_INTERVAL = 1
+# BS data is considered ready once each of (at most) BSDATA_READINESS_CHANNELS of the requested channels
+# has data at or after the stop pulse ID, the margin (in pulses) covers the channels with lower rates
+BSDATA_READINESS_MARGIN = 500
+BSDATA_READINESS_CHANNELS = 10
+
+# detector liveness: seconds between refreshes of the module status, age of the LATEST file up to which a module is running, parallel stat calls
+LIVENESS_INTERVAL = 5
+LIVENESS_MAX_AGE = 30
+LIVENESS_THREADS = 16
+
+# seconds between rewrites of scan.json from the scan journal during a run
+SCAN_INFO_INTERVAL = 10
+
+# pulse ID to timestamp mapping: cached pulse IDs, file the cache is persisted to (None: in memory only),
+# largest distance (pulses) of two cached pulse IDs between which is interpolated and their largest deviation (ns) from the 100 Hz grid,
+# concurrent requests of a batch lookup
+PULSEID_CACHE_SIZE = 10000
+PULSEID_CACHE_FILE = None
+PULSEID_INTERPOLATION_MAX_GAP = 6000
+PULSEID_INTERPOLATION_TOLERANCE = 1_000_000
+PULSEID_LOOKUP_THREADS = 4
+
+# Data API 3 requests with more channels are split into shards of this many channels, which are downloaded concurrently
+DATA_API3_SHARD_CHANNELS = 50
+DATA_API3_SHARD_THREADS = 4
+# Data API 3 requests with more pulses are split into time segments of this many pulses, which are downloaded concurrently (with retries)
+DATA_API3_SEGMENT_PULSES = 6000
+DATA_API3_SEGMENT_THREADS = 4
+DATA_API3_SEGMENT_TRIES = 3
+
+# image buffer addresses: seconds an address is avoided after a failure, weight of the latest latency in the smoothed latency
+IMAGE_API_FAILURE_COOLDOWN = 60
+IMAGE_API_LATENCY_SMOOTHING = 0.3
+
+# channels checked at once by the data consistency check
+DATA_CONSISTENCY_THREADS = 4
+
+# streaming pedestal calculation: seconds between retrieved segments and delay of the buffer (at least the one of a normal retrieval)
+PEDESTAL_STREAM_INTERVAL = 5
+PEDESTAL_STREAM_DELAY = DETECTOR_RETRIEVAL_DELAY
+
+# memory used by one conversion of a raw detector file (limits the batch size)
+CONVERSION_MEMORY_BUDGET = 4 * 1024**3
+
+# requests processed at once by one writer process per writer type (pedestals are always taken one at a time)
+DATA_API_WRITER_WORKERS = 2
+DETECTOR_CONVERT_WRITER_WORKERS = 1
+
+# detector retrievals: concurrent requests per writer, and the GPFS bandwidth (bytes/s, estimated per module) and SSD tmp space they may use together
+DETECTOR_RETRIEVE_CONCURRENCY = 4
+DETECTOR_RETRIEVE_BANDWIDTH = 4 * 1024**3
+DETECTOR_RETRIEVE_MODULE_BANDWIDTH = 256 * 1024**2
+DETECTOR_RETRIEVE_TMP_SPACE = 2 * 1024**4
+# seconds after which a waiting retrieval is started next, regardless of its size
+DETECTOR_RETRIEVE_MAX_WAIT = 300
 
 AUDIT_FILE_TIME_FORMAT = "%Y%m%d-%H%M%S"
 CONFIG_FILENAME_TIME_FORMAT = "%Y-%m-%d_%H:%M:%S"
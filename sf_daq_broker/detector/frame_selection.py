@@ -0,0 +1,53 @@
+import numpy as np
+
+
+# event bits in daq_rec
+DAQ_REC_LASER    = 1 << 16
+DAQ_REC_DARKSHOT = 1 << 17
+DAQ_REC_FEL      = 1 << 18
+DAQ_REC_PPICKER  = 1 << 19
+
+
+
+def select_frames(is_good_frame, pulse_ids=None, selected_pulse_ids=None):
+    """
+    indices of the good frames, optionally only those with pulse IDs in selected_pulse_ids
+    """
+    good = first_column(is_good_frame) != 0
+
+    if selected_pulse_ids is not None and len(selected_pulse_ids):
+        pulse_ids = first_column(pulse_ids)
+        selected_pulse_ids = np.unique(np.asarray(selected_pulse_ids, dtype=pulse_ids.dtype)) # sorted
+        good &= np.isin(pulse_ids, selected_pulse_ids)
+
+    return np.flatnonzero(good)
+
+
+def filter_events(indices, daq_recs, event):
+    """
+    the subset of frame indices for which the event bit is set in daq_rec
+    """
+    indices = np.asarray(indices, dtype=int)
+    return indices[has_event(daq_recs, event)[indices]]
+
+
+def has_event(daq_recs, event):
+    """
+    per frame, whether the event bit is set in daq_rec (of the first module)
+    """
+    return (first_column(daq_recs) & event) != 0
+
+
+def split_laser_events(indices, daq_recs):
+    """
+    splits the frame indices into dark and light frames, darkshot events are dark even if the laser is on
+    """
+    indices = np.asarray(indices, dtype=int)
+    laser_on = has_event(daq_recs, DAQ_REC_LASER) & ~has_event(daq_recs, DAQ_REC_DARKSHOT)
+    is_light = laser_on[indices]
+    return indices[~is_light], indices[is_light]
+
+
+def first_column(values):
+    values = np.asarray(values)
+    return values.reshape(len(values), -1)[:, 0]
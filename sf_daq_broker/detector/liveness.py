@@ -0,0 +1,132 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock, Thread
+from time import time
+
+from sf_daq_broker import config
+from sf_daq_broker.utils import parse_det_name
+
+
+_logger = logging.getLogger(__name__)
+
+
+BUFFER_LOCATION = "/gpfs/photonics/swissfel/buffer"
+
+
+
+class LivenessMonitor:
+    """
+    keeps a snapshot of the modification times of the LATEST files of all modules of the watched detectors,
+    which is refreshed in the background every interval seconds with parallel stat calls,
+    detectors are watched from the first time their status is requested
+    """
+
+    def __init__(self, buffer_location=BUFFER_LOCATION, interval=config.LIVENESS_INTERVAL, max_age=config.LIVENESS_MAX_AGE, n_threads=config.LIVENESS_THREADS):
+        self.buffer_location = buffer_location
+        self.interval = interval
+        self.max_age = max_age
+
+        self.executor = ThreadPoolExecutor(max_workers=n_threads, thread_name_prefix="liveness")
+        self.lock = Lock()
+        self.detectors = set()
+        self.snapshot_time = None
+        self.mtimes = {}
+
+        self.thread = None
+        self.stopped = Event()
+
+
+    def get_status(self, detectors):
+        """
+        running, limping and missing detectors according to the latest snapshot, and the time of the snapshot
+        """
+        while True:
+            with self.lock:
+                self.detectors.update(detectors)
+                snapshot_time = self.snapshot_time
+                mtimes = self.mtimes
+            if all(detector in mtimes for detector in detectors):
+                break
+            self.refresh()
+
+        self.start()
+
+        running_detectors = []
+        missing_detectors = []
+        limping_detectors = {}
+
+        for detector in detectors:
+            running_modules = []
+            missing_modules = []
+
+            for i_module, mtime in enumerate(mtimes[detector]):
+                if mtime is not None and snapshot_time - mtime < self.max_age:
+                    running_modules.append(i_module)
+                else:
+                    missing_modules.append(i_module)
+
+            if not running_modules:
+                missing_detectors.append(detector)
+            elif not missing_modules:
+                running_detectors.append(detector)
+            else:
+                limping_detectors[detector] = {
+                    "running_modules": running_modules,
+                    "missing_modules": missing_modules
+                }
+
+        return running_detectors, limping_detectors, missing_detectors, snapshot_time
+
+
+    def start(self):
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+
+    def stop(self):
+        self.stopped.set()
+
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception:
+                _logger.exception("refreshing the detector liveness snapshot failed")
+
+
+    def refresh(self):
+        with self.lock:
+            detectors = sorted(self.detectors)
+
+        fnames = []
+        for detector in detectors:
+            n_modules = parse_det_name(detector).T
+            fnames.extend(f"{self.buffer_location}/{detector}/M{i_module:02}/LATEST" for i_module in range(n_modules))
+
+        snapshot_time = time()
+        all_mtimes = iter(self.executor.map(get_mtime, fnames))
+
+        mtimes = {}
+        for detector in detectors:
+            n_modules = parse_det_name(detector).T
+            mtimes[detector] = [next(all_mtimes) for _ in range(n_modules)]
+
+        # the snapshot is replaced as a whole
+        with self.lock:
+            self.snapshot_time = snapshot_time
+            self.mtimes = mtimes
+
+
+
+def get_mtime(fname):
+    try:
+        return os.path.getmtime(fname)
+    except OSError:
+        return None
@@ -1,7 +1,9 @@
 import logging
 
 import h5py
+import numpy as np
 
+from sf_daq_broker.detector.frame_selection import select_frames, split_laser_events
 from sf_daq_broker.utils import json_load
 
 
@@ -23,46 +25,23 @@ def make_crystfel_list(data_file, run_info_file, detector):
         _logger.exception(f"cannot open provided data file {data_file}")
         raise
 
-    pulseids = f[f"/data/{detector}/pulse_id"][:]
-    n_pulse_id = len(pulseids)
+    # the per-frame datasets are read completely at once, which reads each chunk exactly once
+    with f:
+        pulseids = f[f"/data/{detector}/pulse_id"][:]
+        n_pulse_id = len(pulseids)
 
-    if f"/data/{detector}/is_good_frame" in f:
-        is_good_frame = f[f"/data/{detector}/is_good_frame"][:]
-    else:
-        is_good_frame = [1] * n_pulse_id
-
-    daq_recs = f[f"/data/{detector}/daq_rec"][:]
-
-    nGoodFrames = 0
-    nProcessedFrames = 0
-
-    index_dark = []
-    index_light = []
-
-    for i in range(len(pulseids)):
-        if not is_good_frame[i]:
-            continue
-
-        nGoodFrames += 1
-#        p = pulseids[i]
-        nProcessedFrames += 1
-        daq_rec = daq_recs[i]
-
-        event_laser    = bool((daq_rec>>16) & 1)
-        event_darkshot = bool((daq_rec>>17) & 1)
-#        event_fel      = bool((daq_rec>>18) & 1)
-#        event_ppicker  = bool((daq_rec>>19) & 1)
+        if f"/data/{detector}/is_good_frame" in f:
+            is_good_frame = f[f"/data/{detector}/is_good_frame"][:]
+        else:
+            is_good_frame = np.ones(n_pulse_id, dtype=bool)
 
-        laser_on = False
-        if not event_darkshot:
-            laser_on = event_laser
+        daq_recs = f[f"/data/{detector}/daq_rec"][:]
 
-        if laser_on:
-            index_light.append(i)
-        else:
-            index_dark.append(i)
+    good_frames = select_frames(is_good_frame)
+    index_dark, index_light = split_laser_events(good_frames, daq_recs)
 
-    f.close()
+    nGoodFrames = len(good_frames)
+    nProcessedFrames = nGoodFrames
 
     n_total = len(pulseids)
     n_dark  = len(index_dark)
@@ -70,10 +49,10 @@ def make_crystfel_list(data_file, run_info_file, detector):
 
     _logger.info(f"total number of frames: {n_total}, number of good frames: {nGoodFrames}, number of processed frames: {nProcessedFrames}, number of output frames: {n_dark} (dark) {n_light} (light)")
 
-    if index_dark:
+    if len(index_dark):
         write_list_file(data_file, "dark", index_dark)
 
-    if index_light:
+    if len(index_light):
         write_list_file(data_file, "light", index_light)
 
 
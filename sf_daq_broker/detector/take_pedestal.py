@@ -1,17 +1,22 @@
 import logging
-from time import sleep
+from time import sleep, time
 
 import epics
 
+from sf_daq_broker import config
 from sf_daq_broker.detector.detector import Detector
 from sf_daq_broker.utils import get_pulse_id_pvname
+from sf_daq_broker.utils.pulseids import align_pulse_ids
 
 
 _logger = logging.getLogger("broker_writer")
 
 
 
-def take_pedestal(detector_names, rate=1, pedestalmode=False):
+def take_pedestal(detector_names, rate=1, pedestalmode=False, on_progress=None):
+    """
+    on_progress(start_pulse_id, pulse_id) is called regularly while the gains are switched
+    """
     if not detector_names:
         raise ValueError("no detector names provided")
 
@@ -26,12 +31,12 @@ def take_pedestal(detector_names, rate=1, pedestalmode=False):
 
     _logger.info(f"take_pedestal: switch gains {mode} for {detector_names}")
 
-    start_pulse_id, stop_pulse_id = switch_gains(detectors, rate)
-    det_start_pulse_id, det_stop_pulse_id = align_pids(start_pulse_id, stop_pulse_id, rate)
+    start_pulse_id, stop_pulse_id = switch_gains(detectors, rate, on_progress=on_progress)
+    det_start_pulse_id, det_stop_pulse_id = align_pulse_ids(start_pulse_id, stop_pulse_id, rate)
     return det_start_pulse_id, det_stop_pulse_id
 
 
-def switch_gains_manually(detectors, rate):
+def switch_gains_manually(detectors, rate, on_progress=None):
     pulse_id_pv = get_pulse_id_pv(detectors)
 
     # store original gain mode settings
@@ -46,21 +51,21 @@ def switch_gains_manually(detectors, rate):
     start_pulse_id = int(pulse_id_pv.get())
 
     # collect in G0
-    sleep(10 * rate)
+    sleep_with_progress(10 * rate, pulse_id_pv, start_pulse_id, on_progress)
 
     # switch to G1
     for detector in detectors:
         detector.gain_mode = "fixed_gain1"
 
     # collect in G1
-    sleep(10 * rate)
+    sleep_with_progress(10 * rate, pulse_id_pv, start_pulse_id, on_progress)
 
     # switch to G2
     for detector in detectors:
         detector.gain_mode = "fixed_gain2"
 
     # collect in G2
-    sleep(10 * rate)
+    sleep_with_progress(10 * rate, pulse_id_pv, start_pulse_id, on_progress)
 
     stop_pulse_id = int(pulse_id_pv.get())
 
@@ -73,7 +78,7 @@ def switch_gains_manually(detectors, rate):
     return start_pulse_id, stop_pulse_id
 
 
-def switch_gains_via_pedestalmode(detectors, rate):
+def switch_gains_via_pedestalmode(detectors, rate, on_progress=None):
     pulse_id_pv = get_pulse_id_pv(detectors)
 
     # config
@@ -97,7 +102,7 @@ def switch_gains_via_pedestalmode(detectors, rate):
     ngains = 2 # g1 and g2
     nominal_rate = 100 # Hz
     wait_time = ngains * frames * loops * rate / nominal_rate
-    sleep(wait_time)
+    sleep_with_progress(wait_time, pulse_id_pv, start_pulse_id, on_progress)
 
     stop_pulse_id = int(pulse_id_pv.get())
 
@@ -118,16 +123,19 @@ def switch_gains_via_pedestalmode(detectors, rate):
     return start_pulse_id, stop_pulse_id
 
 
-def align_pids(start_pulse_id, stop_pulse_id, rate):
-    det_start_pulse_id = 0
-    det_stop_pulse_id = stop_pulse_id
-    for p in range(start_pulse_id, stop_pulse_id+1):
-        if p % rate == 0:
-            det_stop_pulse_id = p
-            if det_start_pulse_id == 0:
-                det_start_pulse_id = p
+def sleep_with_progress(duration, pulse_id_pv, start_pulse_id, on_progress, interval=config.PEDESTAL_STREAM_INTERVAL):
+    if on_progress is None:
+        sleep(duration)
+        return
 
-    return det_start_pulse_id, det_stop_pulse_id
+    end_time = time() + duration
+    while (remaining := end_time - time()) > 0:
+        sleep(min(interval, remaining))
+        pulse_id = int(pulse_id_pv.get())
+        try:
+            on_progress(start_pulse_id, pulse_id)
+        except Exception:
+            _logger.exception(f"take_pedestal: progress callback failed at pulse id {pulse_id}")
 
 
 def get_pulse_id_pv(detectors):
@@ -6,6 +6,7 @@ from pika import BasicProperties, BlockingConnection, ConnectionParameters
 from sf_daq_broker.utils import json_obj_to_str
 
 from . import broker_config
+from .publisher import Publisher
 
 
 ROUTES = {
@@ -20,15 +21,20 @@ ROUTES = {
 
 
 class BrokerClient:
+    """
+    send() publishes via a pool of long-lived connections and can be used from several threads,
+    open() returns a separate connection (e.g., for consuming), which is closed by close()
+    """
 
     def __init__(self, broker_url=broker_config.DEFAULT_BROKER_URL):
         self.broker_url = broker_url
         self.connection = None
         self.channel = None
+        self.publisher = Publisher(broker_url=broker_url)
 
 
     def open(self):
-        params = ConnectionParameters(self.broker_url)
+        params = ConnectionParameters(self.broker_url, heartbeat=broker_config.HEARTBEAT)
 
         try:
             self.connection = BlockingConnection(params)
@@ -52,54 +58,71 @@ class BrokerClient:
 
 
     def close(self):
-        self.connection.close()
+        if self.connection is not None:
+            self.connection.close()
         self.connection = None
         self.channel = None
+        self.publisher.close()
 
 
     def send(self, write_request, tag):
-        if self.channel is None:
-            raise RuntimeError("BrokerClient not connected.")
-
-        if tag.startswith("epics_"):
-            routing_key = tag
-        else:
-            routing_key = ROUTES[tag]
-
-        correlation_id = str(uuid.uuid4())
-        timestamp = time_ns()
-        body_bytes = json_obj_to_str(write_request).encode()
-
-        properties = BasicProperties(
-            correlation_id=correlation_id,
-            timestamp=timestamp
-        )
-
-        self.channel.basic_publish(
-            exchange=broker_config.REQUEST_EXCHANGE,
-            properties=properties,
-            routing_key=routing_key,
-            body=body_bytes
-        )
-
-        headers = {
-            "action": "write_request",
-            "source": "BrokerClient",
-            "routing_key": routing_key
-        }
-
-        properties = BasicProperties(
-            headers=headers,
-            correlation_id=correlation_id,
-            timestamp=timestamp
-        )
-
-        self.channel.basic_publish(
-            exchange=broker_config.STATUS_EXCHANGE,
-            properties=properties,
-            routing_key=routing_key,
-            body=body_bytes
-        )
-
-
-
+        unrouted = self.send_batch([(write_request, tag)])
+        if unrouted:
+            raise RuntimeError(f"no writer received the {tag} request")
+
+
+    def send_batch(self, requests):
+        """
+        publishes the (write_request, tag) pairs and their status notifications in one transaction,
+        returns once the broker has accepted all of them,
+        returns the (write_request, tag) pairs that no writer received (the others are delivered nevertheless)
+        """
+        messages = []
+        routing_keys = []
+        for write_request, tag in requests:
+            request_message, status_message = make_messages(write_request, tag)
+            messages.extend((request_message, status_message))
+            routing_keys.append(request_message[1])
+
+        returned = self.publisher.publish_batch(messages)
+        unrouted_keys = {routing_key for exchange, routing_key, _reason in returned if exchange == broker_config.REQUEST_EXCHANGE}
+
+        return [req for req, routing_key in zip(requests, routing_keys) if routing_key in unrouted_keys]
+
+
+
+def make_messages(write_request, tag):
+    """
+    the write request and the corresponding status notification as (exchange, routing_key, body, properties)
+    """
+    if tag.startswith("epics_"):
+        routing_key = tag
+    else:
+        routing_key = ROUTES[tag]
+
+    correlation_id = str(uuid.uuid4())
+    timestamp = time_ns()
+    body_bytes = json_obj_to_str(write_request).encode()
+
+    properties = BasicProperties(
+        correlation_id=correlation_id,
+        timestamp=timestamp
+    )
+
+    request_message = (broker_config.REQUEST_EXCHANGE, routing_key, body_bytes, properties)
+
+    headers = {
+        "action": "write_request",
+        "source": "BrokerClient",
+        "routing_key": routing_key
+    }
+
+    properties = BasicProperties(
+        headers=headers,
+        correlation_id=correlation_id,
+        timestamp=timestamp
+    )
+
+    status_message = (broker_config.STATUS_EXCHANGE, routing_key, body_bytes, properties)
+
+    return request_message, status_message
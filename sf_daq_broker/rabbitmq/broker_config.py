@@ -1,5 +1,11 @@
 DEFAULT_BROKER_URL = "127.0.0.1"
 
+# Publisher: number of pooled connections, heartbeat interval (s), and reconnection attempts.
+PUBLISHER_POOL_SIZE = 4
+HEARTBEAT = 60
+CONNECTION_ATTEMPTS = 3
+RETRY_DELAY = 1
+
 # Exchange where the write requests are sent.
 REQUEST_EXCHANGE = "request"
 
@@ -0,0 +1,203 @@
+import logging
+from queue import Empty, LifoQueue
+from threading import Lock
+
+from pika import BlockingConnection, ConnectionParameters
+from pika.exceptions import AMQPError
+
+from . import broker_config
+
+
+_logger = logging.getLogger(__name__)
+
+
+IDLE_WAIT = 1
+
+EXCHANGE_TYPES = {
+    broker_config.REQUEST_EXCHANGE: "topic",
+    broker_config.STATUS_EXCHANGE:  "fanout"
+}
+
+# messages to these exchanges are returned by the broker if no queue receives them (status messages may have no listener)
+MANDATORY_EXCHANGES = {
+    broker_config.REQUEST_EXCHANGE
+}
+
+
+
+class PooledConnection:
+    """
+    a connection with one transactional channel, the exchanges are declared once per connection,
+    the messages of a batch are published without waiting and committed together,
+    the commit returns once the broker has accepted all of them (or none, if the connection breaks before)
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.channel = connection.channel()
+        self.channel.tx_select()
+        self.channel.add_on_return_callback(self.on_return)
+        self.declared_exchanges = set()
+        self.returned = []
+
+
+    def publish_batch(self, messages):
+        """
+        returns (exchange, routing_key, reason) of the mandatory messages that no queue received
+        """
+        for exchange, _routing_key, _body, _properties in messages:
+            if exchange not in self.declared_exchanges:
+                self.channel.exchange_declare(exchange=exchange, exchange_type=EXCHANGE_TYPES[exchange])
+                self.declared_exchanges.add(exchange)
+
+        self.returned = []
+
+        for exchange, routing_key, body, properties in messages:
+            mandatory = (exchange in MANDATORY_EXCHANGES)
+            self.channel.basic_publish(exchange=exchange, routing_key=routing_key, body=body, properties=properties, mandatory=mandatory)
+
+        self.channel.tx_commit()
+        # the broker sends the returns before confirming the commit, this dispatches them
+        self.connection.process_data_events(time_limit=0)
+
+        return self.returned
+
+
+    def on_return(self, _channel, method, _properties, _body):
+        self.returned.append((method.exchange, method.routing_key, method.reply_text))
+
+
+    def keep_alive(self):
+        """
+        a blocking connection handles heartbeats only while it is used, thus, idle connections need to catch up
+        """
+        self.connection.process_data_events(time_limit=0)
+
+
+    @property
+    def is_open(self):
+        return self.connection.is_open and self.channel.is_open
+
+
+    def close(self):
+        try:
+            if self.connection.is_open:
+                self.connection.close()
+        except AMQPError:
+            pass
+
+
+
+class Publisher:
+    """
+    thread-safe publisher that keeps up to pool_size connections open,
+    each connection is used by one thread at a time, broken connections are replaced and the message is sent again
+    """
+
+    def __init__(self, broker_url=broker_config.DEFAULT_BROKER_URL, pool_size=broker_config.PUBLISHER_POOL_SIZE, heartbeat=broker_config.HEARTBEAT):
+        self.broker_url = broker_url
+        self.pool_size = pool_size
+        self.heartbeat = heartbeat
+
+        self.idle = LifoQueue() # the most recently used connection is the most likely to be alive
+        self.n_connections = 0
+        self.lock = Lock()
+
+
+    def publish(self, exchange, routing_key, body, properties=None):
+        return self.publish_batch([(exchange, routing_key, body, properties)])
+
+
+    def publish_batch(self, messages, n_tries=2):
+        """
+        messages: list of (exchange, routing_key, body, properties), which are committed together,
+        a failed batch is sent again as a whole: the delivery is at-least-once, since the connection may break
+        after the broker committed the batch but before the confirmation arrived, the batch is then delivered twice,
+        returns (exchange, routing_key, reason) of the mandatory messages that no queue received (e.g., no writer is running),
+        the other messages of that batch are delivered nevertheless
+        """
+        for i in range(n_tries):
+            conn = self.acquire()
+            try:
+                returned = conn.publish_batch(messages)
+            except AMQPError as e:
+                self.discard(conn)
+                count = i + 1
+                if count == n_tries:
+                    raise
+                _logger.warning(f"publishing {len(messages)} messages failed #{count}/{n_tries} due to {e!r} -- will reconnect and try again")
+            else:
+                self.release(conn)
+                break
+
+        if returned:
+            unroutable = ", ".join(f"{exchange}/{routing_key} ({reason})" for exchange, routing_key, reason in returned)
+            _logger.error(f"{len(returned)} of {len(messages)} messages were not routed to any queue: {unroutable}")
+
+        return returned
+
+
+    def acquire(self):
+        while True:
+            conn = self.get_idle()
+            if conn is None:
+                return self.connect()
+            try:
+                conn.keep_alive()
+            except AMQPError:
+                self.discard(conn)
+                continue
+            if conn.is_open:
+                return conn
+            self.discard(conn)
+
+
+    def get_idle(self):
+        """
+        an idle connection, None if a new one may be opened, otherwise waits for one to be released
+        """
+        while True:
+            try:
+                return self.idle.get_nowait()
+            except Empty:
+                pass
+
+            with self.lock:
+                if self.n_connections < self.pool_size:
+                    self.n_connections += 1
+                    return None
+
+            # a discarded connection frees a place in the pool without being released
+            try:
+                return self.idle.get(timeout=IDLE_WAIT)
+            except Empty:
+                continue
+
+
+    def connect(self):
+        params = ConnectionParameters(self.broker_url, heartbeat=self.heartbeat, connection_attempts=broker_config.CONNECTION_ATTEMPTS, retry_delay=broker_config.RETRY_DELAY)
+        try:
+            return PooledConnection(BlockingConnection(params))
+        except Exception:
+            with self.lock:
+                self.n_connections -= 1
+            raise
+
+
+    def release(self, conn):
+        self.idle.put(conn)
+
+
+    def discard(self, conn):
+        conn.close()
+        with self.lock:
+            self.n_connections -= 1
+
+
+    def close(self):
+        while True:
+            try:
+                conn = self.idle.get_nowait()
+            except Empty:
+                break
+            self.discard(conn)
@@ -1,4 +1,5 @@
 
 from .rest_api import register_rest_api
+from .server import run_server
 
 
@@ -0,0 +1,154 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import time
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+import bottle
+
+from .return_status import return_status
+
+
+_logger = logging.getLogger(__name__)
+
+
+LISTEN_BACKLOG = 64
+
+
+
+def run_server(app, host, port, n_threads):
+    """
+    serves app with n_threads requests handled at once (if n_threads is 0, by bottle's default single-threaded server),
+    the request metrics are available at /get_server_metrics
+    """
+    metrics = RequestMetrics(app)
+    register_metrics_endpoint(app, metrics)
+
+    if n_threads:
+        bottle.run(app=metrics, host=host, port=port, server=ThreadPoolServer, n_threads=n_threads)
+    else:
+        bottle.run(app=metrics, host=host, port=port)
+
+
+def register_metrics_endpoint(app, metrics):
+    @app.get("/get_server_metrics")
+    @return_status
+    def handler():
+        return metrics.snapshot()
+
+
+
+class ThreadPoolServer(bottle.ServerAdapter):
+
+    def run(self, handler):
+        n_threads = self.options["n_threads"]
+        server = make_threadpool_server(self.host, self.port, handler, n_threads)
+        _logger.info(f"handling up to {n_threads} requests at once")
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+
+
+
+def make_threadpool_server(host, port, app, n_threads):
+    server = make_server(host, port, app, server_class=ThreadPoolWSGIServer, handler_class=WSGIRequestHandler)
+    server.executor = ThreadPoolExecutor(max_workers=n_threads, thread_name_prefix="rest_api")
+    return server
+
+
+
+class ThreadPoolWSGIServer(WSGIServer):
+    """
+    handles the connections in a bounded pool of threads, further connections wait until a thread is free
+    """
+
+    request_queue_size = LISTEN_BACKLOG
+    executor = None
+
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+
+class RequestMetrics:
+    """
+    WSGI middleware that counts the requests in flight (current and maximum),
+    and the number of requests and their latency per path
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.lock = Lock()
+        self.start_time = time()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.paths = {}
+
+
+    def __call__(self, environ, start_response):
+        path = environ.get("PATH_INFO", "")
+
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+        time_start = time()
+        try:
+            return self.app(environ, start_response)
+        finally:
+            latency = time() - time_start
+            with self.lock:
+                self.in_flight -= 1
+                stats = self.paths.setdefault(path, PathStats())
+                stats.add(latency)
+
+            _logger.debug(f"{path} took {latency} seconds")
+
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "uptime": time() - self.start_time,
+                "in_flight": self.in_flight,
+                "max_in_flight": self.max_in_flight,
+                "endpoints": {path: stats.to_dict() for path, stats in sorted(self.paths.items())}
+            }
+
+
+
+class PathStats:
+
+    def __init__(self):
+        self.count = 0
+        self.total_latency = 0
+        self.max_latency = 0
+
+
+    def add(self, latency):
+        self.count += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "mean_latency": self.total_latency / self.count,
+            "max_latency": self.max_latency
+        }
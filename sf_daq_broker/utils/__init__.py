@@ -1,4 +1,5 @@
 
+from .counter import get_counter
 from .detname import parse_det_name
 from .excfmt import dueto, excfmt, typename
 from .get_beamline import get_beamline
@@ -8,7 +9,7 @@ from .gitrepo import GitRepo
 from .jsonext import json_load, json_save, json_obj_to_str, json_str_to_obj
 from .load_module import load_module
 from .ping import ping, ping_many
-from .pulseids import pulse_id_to_timestamp
+from .pulseids import pulse_id_to_timestamp, pulse_ids_to_timestamps
 from .run_timeout import run_timeout
 
 
@@ -0,0 +1,87 @@
+import fcntl
+import os
+from contextlib import contextmanager
+from threading import Lock
+from weakref import WeakValueDictionary
+
+
+# a counter is kept only while it is in use, otherwise there would be one for each run ever seen
+_counters = WeakValueDictionary()
+_counters_lock = Lock()
+
+
+
+def get_counter(fname, initial=None):
+    """
+    the FileCounter for fname, shared within the process (and thus its lock) by all threads that use it at the same time
+    """
+    with _counters_lock:
+        counter = _counters.get(fname)
+        if counter is None:
+            counter = _counters[fname] = FileCounter(fname, initial=initial)
+        return counter
+
+
+
+class FileCounter:
+    """
+    integer counter stored as text in fname (if it does not exist, the value returned by initial() or 0):
+    increments hold an fcntl lock on a separate lock file, thus are atomic across processes (and hosts, if the file system supports it),
+    the new value is written to a temporary file that replaces fname, thus readers never see a partially written value,
+    reads are not cached (a replaced file may have the same inode, size and mtime), the value is only a few bytes
+    """
+
+    def __init__(self, fname, initial=None):
+        self.fname = fname
+        self.initial = initial
+        directory, name = os.path.split(fname)
+        self.lock_fname = os.path.join(directory, f".{name}.lock")
+        self.tmp_fname = os.path.join(directory, f".{name}.tmp")
+
+        self.lock = Lock()
+
+
+    def get(self):
+        value = self.read()
+        if value is None:
+            return self.get_initial()
+        return value
+
+
+    def increment(self, step=1):
+        with self.lock, locked(self.lock_fname):
+            value = self.read()
+            if value is None:
+                value = self.get_initial()
+            value += step
+            self.write(value)
+        return value
+
+
+    def read(self):
+        try:
+            with open(self.fname) as f:
+                return int(f.read())
+        except FileNotFoundError:
+            return None
+
+
+    def get_initial(self):
+        return 0 if self.initial is None else self.initial()
+
+
+    def write(self, value):
+        with open(self.tmp_fname, "w") as f:
+            f.write(str(value))
+        os.replace(self.tmp_fname, self.fname)
+
+
+
+@contextmanager
+def locked(fname):
+    with open(fname, "a") as f:
+        fcntl.lockf(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.lockf(f, fcntl.LOCK_UN)
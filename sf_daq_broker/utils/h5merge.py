@@ -0,0 +1,163 @@
+import os
+
+import h5py
+import numpy as np
+
+
+# largest block of data held in memory at once while concatenating
+COPY_NBYTES = 256 * 1024**2
+
+
+
+def merge_files(file_names, output_file, frame_datasets):
+    """
+    combines files with the same layout into output_file:
+    the frame_datasets (one entry per frame, the number of frames is the length of the first one) are concatenated as virtual datasets,
+    all other datasets and the attributes are copied from the first file,
+    the source files are referenced relative to output_file, thus they have to be kept and moved together with it
+    """
+    lengths = []
+    for fn in file_names:
+        with h5py.File(fn, "r") as h5f:
+            lengths.append(len(h5f[frame_datasets[0]]))
+
+    output_dir = os.path.dirname(os.path.abspath(output_file))
+    source_names = [os.path.relpath(os.path.abspath(fn), output_dir) for fn in file_names]
+
+    with h5py.File(file_names[0], "r") as first, h5py.File(output_file, "w") as out:
+        copy_attrs(first, out)
+
+        for name, obj in list_objects(first):
+            if isinstance(obj, h5py.Group):
+                copy_attrs(obj, out.require_group(name))
+                continue
+
+            parent = os.path.dirname(name)
+            if parent:
+                out.require_group(parent)
+
+            if name in frame_datasets:
+                layout = make_layout(name, obj, source_names, file_names, lengths)
+                dataset = out.create_virtual_dataset(name, layout)
+                copy_attrs(obj, dataset)
+            else:
+                first.copy(obj, out, name=name)
+
+    return sum(lengths)
+
+
+
+def combine_files(file_names, output_file):
+    """
+    copies the top-level objects of files with disjoint contents into output_file (the attributes are taken from the first file),
+    the chunks are copied as they are, without decompressing them
+    """
+    with h5py.File(output_file, "w") as out:
+        for i, fn in enumerate(file_names):
+            with h5py.File(fn, "r") as h5f:
+                if i == 0:
+                    copy_attrs(h5f, out)
+                for name in h5f:
+                    if name in out:
+                        msg = f"cannot combine {name}: present in more than one file"
+                        raise RuntimeError(msg)
+                    h5f.copy(h5f[name], out, name=name)
+
+
+
+def concatenate_files(file_names, output_file, max_nbytes=COPY_NBYTES):
+    """
+    concatenates the datasets of the files (in the given order) along the first axis into output_file,
+    datasets may be missing in some of the files, scalar datasets and the attributes are taken from the first file containing them,
+    the data is copied in blocks of at most max_nbytes
+    """
+    shapes = {}
+    for fn in file_names:
+        with h5py.File(fn, "r") as h5f:
+            for name, obj in list_objects(h5f):
+                if isinstance(obj, h5py.Dataset) and obj.shape:
+                    shapes.setdefault(name, []).append((fn, obj.shape))
+
+    offsets = {}
+    with h5py.File(output_file, "w") as out:
+        for i, fn in enumerate(file_names):
+            with h5py.File(fn, "r") as h5f:
+                if i == 0:
+                    copy_attrs(h5f, out)
+
+                for name, obj in list_objects(h5f):
+                    if name not in out:
+                        if isinstance(obj, h5py.Group):
+                            copy_attrs(obj, out.create_group(name))
+                        elif not obj.shape:
+                            h5f.copy(obj, out, name=name)
+                        else:
+                            create_concatenated(out, name, obj, shapes[name])
+                            offsets[name] = 0
+
+                    if name in offsets:
+                        offsets[name] = copy_rows(obj, out[name], offsets[name], max_nbytes)
+
+
+
+def create_concatenated(out, name, first_dataset, shapes):
+    frame_shape = first_dataset.shape[1:]
+    for fn, shape in shapes:
+        if shape[1:] != frame_shape:
+            msg = f"cannot concatenate {name}: different shape {shape} in {fn}"
+            raise RuntimeError(msg)
+
+    n_total = sum(shape[0] for _fn, shape in shapes)
+    dataset = out.create_dataset(
+        name,
+        shape=(n_total,) + frame_shape,
+        dtype=first_dataset.dtype,
+        chunks=first_dataset.chunks,
+        maxshape=(None,) + frame_shape if first_dataset.chunks else None, # allows chunks larger than an empty dataset
+        compression=first_dataset.compression,
+        compression_opts=first_dataset.compression_opts,
+        shuffle=first_dataset.shuffle
+    )
+    copy_attrs(first_dataset, dataset)
+
+
+def copy_rows(src, dst, offset, max_nbytes):
+    nbytes_row = max(1, src.dtype.itemsize * int(np.prod(src.shape[1:])))
+    step = max(1, max_nbytes // nbytes_row)
+    n = len(src)
+    for start in range(0, n, step):
+        stop = min(start + step, n)
+        dst[offset + start:offset + stop] = src[start:stop]
+    return offset + n
+
+
+
+def list_objects(h5f):
+    res = []
+    h5f.visititems(lambda name, obj: res.append((name, obj)))
+    return res
+
+
+def make_layout(name, first_dataset, source_names, file_names, lengths):
+    frame_shape = first_dataset.shape[1:]
+    dtype = first_dataset.dtype
+
+    layout = h5py.VirtualLayout(shape=(sum(lengths),) + frame_shape, dtype=dtype)
+
+    start = 0
+    for source_name, fn, n in zip(source_names, file_names, lengths):
+        with h5py.File(fn, "r") as h5f:
+            if name not in h5f or h5f[name].shape != (n,) + frame_shape:
+                msg = f"cannot merge {name}: different layout in {fn}"
+                raise RuntimeError(msg)
+
+        stop = start + n
+        layout[start:stop] = h5py.VirtualSource(source_name, name, shape=(n,) + frame_shape, dtype=dtype)
+        start = stop
+
+    return layout
+
+
+def copy_attrs(src, dst):
+    for key, value in src.attrs.items():
+        dst.attrs[key] = value
@@ -0,0 +1,111 @@
+import h5py
+import numpy as np
+
+
+# frames are read in batches of roughly this size
+BATCH_NBYTES = 256 * 1024**2 # 256 MB
+
+# chunk cache: at most this size, and about 100 hash slots per chunk that fits into the cache (as recommended by HDF5)
+CACHE_NBYTES_MIN = 1024**2 # HDF5 default
+CACHE_NBYTES_MAX = 1024**3
+CACHE_NSLOTS_PER_CHUNK = 100
+# evict fully read chunks first, the data is read sequentially
+CACHE_W0 = 1.0
+
+
+
+class ChunkedReader:
+    """
+    reads a dataset with frames along the first axis in batches that are aligned to its chunks,
+    the chunk cache holds one layer of chunks (i.e., all chunks of a frame), such that reading single frames
+    or parts of frames does not decompress/read a chunk more than once
+    """
+
+    def __init__(self, h5f, name, batch_size=None, batch_nbytes=BATCH_NBYTES):
+        shape, dtype, chunks = get_layout(h5f, name)
+
+        self.shape = shape
+        self.dtype = dtype
+        self.chunks = chunks
+
+        self.frame_nbytes = dtype.itemsize * int(np.prod(shape[1:]))
+        self.chunk_frames = chunks[0] if chunks else 1
+
+        if chunks:
+            chunk_nbytes = dtype.itemsize * int(np.prod(chunks))
+            layer_nbytes = chunk_nbytes * n_chunks(shape[1:], chunks[1:])
+            cache_nbytes = min(max(layer_nbytes, CACHE_NBYTES_MIN), CACHE_NBYTES_MAX)
+            cache_nslots = next_prime(CACHE_NSLOTS_PER_CHUNK * max(1, cache_nbytes // chunk_nbytes))
+            dataset = open_dataset(h5f, name, cache_nbytes, cache_nslots)
+        else:
+            dataset = h5f[name]
+
+        self.dataset = dataset
+
+        if batch_size is None:
+            batch_size = batch_nbytes // max(1, self.frame_nbytes)
+        self.set_batch_size(batch_size)
+
+
+    def __len__(self):
+        return self.shape[0]
+
+
+    def __getitem__(self, index):
+        return self.dataset[index]
+
+
+    def set_batch_size(self, batch_size):
+        self.batch_size = align_batch_size(batch_size, self.chunk_frames)
+
+
+    def batches(self, start=0, stop=None):
+        """
+        yields (start, stop) of the batches, the boundaries are multiples of the batch size, thus aligned to the chunks
+        """
+        if stop is None:
+            stop = len(self)
+
+        batch_size = self.batch_size
+        while start < stop:
+            batch_stop = min((start // batch_size + 1) * batch_size, stop)
+            yield start, batch_stop
+            start = batch_stop
+
+
+
+def get_layout(h5f, name):
+    # the dataset is closed again when returning, otherwise a later open_dataset would return the already open dataset with its cache
+    dataset = h5f[name]
+    return dataset.shape, dataset.dtype, dataset.chunks
+
+
+def align_batch_size(batch_size, chunk_frames):
+    """
+    rounds down to a multiple of the number of frames per chunk (if batch_size is larger than that)
+    """
+    batch_size = max(1, int(batch_size))
+    if batch_size > chunk_frames:
+        batch_size -= batch_size % chunk_frames
+    return batch_size
+
+
+def open_dataset(h5f, name, cache_nbytes, cache_nslots, cache_w0=CACHE_W0):
+    """
+    opens a dataset with its own chunk cache (the dataset must not be open already)
+    """
+    dapl = h5py.h5p.create(h5py.h5p.DATASET_ACCESS)
+    dapl.set_chunk_cache(cache_nslots, cache_nbytes, cache_w0)
+    dsid = h5py.h5d.open(h5f.id, name.encode(), dapl)
+    return h5py.Dataset(dsid)
+
+
+def n_chunks(shape, chunks):
+    return int(np.prod([-(-s // c) for s, c in zip(shape, chunks)]))
+
+
+def next_prime(n):
+    n = max(2, n)
+    while any(n % i == 0 for i in range(2, int(n**0.5) + 1)):
+        n += 1
+    return n
@@ -0,0 +1,48 @@
+from threading import Lock
+
+
+# fraction of the available memory that the calculations (pedestal, conversion) may use
+MEMORY_FRACTION = 0.8
+
+
+
+def get_available_memory():
+    """
+    MemAvailable in bytes (None if unknown)
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+
+class Reservations:
+    """
+    bytes reserved by the threads of a process, e.g., for files that are about to be written
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.nbytes = 0
+
+
+    def reserve(self, nbytes, fits):
+        """
+        reserves nbytes if fits(nbytes + the bytes reserved already) is true, returns whether it did
+        """
+        with self.lock:
+            if not fits(self.nbytes + nbytes):
+                return False
+            self.nbytes += nbytes
+            return True
+
+
+    def release(self, nbytes):
+        with self.lock:
+            self.nbytes -= nbytes
+
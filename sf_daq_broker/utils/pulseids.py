@@ -1,15 +1,52 @@
 import logging
+from threading import Lock
 from time import sleep
 
+import numpy as np
 import requests
 
 from sf_daq_broker import config
 from .excfmt import dueto
+from .request_context import ContextThreadPoolExecutor
+from .timestamp_cache import TimestampCache
 
 
 _logger = logging.getLogger("broker_writer")
 
 
+_timestamp_cache = None
+_timestamp_cache_lock = Lock()
+
+
+
+def align_pulse_ids(start_pulse_id, stop_pulse_id, rate_multiplicator):
+    """
+    the first and the last pulse ID within [start_pulse_id, stop_pulse_id] that are multiples of rate_multiplicator,
+    (0, stop_pulse_id) if there is none
+    """
+    first = -(-start_pulse_id // rate_multiplicator) * rate_multiplicator
+    last = stop_pulse_id // rate_multiplicator * rate_multiplicator
+    if first > last:
+        return 0, stop_pulse_id
+    return first, last
+
+
+def expected_pulse_ids(start_pulse_id, stop_pulse_id, rate_multiplicator=1):
+    """
+    array of the pulse IDs within [start_pulse_id, stop_pulse_id] that are multiples of rate_multiplicator
+    """
+    first = -(-start_pulse_id // rate_multiplicator) * rate_multiplicator
+    return np.arange(first, stop_pulse_id + 1, rate_multiplicator, dtype=np.int64)
+
+
+def split_pulse_range(start_pulse_id, stop_pulse_id, step, rate_multiplicator=1):
+    """
+    (start, stop) of consecutive segments of step pulses, the segment boundaries stay aligned to rate_multiplicator
+    """
+    starts = range(start_pulse_id, stop_pulse_id + 1, step)
+    return [(start, min(start + step - rate_multiplicator, stop_pulse_id)) for start in starts]
+
+
 
 #def pulse_id_to_seconds(pulse_id, **kwargs):
 #    ts = pulse_id_to_timestamp(pulse_id, **kwargs)
@@ -17,6 +54,63 @@ _logger = logging.getLogger("broker_writer")
 
 
 def pulse_id_to_timestamp(pulse_id, n_tries=15, wait_time=5):
+    return pulse_ids_to_timestamps([pulse_id], n_tries=n_tries, wait_time=wait_time, exact=[pulse_id])[0]
+
+
+def pulse_ids_to_timestamps(pulse_ids, n_tries=15, wait_time=5, cache=None, exact=()):
+    """
+    timestamps of pulse_ids, from the cache if known or interpolatable, otherwise requested (concurrently) from the mapping service,
+    the outermost unknown pulse IDs are requested first, as the ones in between can then often be interpolated,
+    the pulse IDs in exact are never interpolated (an interpolated timestamp may be off by up to the interpolation tolerance)
+    """
+    if cache is None:
+        cache = get_timestamp_cache()
+
+    exact = set(exact)
+
+    res = {pulse_id: cache.get(pulse_id, interpolate=(pulse_id not in exact)) for pulse_id in set(pulse_ids)}
+    missing = sorted(pulse_id for pulse_id, timestamp in res.items() if timestamp is None)
+
+    if missing:
+        outermost = sorted({missing[0], missing[-1]})
+        fetch_timestamps(outermost, res, cache, n_tries, wait_time)
+
+        inner = []
+        for pulse_id in missing[1:-1]:
+            res[pulse_id] = timestamp = cache.get(pulse_id, interpolate=(pulse_id not in exact))
+            if timestamp is None:
+                inner.append(pulse_id)
+        fetch_timestamps(inner, res, cache, n_tries, wait_time)
+
+    return [res[pulse_id] for pulse_id in pulse_ids]
+
+
+def fetch_timestamps(pulse_ids, res, cache, n_tries, wait_time):
+    if not pulse_ids:
+        return
+
+    n_workers = min(len(pulse_ids), config.PULSEID_LOOKUP_THREADS)
+    with ContextThreadPoolExecutor(max_workers=n_workers) as executor:
+        timestamps = executor.map(lambda pulse_id: request_timestamp(pulse_id, n_tries, wait_time), pulse_ids)
+        for pulse_id, timestamp in zip(pulse_ids, timestamps):
+            res[pulse_id] = timestamp
+            cache.put(pulse_id, timestamp)
+
+
+def get_timestamp_cache():
+    global _timestamp_cache
+    with _timestamp_cache_lock:
+        if _timestamp_cache is None:
+            _timestamp_cache = TimestampCache(
+                config.PULSEID_CACHE_SIZE,
+                filename=config.PULSEID_CACHE_FILE,
+                max_gap=config.PULSEID_INTERPOLATION_MAX_GAP,
+                tolerance=config.PULSEID_INTERPOLATION_TOLERANCE
+            )
+        return _timestamp_cache
+
+
+def request_timestamp(pulse_id, n_tries=15, wait_time=5):
     url = f"{config.PULSEID2SECONDS_MATCHING_ADDRESS}/{pulse_id}"
 
     for i in range(n_tries):
@@ -0,0 +1,42 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar, copy_context
+
+
+# the request that the current thread works on (None outside of requests)
+current_request = ContextVar("current_request", default=None)
+
+
+
+class RequestFilter(logging.Filter):
+    """
+    passes the records logged while working on request_id,
+    which includes the threads started via ContextThreadPoolExecutor or run_in_context
+    """
+
+    def __init__(self, request_id):
+        super().__init__()
+        self.request_id = request_id
+
+
+    def filter(self, record):
+        return current_request.get() == self.request_id
+
+
+
+class ContextThreadPoolExecutor(ThreadPoolExecutor):
+    """
+    runs the submitted functions in (a copy of) the context of the submitting thread, e.g., with its current_request
+    """
+
+    def submit(self, fn, /, *args, **kwargs):
+        return super().submit(run_in_context(fn), *args, **kwargs)
+
+
+
+def run_in_context(fn):
+    """
+    fn wrapped to run in (a copy of) the current context, e.g., as target of a Thread
+    """
+    context = copy_context()
+    return lambda *args, **kwargs: context.run(fn, *args, **kwargs)
@@ -0,0 +1,180 @@
+import json
+import logging
+import os
+from threading import Event, Lock, Thread
+
+from .counter import locked
+from .jsonext import json_load, json_save
+
+
+_logger = logging.getLogger(__name__)
+
+
+SCAN_INFO_FILE = "scan.json"
+SCAN_JOURNAL_FILE = "scan.jsonl"
+SCAN_JOURNAL_LOCK_FILE = ".scan.lock"
+
+EACH_SCAN_FIELDS = [
+    "scan_readbacks",
+    "scan_step_info",
+    "scan_values",
+    "scan_readbacks_raw"
+]
+
+
+
+def append_scan_step(meta_directory, request_scan_info, scan_files, pulse_ids):
+    """
+    appends one line with the scan step to the journal in meta_directory,
+    scan.json of runs started before the journal existed is converted to the journal first
+    """
+    entry = make_entry(request_scan_info, scan_files, pulse_ids)
+    journal_file = f"{meta_directory}/{SCAN_JOURNAL_FILE}"
+
+    with locked(f"{meta_directory}/{SCAN_JOURNAL_LOCK_FILE}"):
+        lines = []
+        scan_info_file = f"{meta_directory}/{SCAN_INFO_FILE}"
+        if not os.path.exists(journal_file) and os.path.exists(scan_info_file):
+            lines += scan_info_to_lines(json_load(scan_info_file))
+        lines.append(json.dumps(entry))
+
+        with open(journal_file, "a") as f:
+            f.write("".join(line + "\n" for line in lines))
+
+
+def make_entry(request_scan_info, scan_files, pulse_ids):
+    scan_parameters = {k: v for k, v in request_scan_info.items() if k not in EACH_SCAN_FIELDS}
+    entry = {
+        "scan_parameters": scan_parameters,
+        "scan_files": scan_files,
+        "pulseIds": pulse_ids
+    }
+    for scan_step_field in EACH_SCAN_FIELDS:
+        entry[scan_step_field] = request_scan_info.get(scan_step_field, [])
+    return entry
+
+
+def scan_info_to_lines(scan_info):
+    n_steps = len(scan_info["scan_files"])
+    for i in range(n_steps):
+        entry = {
+            "scan_parameters": scan_info["scan_parameters"],
+            "scan_files": scan_info["scan_files"][i],
+            "pulseIds": scan_info["pulseIds"][i]
+        }
+        for scan_step_field in EACH_SCAN_FIELDS:
+            entry[scan_step_field] = scan_info[scan_step_field][i]
+        yield json.dumps(entry)
+
+
+
+def read_scan_info(meta_directory):
+    """
+    the content of scan.json (as written before the journal existed) built from the journal in meta_directory
+    """
+    scan_info = {
+        "scan_files": [],
+        "pulseIds": []
+    }
+    for scan_step_field in EACH_SCAN_FIELDS:
+        scan_info[scan_step_field] = []
+
+    with open(f"{meta_directory}/{SCAN_JOURNAL_FILE}") as f:
+        for line in f:
+            if not line.endswith("\n"):
+                break # the last step is still being written
+            entry = json.loads(line)
+            # the scan parameters are the ones of the first step
+            scan_info.setdefault("scan_parameters", entry["scan_parameters"])
+            scan_info["scan_files"].append(entry["scan_files"])
+            scan_info["pulseIds"].append(entry["pulseIds"])
+            for scan_step_field in EACH_SCAN_FIELDS:
+                scan_info[scan_step_field].append(entry[scan_step_field])
+
+    scan_info.setdefault("scan_parameters", {})
+    return scan_info
+
+
+def materialize_scan_info(meta_directory):
+    """
+    (re)writes scan.json from the journal in meta_directory, readers never see a partially written file
+    """
+    scan_info_file = f"{meta_directory}/{SCAN_INFO_FILE}"
+    tmp_file = f"{meta_directory}/.{SCAN_INFO_FILE}.tmp"
+
+    with locked(f"{meta_directory}/{SCAN_JOURNAL_LOCK_FILE}"):
+        scan_info = read_scan_info(meta_directory)
+        json_save(scan_info, tmp_file)
+        os.replace(tmp_file, scan_info_file)
+
+
+def is_outdated(meta_directory):
+    """
+    whether scan.json is missing or older than the journal (e.g., after a restart of the broker)
+    """
+    try:
+        mtime_journal = os.path.getmtime(f"{meta_directory}/{SCAN_JOURNAL_FILE}")
+    except FileNotFoundError:
+        return False
+    try:
+        mtime_scan_info = os.path.getmtime(f"{meta_directory}/{SCAN_INFO_FILE}")
+    except FileNotFoundError:
+        return True
+    return mtime_scan_info <= mtime_journal
+
+
+
+class ScanInfoMaterializer:
+    """
+    rewrites scan.json of the runs with new scan steps in the background, at most once every interval seconds per run,
+    instead of once per scan step
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = Lock()
+        self.outdated = set()
+        self.thread = None
+        self.stopped = Event()
+
+
+    def mark(self, meta_directory):
+        with self.lock:
+            self.outdated.add(meta_directory)
+        self.start()
+
+
+    def flush(self, meta_directories=None):
+        """
+        materializes the given (by default all) outdated runs now
+        """
+        with self.lock:
+            if meta_directories is None:
+                meta_directories = set(self.outdated)
+            self.outdated.difference_update(meta_directories)
+
+        for meta_directory in sorted(meta_directories):
+            try:
+                materialize_scan_info(meta_directory)
+            except Exception:
+                _logger.exception(f"writing {SCAN_INFO_FILE} in {meta_directory} failed")
+
+
+    def start(self):
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+
+    def stop(self):
+        self.stopped.set()
+        self.flush()
+
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.flush()
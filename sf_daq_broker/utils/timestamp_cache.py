@@ -0,0 +1,134 @@
+import logging
+import os
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from threading import Lock
+
+
+_logger = logging.getLogger("broker_writer")
+
+
+# SwissFEL pulses are 10 ms apart (100 Hz)
+PULSE_PERIOD_NS = 10_000_000
+
+
+
+class TimestampCache:
+    """
+    LRU cache of the timestamps (ns) of pulse IDs, shared by all threads,
+    pulse IDs between two cached ones at most max_gap pulses apart are interpolated
+    if these two anchors are on the 100 Hz grid within tolerance ns,
+    if filename is given, the cache is loaded from and new entries are appended to it
+    """
+
+    def __init__(self, capacity, filename=None, max_gap=0, tolerance=0):
+        self.capacity = capacity
+        self.filename = filename
+        self.max_gap = max_gap
+        self.tolerance = tolerance
+
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.sorted_pulse_ids = []
+
+        if filename is not None:
+            self.load()
+
+
+    def get(self, pulse_id, interpolate=True):
+        """
+        the cached or (if interpolate) interpolated timestamp of pulse_id, None if it is unknown
+        """
+        with self.lock:
+            timestamp = self.entries.get(pulse_id)
+            if timestamp is not None:
+                self.entries.move_to_end(pulse_id)
+                return timestamp
+
+            if not interpolate:
+                return None
+
+            return self.interpolate(pulse_id)
+
+
+    def put(self, pulse_id, timestamp, persist=True):
+        with self.lock:
+            self.add(pulse_id, timestamp)
+
+        if persist and self.filename is not None:
+            try:
+                with open(self.filename, "a") as f:
+                    f.write(f"{pulse_id} {timestamp}\n")
+            except OSError:
+                _logger.exception(f"cannot persist pulse ID {pulse_id} to {self.filename}")
+
+
+    def add(self, pulse_id, timestamp):
+        if pulse_id in self.entries:
+            self.entries.move_to_end(pulse_id)
+            return
+
+        self.entries[pulse_id] = timestamp
+        insort(self.sorted_pulse_ids, pulse_id)
+
+        while len(self.entries) > self.capacity:
+            oldest, _ = self.entries.popitem(last=False)
+            index = bisect_left(self.sorted_pulse_ids, oldest)
+            del self.sorted_pulse_ids[index]
+
+
+    def interpolate(self, pulse_id):
+        index = bisect_left(self.sorted_pulse_ids, pulse_id)
+        if index == 0 or index == len(self.sorted_pulse_ids):
+            return None
+
+        before = self.sorted_pulse_ids[index - 1]
+        after  = self.sorted_pulse_ids[index]
+        if after - before > self.max_gap:
+            return None
+
+        ts_before = self.entries[before]
+        ts_after  = self.entries[after]
+        deviation = (ts_after - ts_before) - (after - before) * PULSE_PERIOD_NS
+        if abs(deviation) > self.tolerance:
+            return None
+
+        return ts_before + (pulse_id - before) * (ts_after - ts_before) // (after - before)
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def load(self):
+        """
+        reads the persisted entries (the last ones are kept), the file is compacted if it grew much larger than the cache
+        """
+        try:
+            with open(self.filename) as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return
+
+        with self.lock:
+            for line in lines:
+                try:
+                    pulse_id, timestamp = map(int, line.split())
+                except ValueError:
+                    continue # e.g., a line still being written by another process
+                self.add(pulse_id, timestamp)
+
+        if len(lines) > 2 * self.capacity:
+            self.compact()
+
+
+    def compact(self):
+        tmp_filename = f"{self.filename}.{os.getpid()}.tmp"
+        with self.lock:
+            entries = list(self.entries.items())
+        try:
+            with open(tmp_filename, "w") as f:
+                f.writelines(f"{pulse_id} {timestamp}\n" for pulse_id, timestamp in entries)
+            os.replace(tmp_filename, self.filename)
+        except OSError:
+            _logger.exception(f"cannot compact {self.filename}")
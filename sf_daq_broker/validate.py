@@ -8,6 +8,7 @@ from sf_daq_broker.utils import dueto, get_beamline
 
 MAX_PULSEID_DELTA = 60001
 ALLOWED_RATE_MULTIPLICATORS = [1, 2, 4, 8, 10, 20, 40, 50, 100]
+ALLOWED_PEDESTAL_ACCUMULATORS = ["float64", "float32", "welford"]
 
 
 ##TODO: use message templates?
@@ -108,6 +109,22 @@ def rate_multiplicator(rm):
     if rm not in ALLOWED_RATE_MULTIPLICATORS:
         raise ValidationError('"rate_multiplicator" not from allowed values {ALLOWED_RATE_MULTIPLICATORS}')
 
+def pedestal_workers(pw):
+    if not isinstance(pw, int) or isinstance(pw, bool) or pw < 1:
+        raise ValidationError(f'"pedestal_workers" ({pw}) is not a positive integer')
+
+def segment_frames(sf):
+    if not isinstance(sf, int) or isinstance(sf, bool) or sf < 1:
+        raise ValidationError(f'"segment_frames" ({sf}) is not a positive integer')
+
+def pedestal_streaming(ps):
+    if not isinstance(ps, bool):
+        raise ValidationError(f'"pedestal_streaming" ({ps}) is not a boolean')
+
+def pedestal_accumulator(pa):
+    if pa not in ALLOWED_PEDESTAL_ACCUMULATORS:
+        raise ValidationError(f'"pedestal_accumulator" ({pa}) not from allowed values {ALLOWED_PEDESTAL_ACCUMULATORS}')
+
 def allowed_run_number(rn, ckrn):
     if rn > ckrn:
         raise ValidationError(f'requested "run_number" {rn:04} not generated by sf-daq')
@@ -1,69 +1,95 @@
 import logging
+import os
+import shutil
 from datetime import datetime
-from random import choice
-from time import time
+from time import sleep, time
 
-import h5py
-import numpy as np
 import pytz
 from data_api3 import h5 as dapi3h5
 
 from sf_daq_broker import config
-from sf_daq_broker.utils import pulse_id_to_timestamp
+from sf_daq_broker.utils import dueto, json_load, json_save, pulse_ids_to_timestamps
+from sf_daq_broker.utils.h5merge import combine_files, concatenate_files
+from sf_daq_broker.utils.pulseids import split_pulse_range
+from sf_daq_broker.utils.request_context import ContextThreadPoolExecutor
+from sf_daq_broker.utils.timestamp_cache import PULSE_PERIOD_NS
+from sf_daq_broker.writer.data_consistency import check_data_consistency
+from sf_daq_broker.writer.endpoint_selector import EndpointSelector
 
 
 _logger = logging.getLogger("broker_writer")
 
 
+# shared by all requests (and segments) of the writer process
+image_buffer_selector = EndpointSelector(config.IMAGE_API_QUERY_ADDRESS)
+
+
 
 def write_from_imagebuffer(data_api_request, output_file, _parameters): #TODO: what is parameters for?
-    buffer_url = choice(config.IMAGE_API_QUERY_ADDRESS)
-    requester = lambda *args: dapi3h5.request(*args, url=buffer_url)
+    buffer_url = config.IMAGE_API_QUERY_ADDRESS
+    requester = lambda query, fname: image_buffer_selector.request(lambda url: dapi3h5.request(query, fname, url=url), size=query_size(query))
     what = "image"
-    write_generic(data_api_request, output_file, buffer_url, requester, what)
+    try:
+        write_generic(data_api_request, output_file, buffer_url, requester, what)
+    finally:
+        _logger.info(f"image buffer endpoint stats: {image_buffer_selector.snapshot()}")
 
 
 def write_from_databuffer_api3(data_api_request, output_file, _parameters):
     buffer_url = config.DATA_API3_QUERY_ADDRESS
     requester = lambda *args: dapi3h5.request(*args, baseurl=buffer_url, default_backend=config.DATA_BACKEND)
     what = "data"
-    write_generic(data_api_request, output_file, buffer_url, requester, what)
+    write_generic(data_api_request, output_file, buffer_url, requester, what, shard_channels=config.DATA_API3_SHARD_CHANNELS)
 
 
-def write_generic(data_api_request, output_file, buffer_url, requester, what):
+def write_generic(data_api_request, output_file, buffer_url, requester, what, shard_channels=None):
     _logger.debug(f"Data API 3 ({what} buffer) request: {data_api_request}")
 
     channels = data_api_request["channels"]
     channels = [channel["name"] for channel in channels]
 
-    pid_range = data_api_request["range"]
-    start_pid = pid_range["startPulseId"]
-    stop_pid  = pid_range["endPulseId"] + 1
+    range_pulse_id = data_api_request["range"]
+    start_pulse_id = range_pulse_id["startPulseId"]
+    stop_pulse_id  = range_pulse_id["endPulseId"]
+
+    # the date range of each segment ends with the timestamp of the pulse ID after it
+    segments = split_pulse_range(start_pulse_id, stop_pulse_id, config.DATA_API3_SEGMENT_PULSES)
+    boundaries = [start for start, _stop in segments] + [stop_pulse_id + 1]
+
+    # an inexact outer boundary would drop the first or add one more pulse, the inner ones are shared by two segments
+    outer_boundaries = [start_pulse_id, stop_pulse_id + 1]
 
     try:
-        start_ts = pulse_id_to_timestamp(start_pid)
-        stop_ts  = pulse_id_to_timestamp(stop_pid)
+        timestamps = pulse_ids_to_timestamps(boundaries, exact=outer_boundaries)
     except RuntimeError:
         _logger.exception("request to Data API 3 to map pulse IDs to timestamps failed")
         raise
 
-    start_ts = tsfmt(start_ts)
-    stop_ts  = tsfmt(stop_ts)
-
-    query = {
-        "channels": channels,
-        "range": {
-            "type": "date",
-            "startDate": start_ts,
-            "endDate": stop_ts
+    timestamps = [tsfmt(ts) for ts in timestamps]
+
+    queries = []
+    for start_ts, stop_ts in zip(timestamps[:-1], timestamps[1:]):
+        query = {
+            "channels": channels,
+            "range": {
+                "type": "date",
+                "startDate": start_ts,
+                "endDate": stop_ts
+            }
         }
-    }
+        queries.append(query)
 
-    _logger.debug(f'requesting "{query}" from {buffer_url} to write to output file {output_file}')
+    download = lambda query, fname: request_channels(requester, query, fname, shard_channels)
 
     try:
         start_time = time()
-        requester(query, output_file)
+        if len(queries) == 1:
+            query = queries[0]
+            _logger.debug(f'requesting "{query}" from {buffer_url} to write to output file {output_file}')
+            download(query, output_file)
+        else:
+            _logger.debug(f"requesting {len(queries)} segments from {buffer_url} to write to output file {output_file}")
+            request_segmented(download, queries, output_file)
         delta_time = time() - start_time
         _logger.info(f"{what} download and writing took {delta_time} seconds")
 
@@ -72,82 +98,127 @@ def write_generic(data_api_request, output_file, buffer_url, requester, what):
         raise
 
     finally:
-        range_pulse_id = data_api_request["range"]
-        start_pulse_id = range_pulse_id["startPulseId"]
-        stop_pulse_id  = range_pulse_id["endPulseId"]
-
         rate_multiplicator = data_api_request.get("rate_multiplicator", 1)
 
         check_data_consistency(start_pulse_id, stop_pulse_id, rate_multiplicator, channels, output_file)
 
 
-def check_data_consistency(start_pulse_id, stop_pulse_id, rate_multiplicator, channels, output_file):
-    _logger.debug(f"data consistency check: {output_file}")
+def request_segmented(download, queries, output_file, n_threads=config.DATA_API3_SEGMENT_THREADS, n_tries=config.DATA_API3_SEGMENT_TRIES):
+    """
+    downloads the segments (one query per time range) concurrently and concatenates them in order into output_file,
+    each finished segment is kept in a folder next to output_file until the end,
+    thus if the same request is repeated after a failure, only the missing segments are downloaded
+    """
+    segment_dir = f"{output_file}.segments"
+    segment_files = [f"{segment_dir}/{i:04}.h5" for i in range(len(queries))]
+    prepare_segment_dir(segment_dir, queries)
+
+    missing = [(query, fname) for query, fname in zip(queries, segment_files) if not os.path.exists(fname)]
+    n_done = len(queries) - len(missing)
+    if n_done:
+        _logger.info(f"resuming download: {n_done} of {len(queries)} segments are present already")
+
+    def download_segment(query, fname):
+        tmp_fname = f"{fname}.part"
+        for i in range(n_tries):
+            count = i + 1
+            try:
+                download(query, tmp_fname)
+                os.replace(tmp_fname, fname)
+                return
+            except Exception as e:
+                _logger.warning(f"download of segment {fname} failed #{count}/{n_tries} {dueto(e)} -- will try again in {count} seconds")
+                sleep(count)
+        msg = f"download of segment {fname} failed {n_tries} times"
+        _logger.error(msg)
+        raise RuntimeError(msg)
+
+    try:
+        with ContextThreadPoolExecutor(max_workers=n_threads) as executor:
+            futures = [executor.submit(download_segment, query, fname) for query, fname in missing]
+            for future in futures:
+                future.result()
+    except Exception:
+        n_present = sum(os.path.exists(fname) for fname in segment_files)
+        _logger.error(f"{n_present} of {len(queries)} segments are kept in {segment_dir} to resume the request if it is repeated -- otherwise, this folder can be removed")
+        raise
 
     start_time = time()
+    concatenate_files(segment_files, output_file)
+    delta_time = time() - start_time
+    _logger.info(f"concatenating {len(queries)} segments took {delta_time} seconds")
 
-    expected_pulse_ids = np.arange(start_pulse_id, stop_pulse_id + 1)
-    expected_pulse_ids = expected_pulse_ids[expected_pulse_ids % rate_multiplicator == 0]
-    n_expected_pulse_ids = len(expected_pulse_ids)
+    shutil.rmtree(segment_dir)
 
-    #TODO: split function
-    #TODO: close h5 file
-    try:
-        data_h5py = h5py.File(output_file)
-        channels_in_file = set(data_h5py.keys())
-        for channel in channels:
-            if channel not in channels_in_file:
-                _logger.error(f"check {channel} not present in file")
-                continue
 
-            raw_pulse_ids = data_h5py[f"/{channel}/pulse_id"][:]
+def prepare_segment_dir(segment_dir, queries):
+    """
+    creates segment_dir, segments of a previous attempt are kept only if that was the same request
+    """
+    request_file = f"{segment_dir}/request.json"
+    if os.path.exists(request_file) and json_load(request_file) != queries:
+        _logger.info(f"removing segments of a different request in {segment_dir}")
+        shutil.rmtree(segment_dir)
 
-            min_raw_pulse_id = min(raw_pulse_ids)
-            if min_raw_pulse_id < start_pulse_id:
-                _logger.error(f"check {channel} contains pulse IDs before the requested range: {min_raw_pulse_id} < {start_pulse_id}")
+    os.makedirs(segment_dir, exist_ok=True)
+    json_save(queries, request_file)
 
-            max_raw_pulse_id = max(raw_pulse_ids)
-            if max_raw_pulse_id > stop_pulse_id:
-                _logger.error(f"check {channel} contains pulse IDs after the requested range: {max_raw_pulse_id} > {stop_pulse_id}")
 
-            n_raw_pulse_ids = len(raw_pulse_ids)
-            n_raw_pulse_ids_unique = len(set(raw_pulse_ids))
+def request_channels(requester, query, output_file, shard_channels):
+    if shard_channels and len(query["channels"]) > shard_channels:
+        request_sharded(requester, query, output_file, shard_channels)
+    else:
+        requester(query, output_file)
 
-            has_duplicates = (n_raw_pulse_ids != n_raw_pulse_ids_unique)
 
-            if has_duplicates:
-                n_duplicates = n_raw_pulse_ids - n_raw_pulse_ids_unique
-                _logger.error(f"check {channel} contains duplicate entries: total {n_raw_pulse_ids}, duplicates {n_duplicates}")
+def request_sharded(requester, query, output_file, shard_channels, n_threads=config.DATA_API3_SHARD_THREADS):
+    """
+    downloads the channels of query in shards of shard_channels channels concurrently into temporary files,
+    which are then combined into output_file
+    """
+    # a channel must not end up in two shards, which could not be combined
+    channels = list(dict.fromkeys(query["channels"]))
+    shards = [channels[i:i + shard_channels] for i in range(0, len(channels), shard_channels)]
+    shard_files = [f"{output_file}.shard{i:03}" for i in range(len(shards))]
 
-            matched_pulse_ids = np.intersect1d(expected_pulse_ids, raw_pulse_ids)
-            n_matched_pulse_ids = len(matched_pulse_ids)
+    _logger.info(f"requesting {len(channels)} channels in {len(shards)} shards")
 
-            if n_matched_pulse_ids != n_expected_pulse_ids:
-                _logger.error(f"check {channel} number of (unique) pulse IDs {n_matched_pulse_ids} differs from requested {n_expected_pulse_ids}")
+    def request_shard(shard, shard_file):
+        shard_query = dict(query, channels=shard)
+        start_time = time()
+        requester(shard_query, shard_file)
+        delta_time = time() - start_time
+        _logger.debug(f"download of {len(shard)} channels to {shard_file} took {delta_time} seconds")
 
-            start_matched_pulse_id = matched_pulse_ids[0] if len(matched_pulse_ids) else None
-            start_expected_pulse_id = expected_pulse_ids[0]
-            if start_matched_pulse_id != start_expected_pulse_id:
-                _logger.error(f"check {channel} start pulse ID {start_matched_pulse_id} differs from requested {start_expected_pulse_id}")
+    try:
+        with ContextThreadPoolExecutor(max_workers=n_threads) as executor:
+            futures = [executor.submit(request_shard, shard, shard_file) for shard, shard_file in zip(shards, shard_files)]
+            for future in futures:
+                future.result()
 
-            stop_matched_pulse_id = matched_pulse_ids[-1] if len(matched_pulse_ids) else None
-            stop_expected_pulse_id = expected_pulse_ids[-1]
-            if stop_matched_pulse_id != stop_expected_pulse_id:
-                _logger.error(f"check {channel} stop pulse ID {stop_matched_pulse_id} differs from requested {stop_expected_pulse_id}")
+        start_time = time()
+        combine_files(shard_files, output_file)
+        delta_time = time() - start_time
+        _logger.info(f"combining {len(shards)} shards took {delta_time} seconds")
 
-            if start_matched_pulse_id == start_expected_pulse_id and stop_matched_pulse_id == stop_expected_pulse_id and not has_duplicates:
-                for mpi, epi in zip(matched_pulse_ids, expected_pulse_ids):
-                    if mpi != epi:
-                        _logger.error(f"check {channel} pulse IDs are not monotonic: {mpi} != {epi}")
-                        break
+    finally:
+        for shard_file in shard_files:
+            if os.path.exists(shard_file):
+                os.remove(shard_file)
 
-    except Exception:
-        _logger.exception("data consistency check failed")
-        raise
 
-    finally:
-        time_delta = time() - start_time
-        _logger.info(f"data consistency check took {time_delta} seconds")
+def query_size(query):
+    """
+    number of pulses times number of channels covered by query (at least 1)
+    """
+    query_range = query["range"]
+    duration = tsparse(query_range["endDate"]) - tsparse(query_range["startDate"])
+    n_pulses = round(duration.total_seconds() * 1e9 / PULSE_PERIOD_NS)
+    return max(1, n_pulses * len(query["channels"]))
+
+
+def tsparse(ts):
+    return datetime.strptime(ts, "%Y-%m-%dT%H:%M:%S.%fZ")
 
 
 def tsfmt(ts):
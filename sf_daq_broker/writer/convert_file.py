@@ -1,16 +1,31 @@
 import logging
 import os
+from time import time
 
 import h5py
 import jungfrau_utils as ju
 import numpy as np
 
+from sf_daq_broker import config
+from sf_daq_broker.detector.frame_selection import DAQ_REC_PPICKER, filter_events, select_frames
 from sf_daq_broker.utils import json_load
+from sf_daq_broker.utils.h5read import align_batch_size, get_layout
+from sf_daq_broker.utils.memory import MEMORY_FRACTION, get_available_memory
+from sf_daq_broker.writer.pedestal import MODULE_NPIXELS
 
 
 _logger = logging.getLogger("broker_writer")
 
 
+# bytes per pixel held in memory per frame of a batch: raw (uint16) + converted (float32) + output, and another output copy for compression
+CONVERSION_NBYTES_RAW = 2
+CONVERSION_NBYTES_CONVERTED = 4
+CONVERSION_BATCH_SIZE_MAX = 1000
+
+# conversions that may run at once in this process, they share the memory budget
+conversion_concurrency = 1
+
+
 
 def convert_file(file_in, file_out, json_run_file, detector_config_file):
     data = json_load(detector_config_file)
@@ -63,6 +78,19 @@ def convert_file(file_in, file_out, json_run_file, detector_config_file):
     if conversion or disabled_modules or save_ppicker_events_only or selected_pulse_ids:
         files_to_remove.add(file_in)
 
+        # convert in batches that fit into the memory budget and consist of complete chunks of the raw file,
+        # ju.File opens the raw file itself, thus, only the chunk layout is used here (not the chunk cache of ChunkedReader)
+        with h5py.File(file_in, "r") as h5f:
+            shape, _dtype, chunks = get_layout(h5f, f"data/{detector_name}/data")
+
+        n_modules = int(np.prod(shape[1:])) // MODULE_NPIXELS
+        n_enabled_modules = max(1, n_modules - len(disabled_modules))
+        frame_nbytes = get_conversion_frame_nbytes(n_enabled_modules, conversion, compression)
+        chunk_frames = chunks[0] if chunks else 1
+        batch_size = get_conversion_batch_size(shape[0], chunk_frames, frame_nbytes)
+
+        _logger.debug(f"raw data chunks: {chunks}, enabled modules: {n_enabled_modules}/{n_modules}, conversion batch size: {batch_size} ({batch_size * frame_nbytes / 1024**2:.0f} MB)")
+
         with ju.File(
             file_in,
             gain_file=gain_file,
@@ -76,32 +104,19 @@ def convert_file(file_in, file_out, json_run_file, detector_config_file):
             parallel=True,
         ) as juf:
             n_input_frames = len(juf["data"])
-            if selected_pulse_ids:
-                good_frames = []
-                is_good_frames = juf["is_good_frame"]
-                det_pulse_ids = juf["pulse_id"]
-                for pulse_index in range(n_input_frames):
-                    if is_good_frames[pulse_index] != 0 and det_pulse_ids[pulse_index][0] in selected_pulse_ids:
-                        good_frames.append(pulse_index)
-            else:
-                good_frames = np.nonzero(juf["is_good_frame"])[0]
+
+            # the per-frame datasets are read at once, the selection is done on the arrays
+            is_good_frame = juf["is_good_frame"][:]
+            det_pulse_ids = juf["pulse_id"][:] if selected_pulse_ids else None
+            good_frames = select_frames(is_good_frame, det_pulse_ids, selected_pulse_ids)
 
 
             if save_ppicker_events_only:
-                good_frames_filtered = []
-                daq_recs = juf["daq_rec"]
-                for pulse_index in good_frames:
-                    daq_rec = daq_recs[pulse_index][0]
-#                    event_fel      = bool((daq_rec>>18) & 1)
-                    event_ppicker  = bool((daq_rec>>19) & 1)
-#                    if event_fel and event_ppicker:
-                    if event_ppicker:
-                        good_frames_filtered.append(pulse_index)
-
-                if not np.array_equal(good_frames, good_frames_filtered):
-                    excluded_indexes = set(good_frames) - set(good_frames_filtered)
-                    excluded_indexes = list(excluded_indexes)
-                    n_excluded_indexes = len(excluded_indexes)
+                daq_recs = juf["daq_rec"][:]
+                good_frames_filtered = filter_events(good_frames, daq_recs, DAQ_REC_PPICKER)
+
+                n_excluded_indexes = len(good_frames) - len(good_frames_filtered)
+                if n_excluded_indexes:
                     good_frames = good_frames_filtered
                 else:
                     n_excluded_indexes = "no"
@@ -112,6 +127,7 @@ def convert_file(file_in, file_out, json_run_file, detector_config_file):
             n_output_frames = len(good_frames)
 
             if n_output_frames:
+                time_start = time()
                 juf.export(
                     file_out,
                     disabled_modules=disabled_modules,
@@ -120,8 +136,9 @@ def convert_file(file_in, file_out, json_run_file, detector_config_file):
                     downsample=downsample,
                     compression=compression,
                     factor=factor,
-                    batch_size=35,
+                    batch_size=batch_size,
                 )
+                log_throughput(time() - time_start, n_output_frames, batch_size, n_enabled_modules * MODULE_NPIXELS * CONVERSION_NBYTES_RAW)
             else:
                 _logger.info("no output frames selected, thus no processed data file produced (raw data file will be kept)")
                 remove_raw_files = False
@@ -159,3 +176,48 @@ def convert_file(file_in, file_out, json_run_file, detector_config_file):
 
 
 
+def get_conversion_frame_nbytes(n_enabled_modules, conversion, compression):
+    """
+    estimated memory used per frame of a batch during the export
+    """
+    nbytes_output = CONVERSION_NBYTES_CONVERTED if conversion else CONVERSION_NBYTES_RAW
+    nbytes_per_pixel = CONVERSION_NBYTES_RAW + nbytes_output
+    if conversion:
+        nbytes_per_pixel += CONVERSION_NBYTES_CONVERTED
+    if compression:
+        nbytes_per_pixel += nbytes_output
+    return n_enabled_modules * MODULE_NPIXELS * nbytes_per_pixel
+
+
+def set_conversion_concurrency(n):
+    global conversion_concurrency
+    conversion_concurrency = max(1, n)
+
+
+def get_conversion_batch_size(n_frames, chunk_frames, frame_nbytes, memory_budget=config.CONVERSION_MEMORY_BUDGET, n_concurrent=None):
+    """
+    the largest batch that fits into this conversion's share of the memory budget (and the available memory),
+    as multiple of the frames per chunk of the raw file, but at least one chunk
+    """
+    if n_concurrent is None:
+        n_concurrent = conversion_concurrency
+
+    available = get_available_memory()
+    if available is not None:
+        memory_budget = min(memory_budget, MEMORY_FRACTION * available)
+
+    memory_budget /= n_concurrent
+
+    batch_size = int(memory_budget // frame_nbytes)
+    batch_size = min(batch_size, CONVERSION_BATCH_SIZE_MAX, n_frames)
+
+    batch_size = align_batch_size(batch_size, chunk_frames)
+    return max(batch_size, chunk_frames)
+
+
+def log_throughput(elapsed, n_frames, batch_size, raw_frame_nbytes):
+    n_batches = -(-n_frames // batch_size)
+    elapsed = max(elapsed, 1e-6)
+    frame_rate = n_frames / elapsed
+    data_rate = n_frames * raw_frame_nbytes / elapsed / 1024**2
+    _logger.info(f"conversion of {n_frames} frames in {n_batches} batches took {elapsed:.1f}s: {elapsed / n_batches:.2f}s per batch, {frame_rate:.1f} frames/s, {data_rate:.1f} MB/s (raw)")
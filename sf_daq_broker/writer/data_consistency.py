@@ -0,0 +1,175 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+import h5py
+import numpy as np
+
+from sf_daq_broker import config
+from sf_daq_broker.utils.h5read import ChunkedReader
+from sf_daq_broker.utils.pulseids import expected_pulse_ids
+
+
+_logger = logging.getLogger("broker_writer")
+
+
+# the pulse IDs of a channel are read in batches of roughly this size
+CHECK_BATCH_NBYTES = 64 * 1024**2
+
+
+
+def check_data_consistency(start_pulse_id, stop_pulse_id, rate_multiplicator, channels, output_file, n_threads=config.DATA_CONSISTENCY_THREADS):
+    """
+    compares the pulse IDs of each channel in output_file to the requested ones, logs the problems,
+    and returns a report per channel (see check_channel)
+    """
+    _logger.debug(f"data consistency check: {output_file}")
+
+    start_time = time()
+
+    expected = expected_pulse_ids(start_pulse_id, stop_pulse_id, rate_multiplicator)
+
+    try:
+        with h5py.File(output_file, "r") as data_h5py:
+            channels_in_file = set(data_h5py.keys())
+            present = [channel for channel in channels if channel in channels_in_file]
+
+            check = lambda channel: check_channel(data_h5py, channel, start_pulse_id, stop_pulse_id, expected)
+            with ThreadPoolExecutor(max_workers=n_threads) as executor:
+                reports = dict(zip(present, executor.map(check, present)))
+
+    except Exception:
+        _logger.exception("data consistency check failed")
+        raise
+
+    finally:
+        time_delta = time() - start_time
+        _logger.info(f"data consistency check took {time_delta} seconds")
+
+    report = {}
+    for channel in channels:
+        if channel in reports:
+            channel_report = reports[channel]
+        else:
+            channel_report = {"present": False}
+        report[channel] = channel_report
+        log_channel_report(channel, channel_report, start_pulse_id, stop_pulse_id, expected)
+
+    n_bad = sum(not is_consistent(channel_report) for channel_report in report.values())
+    _logger.info(f"data consistency check: {len(channels) - n_bad} of {len(channels)} channels are consistent")
+
+    return report
+
+
+def check_channel(h5f, channel, start_pulse_id, stop_pulse_id, expected):
+    """
+    counts how often each expected pulse ID is present (the batches of pulse IDs are matched to the expected ones via searchsorted),
+    the report contains the number of
+    entries, missing and duplicate (expected) pulse IDs, pulse IDs before and after the requested range,
+    unexpected pulse IDs within the range (i.e., not aligned to the rate multiplicator), and decreasing steps between consecutive pulse IDs,
+    as well as the first and last matched pulse ID
+    """
+    n_expected = len(expected)
+    counts = np.zeros(n_expected, dtype=np.int64)
+    unexpected = []
+
+    n_entries = n_before = n_after = n_decreasing = 0
+    min_pulse_id = max_pulse_id = previous = None
+
+    reader = ChunkedReader(h5f, f"/{channel}/pulse_id", batch_nbytes=CHECK_BATCH_NBYTES)
+    for start, stop in reader.batches():
+        pulse_ids = np.asarray(reader[start:stop], dtype=np.int64).ravel()
+        if not len(pulse_ids):
+            continue
+
+        n_entries += len(pulse_ids)
+
+        batch_min = pulse_ids.min()
+        batch_max = pulse_ids.max()
+        min_pulse_id = batch_min if min_pulse_id is None else min(min_pulse_id, batch_min)
+        max_pulse_id = batch_max if max_pulse_id is None else max(max_pulse_id, batch_max)
+
+        # the first step is the one from the last pulse ID of the previous batch
+        first_step = pulse_ids[0] - 1 if previous is None else previous
+        n_decreasing += np.count_nonzero(np.diff(pulse_ids, prepend=first_step) < 0)
+        previous = pulse_ids[-1]
+
+        is_before = (pulse_ids < start_pulse_id)
+        is_after  = (pulse_ids > stop_pulse_id)
+        n_before += np.count_nonzero(is_before)
+        n_after  += np.count_nonzero(is_after)
+
+        inside = pulse_ids[~(is_before | is_after)]
+        if not n_expected:
+            unexpected.append(inside)
+            continue
+
+        index = np.searchsorted(expected, inside)
+        index = np.minimum(index, n_expected - 1)
+        is_expected = (expected[index] == inside)
+        counts += np.bincount(index[is_expected], minlength=n_expected)
+        unexpected.append(inside[~is_expected])
+
+    unexpected = np.concatenate(unexpected) if unexpected else np.empty(0, dtype=np.int64)
+    n_unexpected_unique = len(np.unique(unexpected))
+
+    n_duplicates = int(np.sum(counts[counts > 1] - 1)) + len(unexpected) - n_unexpected_unique
+
+    matched = np.flatnonzero(counts)
+    first_matched = int(expected[matched[0]]) if len(matched) else None
+    last_matched  = int(expected[matched[-1]]) if len(matched) else None
+
+    return {
+        "present": True,
+        "entries": n_entries,
+        "matched": len(matched),
+        "missing": n_expected - len(matched),
+        "duplicates": n_duplicates,
+        "before": n_before,
+        "after": n_after,
+        "unexpected": n_unexpected_unique,
+        "decreasing": n_decreasing,
+        "min_pulse_id": None if min_pulse_id is None else int(min_pulse_id),
+        "max_pulse_id": None if max_pulse_id is None else int(max_pulse_id),
+        "first_matched_pulse_id": first_matched,
+        "last_matched_pulse_id": last_matched
+    }
+
+
+def log_channel_report(channel, report, start_pulse_id, stop_pulse_id, expected):
+    if not report["present"]:
+        _logger.error(f"check {channel} not present in file")
+        return
+
+    if report["before"]:
+        _logger.error(f"check {channel} contains {report['before']} pulse IDs before the requested range: {report['min_pulse_id']} < {start_pulse_id}")
+
+    if report["after"]:
+        _logger.error(f"check {channel} contains {report['after']} pulse IDs after the requested range: {report['max_pulse_id']} > {stop_pulse_id}")
+
+    if report["duplicates"]:
+        _logger.error(f"check {channel} contains duplicate entries: total {report['entries']}, duplicates {report['duplicates']}")
+
+    if report["unexpected"]:
+        _logger.error(f"check {channel} contains {report['unexpected']} pulse IDs within the requested range that do not match the rate multiplicator")
+
+    if report["missing"]:
+        _logger.error(f"check {channel} number of (unique) pulse IDs {report['matched']} differs from requested {len(expected)}: {report['missing']} missing")
+
+    start_expected_pulse_id = int(expected[0]) if len(expected) else None
+    if report["first_matched_pulse_id"] != start_expected_pulse_id:
+        _logger.error(f"check {channel} start pulse ID {report['first_matched_pulse_id']} differs from requested {start_expected_pulse_id}")
+
+    stop_expected_pulse_id = int(expected[-1]) if len(expected) else None
+    if report["last_matched_pulse_id"] != stop_expected_pulse_id:
+        _logger.error(f"check {channel} stop pulse ID {report['last_matched_pulse_id']} differs from requested {stop_expected_pulse_id}")
+
+    if report["decreasing"]:
+        _logger.error(f"check {channel} pulse IDs are not monotonic: {report['decreasing']} decreasing steps")
+
+
+def is_consistent(report):
+    if not report["present"]:
+        return False
+    problems = ("missing", "duplicates", "before", "after", "unexpected", "decreasing")
+    return not any(report[key] for key in problems)
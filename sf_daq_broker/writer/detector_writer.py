@@ -2,18 +2,23 @@ import logging
 import os
 import shutil
 import subprocess
+from contextlib import contextmanager
 from datetime import datetime
+from queue import Queue
 from shutil import copyfile
+from threading import Event, Thread
 from time import sleep, time
 
-import h5py
-import numpy as np
-
-from sf_daq_broker.config import PEDESTAL_FILENAME_TIME_FORMAT, REQUEST_TIME_FORMAT
+from sf_daq_broker.config import CONVERSION_MEMORY_BUDGET, PEDESTAL_FILENAME_TIME_FORMAT, REQUEST_TIME_FORMAT
 from sf_daq_broker.detector.make_crystfel_list import make_crystfel_list
 from sf_daq_broker.detector.store_dap_info import store_dap_info
 from sf_daq_broker.writer.convert_file import convert_file
+from sf_daq_broker.writer.pedestal import MODULE_NPIXELS, can_read_file, create_pedestal_file
 from sf_daq_broker.utils import json_save, json_load, parse_det_name
+from sf_daq_broker.utils.h5merge import merge_files
+from sf_daq_broker.utils.memory import MEMORY_FRACTION, Reservations, get_available_memory
+from sf_daq_broker.utils.pulseids import split_pulse_range
+from sf_daq_broker.utils.request_context import run_in_context
 
 
 _logger = logging.getLogger("broker_writer")
@@ -40,9 +45,22 @@ MASK_DIRECTORY = "/sf/jungfrau/config/pixel_mask"
 TMP_DIRECTORY = "/gpfs/photonics/swissfel/daqtmp"
 TMP_SPACE_THRESH = 1e12 # 1TB
 
+# datasets of the converted files with one entry per frame (see merge_files), the first one gives the number of frames
+FRAME_DATASETS = ["pulse_id", "data", "frame_index", "daq_rec", "is_good_frame"]
+
+# raw files that are converted and removed afterwards are written to memory if they fit
+SHM_DIRECTORY = "/dev/shm"
+SHM_FILE_PREFIX = "sf_daq_broker."
+
+# the space in SHM_DIRECTORY is reserved before the raw files are written, since several retrievals run at once
+shm_reservations = Reservations()
 
 
-def detector_retrieve(request, output_file_detector):
+
+def detector_retrieve(request, output_file_detector, on_retrieved=None, raw_file_plan=None):
+    """
+    raw_file_plan is (use_tmp, use_shm, raw_file_nbytes) as returned by plan_raw_file, which is called if it is not given
+    """
     detector_name      = request["detector_name"]
     det_start_pulse_id = request["det_start_pulse_id"]
     det_stop_pulse_id  = request["det_stop_pulse_id"]
@@ -53,36 +71,18 @@ def detector_retrieve(request, output_file_detector):
 
     beamline           = request.get("beamline", None)
     pgroup             = request.get("pgroup", None)
-    directory_name     = request.get("directory_name", None)
-    selected_pulse_ids = request.get("selected_pulse_ids", [])
 
     detector_params = request["detectors"][detector_name]
 
-    adc_to_energy            = detector_params.get("adc_to_energy", False)
-    compression              = detector_params.get("compression", False)
-    disabled_modules         = detector_params.get("disabled_modules", [])
-    roi                      = detector_params.get("roi", {})
-    save_dap_results         = detector_params.get("save_dap_results", False)
-    save_ppicker_events_only = detector_params.get("save_ppicker_events_only", False)
+    save_dap_results = detector_params.get("save_dap_results", False)
 
-    # use SSD tmp storage only if raw files are removed
-    use_tmp = detector_params.get("remove_raw_files", False)
+    pedestal_run = is_pedestal_run(request)
+    convert_ju_file = needs_conversion(request)
+    segment_frames = get_segment_frames(request)
 
-    # get free space in SSD tmp storage, if smaller than threshold do not use it
-    _tmp_space_total, _tmp_space_used, tmp_space_free = shutil.disk_usage(TMP_DIRECTORY)
-    if tmp_space_free < TMP_SPACE_THRESH:
-        use_tmp = False
-
-    pedestal_run = (directory_name == "JF_pedestals")
-
-    convert_ju_file = any((
-        adc_to_energy,
-        compression,
-        disabled_modules,
-        roi,
-        save_ppicker_events_only,
-        selected_pulse_ids
-    ))
+    if raw_file_plan is None:
+        raw_file_plan = plan_raw_file(request)
+    use_tmp, use_shm, raw_file_nbytes = raw_file_plan
 
     if convert_ju_file:
         detector_filename = os.path.basename(output_file_detector)
@@ -92,11 +92,122 @@ def detector_retrieve(request, output_file_detector):
             # flatten folder structure so that there are no empty folders after removal
             flat_raw_file_name = raw_file_name.replace("/", "_")
             raw_file_name = f"{TMP_DIRECTORY}/{flat_raw_file_name}"
-        raw_dir = os.path.dirname(raw_file_name)
-        os.makedirs(raw_dir, exist_ok=True)
     else:
         raw_file_name = output_file_detector
 
+    # entered right away, since it releases the memory reserved by plan_raw_file
+    with stage_in_memory(raw_file_name, use_shm, raw_file_nbytes) as staged_raw_file_name:
+        if convert_ju_file:
+            raw_dir = os.path.dirname(raw_file_name)
+            os.makedirs(raw_dir, exist_ok=True)
+
+        raw_file_name = staged_raw_file_name
+        detector_config_file = get_detector_config_file(detector_name)
+
+        if segment_frames:
+            retrieve_and_convert_in_segments(detector_name, raw_file_name, output_file_detector, run_file_json, detector_config_file, det_start_pulse_id, det_stop_pulse_id, rate_multiplicator, segment_frames, on_retrieved)
+        else:
+            retrieve_from_buffer(detector_name, raw_file_name, det_start_pulse_id, det_stop_pulse_id, rate_multiplicator)
+            if on_retrieved is not None:
+                on_retrieved()
+
+        # the pedestal may have been computed already while it was taken (see PedestalStream)
+        pedestal_ready = request.get("pedestal_ready", False)
+
+        if pedestal_run and pedestal_ready:
+            _logger.info(f"pedestal of {detector_name} was already computed during acquisition, skipping pedestal creation")
+
+        if pedestal_run and not pedestal_ready:
+            sleep(5)
+
+            add_pixel_mask, specific_kwargs = get_pedestal_options(detector_name)
+            pedestal_workers = request.get("pedestal_workers", 1)
+            pedestal_accumulator = request.get("pedestal_accumulator", "float64")
+            time_start = time()
+            create_pedestal_file(filename=raw_file_name, directory=os.path.dirname(raw_file_name), add_pixel_mask=add_pixel_mask, n_workers=pedestal_workers, accumulator=pedestal_accumulator, **specific_kwargs)
+            delta_time = time() - time_start
+            _logger.info(f"pedestal creation took {delta_time} seconds")
+
+            request_time = request["request_time"]
+            res_file_name = raw_file_name[:-3] + ".res.h5"
+            publish_pedestal(request_time, res_file_name, detector_name, add_pixel_mask)
+
+
+        if convert_ju_file:
+            if not segment_frames:
+                convert_detector_file(raw_file_name, output_file_detector, run_file_json, detector_config_file)
+
+            crystfel_lists_laser = detector_params.get("crystfel_lists_laser", False)
+            if crystfel_lists_laser:
+                make_crystfel_list(output_file_detector, run_file_json, detector_name)
+
+
+    if save_dap_results and not pedestal_run:
+        file_name_out = output_file_detector[:-3] + ".dap"
+        store_dap_info(beamline, pgroup, detector_name, det_start_pulse_id, det_stop_pulse_id, file_name_out)
+
+
+
+def plan_raw_file(request):
+    """
+    where detector_retrieve writes the raw file, returns (use_tmp, use_shm, raw_file_nbytes):
+    to SSD tmp storage, staged in memory (the raw_file_nbytes are then reserved, stage_in_memory releases them),
+    or else next to the output file
+    """
+    detector_name = request["detector_name"]
+    detector_params = request["detectors"][detector_name]
+
+    convert_ju_file = needs_conversion(request)
+    remove_raw_files = detector_params.get("remove_raw_files", False)
+
+    # use SSD tmp storage only if raw files are removed
+    use_tmp = convert_ju_file and remove_raw_files
+
+    # get free space in SSD tmp storage, if smaller than threshold do not use it
+    if use_tmp:
+        _tmp_space_total, _tmp_space_used, tmp_space_free = shutil.disk_usage(TMP_DIRECTORY)
+        if tmp_space_free < TMP_SPACE_THRESH:
+            use_tmp = False
+
+    # the raw file is only read once by the conversion, thus, if it is removed afterwards, it does not need to go through the file system
+    use_shm = convert_ju_file and remove_raw_files and not is_pedestal_run(request) and not get_segment_frames(request)
+    raw_file_nbytes = 0
+    if use_shm:
+        raw_file_nbytes = estimate_raw_file_nbytes(detector_name, request["det_start_pulse_id"], request["det_stop_pulse_id"], request["rate_multiplicator"])
+        use_shm = shm_reservations.reserve(raw_file_nbytes, fits_in_memory)
+        if not use_shm:
+            raw_file_nbytes = 0
+
+    return use_tmp, use_shm, raw_file_nbytes
+
+
+def needs_conversion(request):
+    detector_params = request["detectors"][request["detector_name"]]
+    return any((
+        detector_params.get("adc_to_energy", False),
+        detector_params.get("compression", False),
+        detector_params.get("disabled_modules", []),
+        detector_params.get("roi", {}),
+        detector_params.get("save_ppicker_events_only", False),
+        request.get("selected_pulse_ids", [])
+    ))
+
+
+def is_pedestal_run(request):
+    return request.get("directory_name", None) == "JF_pedestals"
+
+
+def get_segment_frames(request):
+    """
+    retrieve and convert in segments of this many frames (None: at once), which overlaps retrieval and conversion
+    """
+    if not needs_conversion(request) or is_pedestal_run(request):
+        return None
+    detector_params = request["detectors"][request["detector_name"]]
+    return detector_params.get("segment_frames", None)
+
+
+def retrieve_from_buffer(detector_name, raw_file_name, det_start_pulse_id, det_stop_pulse_id, rate_multiplicator):
     number_modules = parse_det_name(detector_name).T
 
     command_retrieve_from_buffer = (
@@ -120,261 +231,219 @@ def detector_retrieve(request, output_file_detector):
 
     _logger.info(f"detector retrieval from buffer took {delta_time} seconds")
 
-    detector_config_file = f"/gpfs/photonics/swissfel/buffer/config/{detector_name}.json"
 
+def convert_detector_file(raw_file_name, output_file_detector, run_file_json, detector_config_file):
+    output_dir = os.path.dirname(output_file_detector)
+    os.makedirs(output_dir, exist_ok=True)
 
-    if pedestal_run:
-        sleep(5)
+    _logger.info(f"performing file conversion: {raw_file_name}, {output_file_detector}, {run_file_json}, {detector_config_file}")
 
-        add_pixel_mask = f"{MASK_DIRECTORY}/{detector_name}/pixel_mask.h5"
-        if not can_read_file(add_pixel_mask):
-            add_pixel_mask = None
+    time_start = time()
 
-        specific_kwargs = PEDESTAL_SPECIFIC.get(detector_name, {})
-        time_start = time()
-        create_pedestal_file(filename=raw_file_name, directory=os.path.dirname(raw_file_name), add_pixel_mask=add_pixel_mask, **specific_kwargs)
+    try:
+        convert_file(raw_file_name, output_file_detector, run_file_json, detector_config_file)
+    except Exception:
+        _logger.exception("file conversion failed")
+        raise
+    finally:
         delta_time = time() - time_start
-        _logger.info(f"pedestal creation took {delta_time} seconds")
+        _logger.info(f"file conversion took {delta_time} seconds")
+
 
-        request_time = request["request_time"]
-        res_file_name = raw_file_name[:-3] + ".res.h5"
-        #TODO: does this make sense? copy_pedestal_file only actively raises if detector_config_file does not exist. copy_calibration_files does not even check but would fail as well.
+def retrieve_and_convert_in_segments(detector_name, raw_file_name, output_file_detector, run_file_json, detector_config_file, det_start_pulse_id, det_stop_pulse_id, rate_multiplicator, segment_frames, on_retrieved=None):
+    """
+    segment k+1 is retrieved from the buffer while segment k is converted,
+    the converted segments are kept in a folder next to output_file_detector, which combines them via virtual datasets
+    """
+    segments = split_pulse_range(det_start_pulse_id, det_stop_pulse_id, segment_frames * rate_multiplicator, rate_multiplicator)
+    segment_dir = output_file_detector[:-3] + ".segments"
+    os.makedirs(segment_dir, exist_ok=True)
+
+    _logger.info(f"retrieval and conversion of {detector_name} in {len(segments)} segments of {segment_frames} frames")
+
+    # at most one retrieved segment waits for its conversion
+    retrieved = Queue(maxsize=1)
+    stopped = Event()
+    thread = Thread(target=run_in_context(retrieve_segments), args=(detector_name, raw_file_name, segments, rate_multiplicator, retrieved, stopped, on_retrieved), daemon=True)
+
+    time_start = time()
+    thread.start()
+
+    converted = []
+    retrieval_done = False
+    try:
+        while (item := retrieved.get()) is not None:
+            if isinstance(item, Exception):
+                retrieval_done = True
+                msg = f"detector retrieval from buffer failed for {detector_name}"
+                _logger.error(msg)
+                raise RuntimeError(msg) from item
+
+            i, raw_segment_file_name = item
+            segment_file_name = f"{segment_dir}/{i:04}.h5"
+            convert_detector_file(raw_segment_file_name, segment_file_name, run_file_json, detector_config_file)
+            # no file is written if no frame of the segment was selected
+            if os.path.exists(segment_file_name):
+                converted.append(segment_file_name)
+    except Exception:
+        stopped.set()
+        if not retrieval_done:
+            drain_segments(retrieved)
+        raise
+    finally:
+        thread.join()
+
+    if not converted:
+        _logger.info(f"no output frames selected in any segment, thus no processed data file produced for {detector_name}")
+        return
+
+    frame_datasets = [f"data/{detector_name}/{name}" for name in FRAME_DATASETS]
+    n_frames = merge_files(converted, output_file_detector, frame_datasets)
+
+    delta_time = time() - time_start
+    _logger.info(f"retrieval and conversion of {n_frames} frames in {len(segments)} segments took {delta_time} seconds")
+
+
+def retrieve_segments(detector_name, raw_file_name, segments, rate_multiplicator, retrieved, stopped, on_retrieved=None):
+    """
+    puts (index, file name) of the retrieved segments into the queue, followed by None (or the exception),
+    on_retrieved is called once all segments are retrieved
+    """
+    try:
+        for i, (start_pulse_id, stop_pulse_id) in enumerate(segments):
+            if stopped.is_set():
+                break
+            raw_segment_file_name = f"{raw_file_name[:-3]}.{i:04}.h5"
+            retrieve_from_buffer(detector_name, raw_segment_file_name, start_pulse_id, stop_pulse_id, rate_multiplicator)
+            retrieved.put((i, raw_segment_file_name))
+    except Exception as e:
+        _logger.exception(f"detector retrieval from buffer failed for {detector_name}")
+        retrieved.put(e)
+    else:
+        if on_retrieved is not None and not stopped.is_set():
+            on_retrieved()
+        retrieved.put(None)
+
+
+def drain_segments(retrieved):
+    """
+    waits for the retrieval to stop and removes the raw segments that were not converted
+    """
+    while True:
+        item = retrieved.get()
+        if item is None or isinstance(item, Exception):
+            break
+        _i, raw_segment_file_name = item
+        if os.path.exists(raw_segment_file_name):
+            os.remove(raw_segment_file_name)
+
+
+def estimate_raw_file_nbytes(detector_name, det_start_pulse_id, det_stop_pulse_id, rate_multiplicator):
+    number_modules = parse_det_name(detector_name).T
+    n_frames = (det_stop_pulse_id - det_start_pulse_id) // rate_multiplicator + 1
+    return n_frames * number_modules * MODULE_NPIXELS * 2 # uint16
+
+
+def fits_in_memory(nbytes):
+    """
+    whether files of size nbytes (in total) fit into SHM_DIRECTORY, keeping enough memory for the conversion,
+    the free space does not include the files written so far, hence, this is conservative
+    """
+    if not os.path.isdir(SHM_DIRECTORY):
+        return False
+
+    _shm_space_total, _shm_space_used, shm_space_free = shutil.disk_usage(SHM_DIRECTORY)
+    available = get_available_memory()
+    if available is None:
+        return False
+
+    return nbytes < shm_space_free and nbytes + CONVERSION_MEMORY_BUDGET < MEMORY_FRACTION * available
+
+
+@contextmanager
+def stage_in_memory(raw_file_name, enabled=True, reserved_nbytes=0):
+    """
+    yields the file name to be used for the raw file: if enabled, a file in SHM_DIRECTORY,
+    which is moved to raw_file_name in the end if it was not removed (e.g., conversion failed or no frames were selected),
+    and the reserved_nbytes are released
+    """
+    if not enabled:
+        yield raw_file_name
+        return
+
+    flat_raw_file_name = raw_file_name.replace("/", "_")
+    # the pid allows to tell the staged files of running processes from stale ones (see remove_stale_staged_files)
+    shm_file_name = f"{SHM_DIRECTORY}/{SHM_FILE_PREFIX}{os.getpid()}.{flat_raw_file_name}"
+    _logger.info(f"raw data file is staged in memory: {shm_file_name}")
+
+    try:
+        yield shm_file_name
+    finally:
         try:
-            copy_pedestal_file(request_time, res_file_name, detector_name, detector_config_file)
+            if os.path.exists(shm_file_name):
+                _logger.info(f"moving raw data file from memory to {raw_file_name}")
+                shutil.move(shm_file_name, raw_file_name)
         finally:
-            copy_calibration_files(res_file_name, add_pixel_mask, detector_config_file)
+            shm_reservations.release(reserved_nbytes)
 
 
-    if convert_ju_file:
-        output_dir = os.path.dirname(output_file_detector)
-        os.makedirs(output_dir, exist_ok=True)
+def remove_stale_staged_files(directory=SHM_DIRECTORY):
+    """
+    removes the raw files staged in memory by processes that are not running anymore (e.g., killed during a retrieval),
+    the requests are redelivered by the broker anyway
+    """
+    if not os.path.isdir(directory):
+        return
 
-        _logger.info(f"performing file conversion: {raw_file_name}, {output_file_detector}, {run_file_json}, {detector_config_file}")
+    for fname in os.listdir(directory):
+        if not fname.startswith(SHM_FILE_PREFIX):
+            continue
 
-        time_start = time()
+        pid = fname[len(SHM_FILE_PREFIX):].split(".", 1)[0]
+        if not pid.isdigit() or is_running(int(pid)):
+            continue
 
+        stale_file_name = f"{directory}/{fname}"
+        _logger.warning(f"removing stale raw data file staged in memory: {stale_file_name}")
         try:
-            convert_file(raw_file_name, output_file_detector, run_file_json, detector_config_file)
-        except Exception:
-            _logger.exception("file conversion failed")
-            raise
-        finally:
-            delta_time = time() - time_start
-            _logger.info(f"file conversion took {delta_time} seconds")
+            os.remove(stale_file_name)
+        except OSError:
+            _logger.exception(f"cannot remove {stale_file_name}")
 
 
-        crystfel_lists_laser = detector_params.get("crystfel_lists_laser", False)
-        if crystfel_lists_laser:
-            make_crystfel_list(output_file_detector, run_file_json, detector_name)
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass # running, but owned by another user
+    return True
 
 
-    if save_dap_results and not pedestal_run:
-        file_name_out = output_file_detector[:-3] + ".dap"
-        store_dap_info(beamline, pgroup, detector_name, det_start_pulse_id, det_stop_pulse_id, file_name_out)
+def get_detector_config_file(detector_name):
+    return f"/gpfs/photonics/swissfel/buffer/config/{detector_name}.json"
+
 
+def get_pedestal_options(detector_name):
+    """
+    returns the additional pixel mask file (or None) and the detector-specific arguments for the pedestal calculation
+    """
+    add_pixel_mask = f"{MASK_DIRECTORY}/{detector_name}/pixel_mask.h5"
+    if not can_read_file(add_pixel_mask):
+        add_pixel_mask = None
 
+    specific_kwargs = PEDESTAL_SPECIFIC.get(detector_name, {})
+    return add_pixel_mask, specific_kwargs
 
-def create_pedestal_file(
-    filename="pedestal.h5",
-    directory="./",
-    add_pixel_mask=None,
-    X_test_pixel=0,
-    Y_test_pixel=0,
-    frames_average=1000,
-    gain_check=True,
-    number_bad_modules=0
-):
-    if not can_read_file(filename):
-        msg = f"cannot create pedestal file: input file {filename} not found"
-        _logger.info(msg)
-        raise RuntimeError(msg)
 
-    with h5py.File(filename, "r") as h5f:
-        detector_name = h5f["general/detector_name"][()]
-        detector_name = detector_name.decode("UTF-8")
-
-        data_location          = f"data/{detector_name}/data"
-        daq_recs_location      = f"data/{detector_name}/daq_rec"
-        is_good_frame_location = f"data/{detector_name}/is_good_frame"
-
-        # for larger detectors and pedestalmode=True, data may be too large to be loaded at once
-        #TODO: for better read performance:
-        # - investigate chunking
-        # - check memory needed vs. available and only if possible load at once
-        f_data          = h5f[data_location]
-        f_is_good_frame = h5f[is_good_frame_location][:]
-        f_daq_recs      = h5f[daq_recs_location][:]
-
-        f_data0 = f_data[0]
-
-        sh_y, sh_x = f_data0.shape
-        nModules = (sh_x * sh_y) // (1024 * 512)
-        if (nModules * 1024 * 512) != (sh_x * sh_y):
-            msg = f"{detector_name}: shape mismatch: Jungfrau modules have shape 1024x512, while data has shape {sh_x}x{sh_y}"
-            _logger.error(msg)
-            raise RuntimeError(msg)
-
-        tX = X_test_pixel
-        tY = Y_test_pixel
-        if tX < 0 or tX > (sh_x - 1):
-            tX = 0
-        if tY < 0 or tY > (sh_y - 1):
-            tY = 0
-
-        _logger.debug(f"{detector_name}: test pixel is at (x, y): ({tX}, {tY})")
-
-        numberOfFrames = len(f_data)
-        _logger.info(f"{detector_name}: pedestal file {filename} contains {numberOfFrames + 1} frames")
-
-        data_shape = f_data0.shape
-        data_dtype = f_data0.dtype
-        _logger.debug(f"{detector_name}: data has shape: {data_shape}, type: {data_dtype}, {nModules} modules ({number_bad_modules} bad modules)")
-
-        pixelMask = np.zeros((sh_y, sh_x), dtype=int)
-
-        adcValuesN  = np.zeros((4, sh_y, sh_x))
-        adcValuesNN = np.zeros((4, sh_y, sh_x))
-
-        nMgain = [0] * 4
-
-        gainCheck = -1
-        highG0Check = 0
-        printFalseGain = False
-        nGoodFrames = 0
-        nGoodFramesGain = 0
-
-        for n in range(numberOfFrames):
-
-            if not f_is_good_frame[n]:
-                continue
-
-            nGoodFrames += 1
-
-            image = f_data[n]
-            frameData = (image & 0b0011111111111111)
-            gainData  = (image & 0b1100000000000000) >> 14
-
-            daq_rec = f_daq_recs[n][0]
-            trueGain = (daq_rec & 0b11000000000000) >> 12
-            highG0 = (daq_rec & 0b1)
-
-            gainGoodAllModules = True
-            if gain_check:
-                daq_recs = f_daq_recs[n]
-                for dr in daq_recs:
-                    trueGain_found = (dr & 0b11000000000000) >> 12
-                    highG0_found = (dr & 0b1)
-                    if trueGain != trueGain_found or highG0 != highG0_found:
-                        gainGoodAllModules = False
-
-            if not gainGoodAllModules:
-                trueGain_found = (daq_recs & 0b11000000000000) >> 12
-                highG0_found = (daq_recs & 0b1)
-                _logger.debug(f"{detector_name}: skipping frame {n}: mismatch between modules and general settings: gain: {trueGain} vs {trueGain_found}, highG0: {highG0} vs {highG0_found}")
-                continue
-
-#            if highG0 == 1 and trueGain != 0:
-#                gainGoodAllModules = False
-#                _logger.info(f"{detector_name}: skipping frame {n}: Jungfrau is in high G0 mode ({highG0}), but gain setting is: {trueGain}")
-#                continue
-
-            correct_gain = (gainData == trueGain)
-            nFramesGain = np.sum(correct_gain)
-            # make sure that most of the modules are in correct gain
-            if nFramesGain < (nModules - 0.5 - number_bad_modules) * (1024 * 512):
-                gainGoodAllModules = False
-                gain0 = np.sum(gainData == 0)
-                gain1 = np.sum(gainData == 1)
-                gain2 = np.sum(gainData == 3)
-                gain_undefined = np.sum(gainData == 2)
-                _logger.debug(f"{detector_name}: skipping frame {n}: too many bad pixels (true gain: {trueGain} ({nFramesGain}), highG0: {highG0}, gain0: {gain0}, gain1: {gain1}, gain2: {gain2}, undefined gain: {gain_undefined})")
-                continue
-
-            nGoodFramesGain += 1
-
-            gainData_tXtY = gainData[tY][tX]
-
-            if gainData_tXtY != trueGain:
-                if not printFalseGain:
-                    _logger.info(f"{detector_name}: frame {n}: wrong gain for test pixel ({tX}, {tY}): expected {trueGain} but found {gainData_tXtY}")
-                    printFalseGain = True
-            else:
-                if gainCheck != -1 and printFalseGain:
-                    _logger.info(f"{detector_name}: frame {n}: wrong gain for test pixel ({tX}, {tY}) in previous frame, but correct in this frame {gainData[tY, tX]}")
-                printFalseGain = False
-
-            if gainCheck != gainData_tXtY or highG0Check != highG0:
-                _logger.info(f"{detector_name}: frame {n}: gain changed for test pixel ({tX}, {tY}): {gainCheck} -> {gainData_tXtY} (highG0: {highG0Check} -> {highG0}), match: {gainData_tXtY == trueGain}")
-                gainCheck = gainData_tXtY
-                highG0Check = highG0
-
-            if gainGoodAllModules:
-                pixelMask[~correct_gain] |= (1 << (1 + trueGain + 4 * highG0)) # skip additional_pixel_mask
-                #trueGain += 4 * highG0
-                nMgain[trueGain] += 1
-
-                if nMgain[trueGain] > frames_average:
-                    adcValuesN[trueGain]  -= adcValuesN[trueGain]  / frames_average
-                    adcValuesNN[trueGain] -= adcValuesNN[trueGain] / frames_average
-
-                adcValuesN[trueGain]  += frameData
-                adcValuesNN[trueGain] += np.square(frameData, dtype=np.uint32) # frameData is uint16, the largest uint16 squared fits into uint32
-
-
-        _logger.info(f"{detector_name}: {numberOfFrames} frames analyzed, {nGoodFrames} good frames, {nGoodFramesGain} frames without settings mismatch; gain frames distribution (0, 1, 2, 3): {tuple(nMgain)}")
-
-        if add_pixel_mask is not None:
-            if can_read_file(add_pixel_mask):
-                with h5py.File(add_pixel_mask, "r") as additional_pixel_mask_file:
-                    additional_pixel_mask = additional_pixel_mask_file["pixel_mask"][:]
-                nmasked = np.sum(additional_pixel_mask)
-                _logger.info(f"{detector_name}: adding additional pixel mask from file {add_pixel_mask}, number of additionally masked pixels: {nmasked}")
-                if additional_pixel_mask.shape == pixelMask.shape:
-                    additional_pixel_mask = additional_pixel_mask.astype(bool)
-                    pixelMask[additional_pixel_mask] |= (1 << 0)
-                else:
-                    _logger.error(f"{detector_name}: shape of additional pixel mask ({additional_pixel_mask.shape}) does not match current pixel mask ({pixelMask.shape})")
-            else:
-                _logger.error(f"{detector_name}: specified file with additional pixel mask {add_pixel_mask} not found or not readable")
-
-        fileNameIn = os.path.splitext(os.path.basename(filename))[0]
-        full_fileNameOut = directory + "/" + fileNameIn + ".res.h5"
-        _logger.info(f"{detector_name}: output file with pedestal corrections: {full_fileNameOut}")
-
-        gains    = []
-        gainsRMS = []
-
-        for gain in range(4):
-            numberFramesAverage = max(1, min(frames_average, nMgain[gain]))
-            mean  = adcValuesN[gain]  / numberFramesAverage
-            mean2 = adcValuesNN[gain] / numberFramesAverage
-            variance = mean2 - mean**2
-            stdDeviation = np.sqrt(variance)
-            _logger.debug(f"{detector_name}: results for gain {gain}: test pixel ({tY}, {tX}), mean: {mean[tY][tX]}, stddev: {stdDeviation[tY][tX]}")
-
-            # gain 2 is unused
-            if gain == 2:
-                continue
-
-            gains.append(mean)
-            gainsRMS.append(stdDeviation)
-
-            pixelMask[np.isclose(stdDeviation, 0)] |= (1 << (9 + gain)) # skip additional_pixel_mask and 4*2 wrong gain
-
-        with h5py.File(full_fileNameOut, "w") as outFile:
-            outFile.create_dataset("pixel_mask", data=pixelMask)
-            outFile.create_dataset("gains",      data=gains)
-            outFile.create_dataset("gainsRMS",   data=gainsRMS)
-
-        ngood = np.sum(pixelMask == 0)
-        ntotal = sh_x * sh_y
-        nbad = ntotal - ngood
-        _logger.info(f"{detector_name}: number of good pixels: {ngood} from {ntotal} in total ({nbad} bad pixels)")
-
-        if ngood == 0:
-            msg = f"pedestal file: output file {full_fileNameOut} contains no good pixel"
-            _logger.error(msg)
-            raise RuntimeError(msg)
+def publish_pedestal(request_time, res_file_name, detector_name, add_pixel_mask):
+    detector_config_file = get_detector_config_file(detector_name)
+    #TODO: does this make sense? copy_pedestal_file only actively raises if detector_config_file does not exist. copy_calibration_files does not even check but would fail as well.
+    try:
+        copy_pedestal_file(request_time, res_file_name, detector_name, detector_config_file)
+    finally:
+        copy_calibration_files(res_file_name, add_pixel_mask, detector_config_file)
 
 
 
@@ -430,10 +499,3 @@ def copy_calibration_files(pedestal_file, pixel_mask_file, detector_config_file)
         if not os.path.exists(pixel_mask_file_copy):
             copyfile(pixel_mask_file, pixel_mask_file_copy)
 
-
-
-def can_read_file(fname):
-    return os.path.isfile(fname) and os.access(fname, os.R_OK)
-
-
-
@@ -0,0 +1,120 @@
+import logging
+from threading import Lock
+from time import time
+
+from sf_daq_broker import config
+from sf_daq_broker.utils import dueto
+
+
+_logger = logging.getLogger("broker_writer")
+
+
+
+class EndpointSelector:
+    """
+    routes requests to the least-loaded healthy one of several equivalent addresses:
+    the load of an address is its number of requests in flight weighted by its (smoothed) latency per unit of request size,
+    only successful requests update the latency,
+    an address that failed is avoided for cooldown seconds, a failed request is repeated on the next address
+    """
+
+    def __init__(self, addresses, cooldown=config.IMAGE_API_FAILURE_COOLDOWN, smoothing=config.IMAGE_API_LATENCY_SMOOTHING):
+        self.cooldown = cooldown
+        self.smoothing = smoothing
+        self.lock = Lock()
+        self.stats = {address: EndpointStats() for address in addresses}
+
+
+    def request(self, func, size=1):
+        """
+        calls func(address) with the best address, and with the next best one(s) if it fails,
+        size (e.g., the number of pulses) normalizes the latency, so that large and small requests can be compared
+        """
+        tried = set()
+        while True:
+            address = self.acquire(exclude=tried)
+            tried.add(address)
+
+            start_time = time()
+            try:
+                res = func(address)
+            except Exception as e:
+                self.release(address, failed=True)
+                if len(tried) == len(self.stats):
+                    raise
+                _logger.warning(f"request to {address} failed {dueto(e)} -- will try another address")
+                continue
+
+            self.release(address, (time() - start_time) / size)
+            _logger.debug(f"request to {address} succeeded, endpoint stats: {self.snapshot()}")
+            return res
+
+
+    def acquire(self, exclude=()):
+        now = time()
+        with self.lock:
+            candidates = [(address, stats) for address, stats in self.stats.items() if address not in exclude]
+            healthy = [(address, stats) for address, stats in candidates if stats.down_until <= now]
+            # if all are down, the one that is down for the shortest time is used
+            if healthy:
+                address, stats = min(healthy, key=lambda item: item[1].load())
+            else:
+                address, stats = min(candidates, key=lambda item: item[1].down_until)
+            stats.in_flight += 1
+            return address
+
+
+    def release(self, address, latency=None, failed=False):
+        """
+        a failed request does not update the latency, it might have failed fast or timed out
+        """
+        with self.lock:
+            stats = self.stats[address]
+            stats.in_flight -= 1
+            stats.n_requests += 1
+            if failed:
+                stats.n_failures += 1
+                stats.down_until = time() + self.cooldown
+            else:
+                stats.add_latency(latency, self.smoothing)
+                stats.down_until = 0
+
+
+    def snapshot(self):
+        now = time()
+        with self.lock:
+            return {address: stats.to_dict(now) for address, stats in self.stats.items()}
+
+
+
+class EndpointStats:
+
+    def __init__(self):
+        self.in_flight = 0
+        self.n_requests = 0
+        self.n_failures = 0
+        self.latency = None
+        self.down_until = 0
+
+
+    def load(self):
+        # addresses without a measured latency are preferred, to get one
+        latency = self.latency or 0
+        return (self.in_flight + 1) * latency, self.in_flight
+
+
+    def add_latency(self, latency, smoothing):
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += smoothing * (latency - self.latency)
+
+
+    def to_dict(self, now):
+        return {
+            "in_flight": self.in_flight,
+            "requests": self.n_requests,
+            "failures": self.n_failures,
+            "latency": self.latency,
+            "healthy": self.down_until <= now
+        }
@@ -0,0 +1,895 @@
+import logging
+import multiprocessing
+import os
+
+import h5py
+import numpy as np
+
+from sf_daq_broker.utils import dueto, excfmt
+from sf_daq_broker.utils.h5read import ChunkedReader
+from sf_daq_broker.utils.memory import MEMORY_FRACTION, get_available_memory
+
+
+_logger = logging.getLogger("broker_writer")
+
+
+MODULE_NPIXELS = 1024 * 512
+N_GAINS = 4
+
+# gain 2 is unused, only the other gains are accumulated and written
+GAIN_SLOTS = (0, 1, 3)
+
+# the pixel mask uses bits 0 to 12, it is written as int64 for compatibility
+MASK_DTYPE = np.uint16
+
+# bits in daq_rec that encode the gain settings
+DAQ_REC_GAIN   = 0b11000000000000
+DAQ_REC_HIGHG0 = 0b1
+
+# per pixel and frame in a block: raw value (uint16) and correct gain flag (bool)
+BATCH_NBYTES_PER_PIXEL = 3
+
+
+
+def create_pedestal_file(
+    filename="pedestal.h5",
+    directory="./",
+    add_pixel_mask=None,
+    X_test_pixel=0,
+    Y_test_pixel=0,
+    frames_average=1000,
+    gain_check=True,
+    number_bad_modules=0,
+    batch_size=None,
+    n_workers=1,
+    accumulator="float64"
+):
+    if not can_read_file(filename):
+        msg = f"cannot create pedestal file: input file {filename} not found"
+        _logger.info(msg)
+        raise RuntimeError(msg)
+
+    with h5py.File(filename, "r") as h5f:
+        detector_name = h5f["general/detector_name"][()]
+        detector_name = detector_name.decode("UTF-8")
+
+        data_location          = f"data/{detector_name}/data"
+        daq_recs_location      = f"data/{detector_name}/daq_rec"
+        is_good_frame_location = f"data/{detector_name}/is_good_frame"
+
+        # for larger detectors and pedestalmode=True, data may be too large to be loaded at once,
+        # it is read in blocks aligned to the chunks that fit into memory (see check_memory)
+        f_data          = ChunkedReader(h5f, data_location, batch_size=batch_size)
+        f_is_good_frame = h5f[is_good_frame_location][:]
+        f_daq_recs      = h5f[daq_recs_location][:]
+
+        numberOfFrames = len(f_data)
+        _logger.info(f"{detector_name}: pedestal file {filename} contains {numberOfFrames + 1} frames")
+
+        engine = PedestalEngine(
+            detector_name,
+            f_data.shape[1:],
+            X_test_pixel=X_test_pixel,
+            Y_test_pixel=Y_test_pixel,
+            frames_average=frames_average,
+            gain_check=gain_check,
+            number_bad_modules=number_bad_modules,
+            accumulator=accumulator
+        )
+
+        _logger.debug(f"{detector_name}: data has shape: {engine.shape}, type: {f_data.dtype}, {engine.nModules} modules ({number_bad_modules} bad modules)")
+
+        _logger.debug(f"{detector_name}: data has chunks: {f_data.chunks}, initial batch size: {f_data.batch_size}")
+
+        row_ranges = split_module_rows(engine, n_workers)
+        f_data.set_batch_size(check_memory(engine, f_data.batch_size, len(row_ranges)))
+
+        if len(row_ranges) > 1:
+            _logger.info(f"{detector_name}: processing {len(row_ranges)} slices of modules in parallel (rows: {row_ranges})")
+            process_in_parallel(engine, filename, data_location, f_data, f_is_good_frame, f_daq_recs, row_ranges)
+        else:
+            process_serially(engine, f_data, f_is_good_frame, f_daq_recs)
+
+    fileNameIn = os.path.splitext(os.path.basename(filename))[0]
+    full_fileNameOut = directory + "/" + fileNameIn + ".res.h5"
+
+    write_pedestal_file(engine, full_fileNameOut, add_pixel_mask=add_pixel_mask)
+
+
+
+def estimate_memory(engine, batch_size, n_workers=1):
+    """
+    estimated peak memory in bytes: accumulators and pixel mask, and the larger of the block of frames or the output arrays,
+    with workers, the parent holds a copy of the accumulators for stitching
+    """
+    npixels = engine.sh_y * engine.sh_x
+    nbytes_state = engine.accumulator.nbytes + engine.pixelMask.nbytes
+    nbytes_batch = batch_size * npixels * BATCH_NBYTES_PER_PIXEL
+    nbytes_write = 3 * np.dtype(np.float64).itemsize * npixels # mean, stddev and int64 mask of one gain
+    if n_workers > 1:
+        nbytes_state *= 2
+    return nbytes_state + max(nbytes_batch, nbytes_write)
+
+
+def check_memory(engine, batch_size, n_workers=1):
+    """
+    reduces the batch size if the estimated memory usage exceeds the available memory, fails if this is not enough
+    """
+    detector_name = engine.detector_name
+
+    available = get_available_memory()
+    estimate = estimate_memory(engine, batch_size, n_workers)
+
+    if available is None:
+        _logger.info(f"{detector_name}: estimated memory usage: {estimate / 1024**3:.2f} GB (available memory unknown)")
+        return batch_size
+
+    limit = MEMORY_FRACTION * available
+    _logger.info(f"{detector_name}: estimated memory usage: {estimate / 1024**3:.2f} GB ({engine.accumulator.name} accumulator, batch size {batch_size}), available: {available / 1024**3:.2f} GB")
+
+    original_batch_size = batch_size
+    while estimate > limit and batch_size > 1:
+        batch_size = max(1, batch_size // 2)
+        estimate = estimate_memory(engine, batch_size, n_workers)
+
+    if estimate > limit:
+        msg = f"{detector_name}: not enough memory for pedestal calculation: estimated {estimate / 1024**3:.2f} GB, available {available / 1024**3:.2f} GB (consider a float32 or welford accumulator)"
+        _logger.error(msg)
+        raise RuntimeError(msg)
+
+    if batch_size != original_batch_size:
+        _logger.warning(f"{detector_name}: reduced batch size from {original_batch_size} to {batch_size} to fit into memory (estimated memory usage: {estimate / 1024**3:.2f} GB)")
+
+    return batch_size
+
+
+def process_serially(engine, f_data, f_is_good_frame, f_daq_recs):
+    """
+    f_data: ChunkedReader of the raw frames
+    """
+    for start, stop in f_data.batches():
+        is_good_frame = f_is_good_frame[start:stop]
+        if not np.any(is_good_frame):
+            engine.skip(stop - start)
+            continue
+        engine.process(f_data[start:stop], is_good_frame, f_daq_recs[start:stop])
+
+
+def write_pedestal_file(engine, full_fileNameOut, add_pixel_mask=None):
+    detector_name = engine.detector_name
+
+    _logger.info(f"{detector_name}: {engine.nFrames} frames analyzed, {engine.nGoodFrames} good frames, {engine.nGoodFramesGain} frames without settings mismatch; gain frames distribution (0, 1, 2, 3): {tuple(engine.nMgain)}")
+
+    if add_pixel_mask is not None:
+        engine.add_pixel_mask(add_pixel_mask)
+
+    _logger.info(f"{detector_name}: output file with pedestal corrections: {full_fileNameOut}")
+
+    engine.write(full_fileNameOut)
+
+
+
+def split_module_rows(engine, n_workers):
+    """
+    splits the rows of the detector into at most n_workers ranges of complete modules
+    """
+    n_workers = min(n_workers or 1, engine.nModules)
+    if n_workers <= 1 or MODULE_NPIXELS % engine.sh_x:
+        return [(0, engine.sh_y)]
+
+    module_rows = MODULE_NPIXELS // engine.sh_x
+    module_ranges = np.array_split(np.arange(engine.nModules), n_workers)
+    return [(int(mr[0]) * module_rows, (int(mr[-1]) + 1) * module_rows) for mr in module_ranges]
+
+
+def process_in_parallel(engine, filename, data_location, f_data, f_is_good_frame, f_daq_recs, row_ranges):
+    """
+    each worker process reads and accumulates its range of rows,
+    per block of frames, the workers report the number of pixels in the correct gain,
+    the sum over all workers decides (as in the serial case) which frames are used
+    """
+    context = multiprocessing.get_context("spawn")
+    test_pixel = (engine.tX, engine.tY)
+    accumulator = engine.accumulator
+    accumulator_kwargs = {"frames_average": accumulator.frames_average, "accumulator": accumulator.name}
+    workers = []
+
+    try:
+        for rows in row_ranges:
+            conn, worker_conn = context.Pipe()
+            process = context.Process(target=pedestal_worker, args=(worker_conn, filename, data_location, rows, test_pixel, accumulator_kwargs), daemon=True)
+            process.start()
+            worker_conn.close()
+            workers.append((rows, conn, process))
+
+        for start, stop in f_data.batches():
+            is_good_frame = f_is_good_frame[start:stop]
+            if not np.any(is_good_frame):
+                engine.skip(stop - start)
+                continue
+
+            block = engine.next_block(is_good_frame, f_daq_recs[start:stop])
+
+            for _rows, conn, _process in workers:
+                conn.send((start, stop, block))
+
+            nFramesGain = 0
+            gainData_tXtY = None
+            for _rows, conn, _process in workers:
+                worker_nFramesGain, worker_gainData_tXtY = receive_from_worker(conn)
+                nFramesGain += worker_nFramesGain
+                if worker_gainData_tXtY is not None:
+                    gainData_tXtY = worker_gainData_tXtY
+
+            accepted = engine.select(block, nFramesGain, gainData_tXtY, lambda j: f_data[start + j]) # pylint: disable=cell-var-from-loop
+
+            for _rows, conn, _process in workers:
+                conn.send(accepted)
+
+        for _rows, conn, _process in workers:
+            conn.send(None)
+
+        for rows, conn, _process in workers:
+            engine.stitch(rows, *receive_from_worker(conn))
+
+    finally:
+        for _rows, conn, process in workers:
+            conn.close()
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+
+
+def receive_from_worker(conn):
+    try:
+        res = conn.recv()
+    except (EOFError, OSError) as e:
+        res = RuntimeError(f"worker process ended unexpectedly {dueto(e)}")
+
+    if isinstance(res, Exception):
+        msg = f"pedestal worker failed: {excfmt(res)}"
+        _logger.error(msg)
+        raise RuntimeError(msg)
+
+    return res
+
+
+def pedestal_worker(conn, filename, data_location, rows, test_pixel, accumulator_kwargs):
+    """
+    runs in a separate process, answers the requests of process_in_parallel for the given range of rows
+    """
+    try:
+        run_pedestal_worker(conn, filename, data_location, rows, test_pixel, accumulator_kwargs)
+    except Exception as e:
+        # exceptions are not necessarily picklable
+        conn.send(RuntimeError(f"rows {rows}: {excfmt(e)}"))
+    finally:
+        conn.close()
+
+
+def run_pedestal_worker(conn, filename, data_location, rows, test_pixel, accumulator_kwargs):
+    first, last = rows
+    tX, tY = test_pixel
+    has_test_pixel = (first <= tY < last)
+
+    with h5py.File(filename, "r") as h5f:
+        f_data = ChunkedReader(h5f, data_location)
+        shape = (last - first, f_data.shape[2])
+        engine = PedestalEngine(f"rows {first}-{last}", shape, **accumulator_kwargs)
+
+        while True:
+            msg = conn.recv()
+            if msg is None:
+                break
+
+            start, stop, block = msg
+            images = f_data[start:stop, first:last]
+
+            correct_gain, nFramesGain = check_gain(images, block)
+            gainData_tXtY = images[block.good, tY - first, tX] >> 14 if has_test_pixel else None
+            conn.send((nFramesGain, gainData_tXtY))
+
+            accepted = conn.recv()
+            engine.accumulate(images, block, accepted, correct_gain)
+
+    accumulator = engine.accumulator
+    accumulator.flush()
+
+    conn.send((engine.pixelMask, accumulator.arrays(), accumulator.counts))
+
+
+
+class PedestalEngine:
+    """
+    determines per-gain pedestal (mean and standard deviation) and pixel mask from blocks of raw Jungfrau frames
+    """
+
+    def __init__(self, detector_name, shape, X_test_pixel=0, Y_test_pixel=0, frames_average=1000, gain_check=True, number_bad_modules=0, accumulator="float64"):
+        sh_y, sh_x = shape
+        nModules = (sh_x * sh_y) // MODULE_NPIXELS
+        if (nModules * MODULE_NPIXELS) != (sh_x * sh_y):
+            msg = f"{detector_name}: shape mismatch: Jungfrau modules have shape 1024x512, while data has shape {sh_x}x{sh_y}"
+            _logger.error(msg)
+            raise RuntimeError(msg)
+
+        tX = X_test_pixel
+        tY = Y_test_pixel
+        if tX < 0 or tX > (sh_x - 1):
+            tX = 0
+        if tY < 0 or tY > (sh_y - 1):
+            tY = 0
+
+        _logger.debug(f"{detector_name}: test pixel is at (x, y): ({tX}, {tY})")
+
+        self.detector_name = detector_name
+        self.shape = (sh_y, sh_x)
+        self.sh_y = sh_y
+        self.sh_x = sh_x
+        self.nModules = nModules
+        self.tX = tX
+        self.tY = tY
+        self.gain_check = gain_check
+        self.number_bad_modules = number_bad_modules
+
+        if accumulator not in ACCUMULATORS:
+            msg = f"{detector_name}: unknown pedestal accumulator {accumulator} (allowed: {tuple(ACCUMULATORS)})"
+            _logger.error(msg)
+            raise RuntimeError(msg)
+
+        self.pixelMask = np.zeros(self.shape, dtype=MASK_DTYPE)
+        self.accumulator = ACCUMULATORS[accumulator](self.shape, frames_average)
+
+        self.gainCheck = -1
+        self.highG0Check = 0
+        self.printFalseGain = False
+
+        self.nFrames = 0
+        self.nGoodFrames = 0
+        self.nGoodFramesGain = 0
+
+
+    @property
+    def nMgain(self):
+        return self.accumulator.counts
+
+
+    def skip(self, n):
+        self.nFrames += n
+
+
+    def next_block(self, is_good_frame, daq_recs):
+        block = FrameBlock(self.nFrames, is_good_frame, daq_recs, self.gain_check)
+        self.nFrames += len(is_good_frame)
+        self.nGoodFrames += len(block.good)
+        return block
+
+
+    def process(self, images, is_good_frame, daq_recs):
+        """
+        images: block of consecutive raw frames (n, sh_y, sh_x)
+        is_good_frame, daq_recs: the matching entries from the raw file
+        """
+        block = self.next_block(is_good_frame, daq_recs)
+        if not len(block.good):
+            return
+
+        correct_gain, nFramesGain = check_gain(images, block)
+        gainData_tXtY = images[block.good, self.tY, self.tX] >> 14
+
+        accepted = self.select(block, nFramesGain, gainData_tXtY, lambda j: images[j])
+        self.accumulate(images, block, accepted, correct_gain)
+
+
+    def select(self, block, nFramesGain, gainData_tXtY, get_frame):
+        """
+        decides which of the good frames in block are used
+        nFramesGain: number of pixels in the correct gain per good frame
+        gainData_tXtY: gain of the test pixel per good frame
+        get_frame: returns the raw frame j of the block (only used for logging skipped frames)
+        """
+        detector_name = self.detector_name
+        tX, tY = self.tX, self.tY
+
+        trueGain = block.trueGain
+        highG0 = block.highG0
+        gainGoodAllModules = block.gainGoodAllModules
+
+        # make sure that most of the modules are in correct gain
+        enoughFramesGain = (nFramesGain >= (self.nModules - 0.5 - self.number_bad_modules) * MODULE_NPIXELS)
+
+        # logging of the skipped frames and the test pixel is kept per frame and in order
+        for i, j in enumerate(block.good):
+            n = block.first_frame + j
+
+            if not gainGoodAllModules[i]:
+                trueGain_found = (block.daq_recs[i] & DAQ_REC_GAIN) >> 12
+                highG0_found = (block.daq_recs[i] & DAQ_REC_HIGHG0)
+                _logger.debug(f"{detector_name}: skipping frame {n}: mismatch between modules and general settings: gain: {trueGain[i]} vs {trueGain_found}, highG0: {highG0[i]} vs {highG0_found}")
+                continue
+
+            if not enoughFramesGain[i]:
+                gainData = (get_frame(j) >> 14)
+                gain0 = np.sum(gainData == 0)
+                gain1 = np.sum(gainData == 1)
+                gain2 = np.sum(gainData == 3)
+                gain_undefined = np.sum(gainData == 2)
+                _logger.debug(f"{detector_name}: skipping frame {n}: too many bad pixels (true gain: {trueGain[i]} ({nFramesGain[i]}), highG0: {highG0[i]}, gain0: {gain0}, gain1: {gain1}, gain2: {gain2}, undefined gain: {gain_undefined})")
+                continue
+
+            self.nGoodFramesGain += 1
+
+            if gainData_tXtY[i] != trueGain[i]:
+                if not self.printFalseGain:
+                    _logger.info(f"{detector_name}: frame {n}: wrong gain for test pixel ({tX}, {tY}): expected {trueGain[i]} but found {gainData_tXtY[i]}")
+                    self.printFalseGain = True
+            else:
+                if self.gainCheck != -1 and self.printFalseGain:
+                    _logger.info(f"{detector_name}: frame {n}: wrong gain for test pixel ({tX}, {tY}) in previous frame, but correct in this frame {gainData_tXtY[i]}")
+                self.printFalseGain = False
+
+            if self.gainCheck != gainData_tXtY[i] or self.highG0Check != highG0[i]:
+                _logger.info(f"{detector_name}: frame {n}: gain changed for test pixel ({tX}, {tY}): {self.gainCheck} -> {gainData_tXtY[i]} (highG0: {self.highG0Check} -> {highG0[i]}), match: {gainData_tXtY[i] == trueGain[i]}")
+                self.gainCheck = gainData_tXtY[i]
+                self.highG0Check = highG0[i]
+
+        return gainGoodAllModules & enoughFramesGain
+
+
+    def accumulate(self, images, block, accepted, correct_gain):
+        """
+        adds the accepted frames of block to the pixel mask and the running sums
+        correct_gain: pixels in the correct gain per good frame (from check_gain)
+        """
+        if not np.any(accepted):
+            return
+
+        good = block.good
+        trueGain = block.trueGain
+        highG0 = block.highG0
+
+        for gain in np.unique(trueGain[accepted]):
+            in_gain = accepted & (trueGain == gain)
+            wrong_gain_any = np.zeros(self.shape, dtype=bool)
+
+            for hg0 in np.unique(highG0[in_gain]):
+                selected = in_gain & (highG0 == hg0)
+                correct_gain_selected = correct_gain if selected.all() else correct_gain[selected]
+                wrong_gain = ~np.all(correct_gain_selected, axis=0)
+                self.pixelMask[wrong_gain] |= (1 << int(1 + gain + 4 * hg0)) # skip additional_pixel_mask
+                wrong_gain_any |= wrong_gain
+
+            frames = [images[j] for j in good[in_gain]]
+            self.accumulator.add(int(gain), frames, wrong_gain_any)
+
+
+    def stitch(self, rows, pixelMask, arrays, counts):
+        """
+        inserts the results of a worker that processed the given rows
+        """
+        first, last = rows
+        self.pixelMask[first:last] = pixelMask
+        for array, worker_array in zip(self.accumulator.arrays(), arrays):
+            array[:, first:last] = worker_array
+        self.accumulator.counts = list(counts)
+
+
+    def add_pixel_mask(self, add_pixel_mask):
+        detector_name = self.detector_name
+        pixelMask = self.pixelMask
+
+        if not can_read_file(add_pixel_mask):
+            _logger.error(f"{detector_name}: specified file with additional pixel mask {add_pixel_mask} not found or not readable")
+            return
+
+        with h5py.File(add_pixel_mask, "r") as additional_pixel_mask_file:
+            additional_pixel_mask = additional_pixel_mask_file["pixel_mask"][:]
+        nmasked = np.sum(additional_pixel_mask)
+        _logger.info(f"{detector_name}: adding additional pixel mask from file {add_pixel_mask}, number of additionally masked pixels: {nmasked}")
+        if additional_pixel_mask.shape == pixelMask.shape:
+            additional_pixel_mask = additional_pixel_mask.astype(bool)
+            pixelMask[additional_pixel_mask] |= (1 << 0)
+        else:
+            _logger.error(f"{detector_name}: shape of additional pixel mask ({additional_pixel_mask.shape}) does not match current pixel mask ({pixelMask.shape})")
+
+
+    def write(self, full_fileNameOut):
+        detector_name = self.detector_name
+        pixelMask = self.pixelMask
+        tX, tY = self.tX, self.tY
+
+        # gains are written one by one, such that only one set of float64 results exists at a time
+        with h5py.File(full_fileNameOut, "w") as outFile:
+            output_shape = (len(GAIN_SLOTS), *self.shape)
+            gains    = outFile.create_dataset("gains",    shape=output_shape, dtype=np.float64)
+            gainsRMS = outFile.create_dataset("gainsRMS", shape=output_shape, dtype=np.float64)
+
+            for slot, gain in enumerate(GAIN_SLOTS):
+                mean, stdDeviation = self.accumulator.get(gain)
+                _logger.debug(f"{detector_name}: results for gain {gain}: test pixel ({tY}, {tX}), mean: {mean[tY][tX]}, stddev: {stdDeviation[tY][tX]}")
+
+                gains[slot]    = mean
+                gainsRMS[slot] = stdDeviation
+
+                pixelMask[np.isclose(stdDeviation, 0)] |= (1 << (9 + gain)) # skip additional_pixel_mask and 4*2 wrong gain
+
+            outFile.create_dataset("pixel_mask", data=pixelMask.astype(int))
+
+        ngood = np.sum(pixelMask == 0)
+        ntotal = self.sh_x * self.sh_y
+        nbad = ntotal - ngood
+        _logger.info(f"{detector_name}: number of good pixels: {ngood} from {ntotal} in total ({nbad} bad pixels)")
+
+        if ngood == 0:
+            msg = f"pedestal file: output file {full_fileNameOut} contains no good pixel"
+            _logger.error(msg)
+            raise RuntimeError(msg)
+
+
+
+class FrameBlock:
+    """
+    gain settings of the good frames in a block of consecutive raw frames
+    """
+
+    def __init__(self, first_frame, is_good_frame, daq_recs, gain_check=True):
+        n_frames = len(is_good_frame)
+        is_good_frame = np.asarray(is_good_frame).reshape(n_frames, -1)[:, 0]
+
+        self.first_frame = first_frame
+        self.good = good = np.flatnonzero(is_good_frame)
+
+        daq_recs = np.asarray(daq_recs).reshape(n_frames, -1)[good]
+        self.daq_recs = daq_recs
+
+        self.trueGain = (daq_recs[:, 0] & DAQ_REC_GAIN) >> 12
+        self.highG0   = (daq_recs[:, 0] & DAQ_REC_HIGHG0)
+
+        if gain_check:
+            settings = daq_recs & (DAQ_REC_GAIN | DAQ_REC_HIGHG0)
+            self.gainGoodAllModules = np.all(settings == settings[:, :1], axis=1)
+        else:
+            self.gainGoodAllModules = np.ones(len(good), dtype=bool)
+
+
+
+class PedestalAccumulator:
+    """
+    per-gain running sums of the 14-bit ADC values and their squares in float64,
+    after frames_average frames, the sums decay such that they represent the last ~frames_average frames
+    """
+
+    name = "float64"
+
+    def __init__(self, shape, frames_average):
+        self.shape = shape
+        self.frames_average = frames_average
+        self.counts = [0] * N_GAINS
+        self.exact_sums = None
+        self.adcValuesN  = np.zeros((len(GAIN_SLOTS), *shape))
+        self.adcValuesNN = np.zeros((len(GAIN_SLOTS), *shape))
+
+
+    @staticmethod
+    def nbytes_per_pixel(frames_average):
+        # float64 sums plus the integer sums of one gain (see ExactSums)
+        return 2 * 8 * len(GAIN_SLOTS) + ExactSums.nbytes_per_pixel(frames_average)
+
+
+    @property
+    def nbytes(self):
+        return self.nbytes_per_pixel(self.frames_average) * int(np.prod(self.shape))
+
+
+    def arrays(self):
+        return self.adcValuesN, self.adcValuesNN
+
+
+    def add(self, gain, frames, wrong_gain):
+        """
+        frames: consecutive raw frames (sh_y, sh_x) taken in gain
+        wrong_gain: mask of the pixels that are not in gain in at least one of the frames
+        """
+        if gain not in GAIN_SLOTS:
+            self.counts[gain] += len(frames)
+            return
+
+        slot = GAIN_SLOTS.index(gain)
+        frames_average = self.frames_average
+
+        # until frames_average is reached, the sums contain only integers, which are exact in float64,
+        # thus the frames can be summed as integers and converted only once
+        n_exact = max(0, frames_average - self.counts[gain])
+        head = frames[:n_exact]
+        tail = frames[n_exact:]
+
+        if head:
+            exact_sums = self.exact_sums
+            if exact_sums is None or exact_sums.gain != gain:
+                # the gains are taken one after the other, only one set of integer sums is kept
+                self.flush()
+                exact_sums = self.exact_sums = ExactSums(self.shape, gain, frames_average)
+            exact_sums.add(head, wrong_gain)
+
+        if tail:
+            self.flush()
+
+            adcValuesN  = self.adcValuesN[slot]
+            adcValuesNN = self.adcValuesNN[slot]
+
+            for image in tail:
+                frameData = (image & 0b0011111111111111)
+                adcValuesN  -= adcValuesN  / frames_average
+                adcValuesNN -= adcValuesNN / frames_average
+                adcValuesN  += frameData
+                adcValuesNN += np.square(frameData, dtype=np.uint32) # frameData is uint16, the largest uint16 squared fits into uint32
+
+        self.counts[gain] += len(frames)
+
+
+    def flush(self):
+        exact_sums = self.exact_sums
+        if exact_sums is None:
+            return
+        slot = GAIN_SLOTS.index(exact_sums.gain)
+        adcValuesN, adcValuesNN = exact_sums.get()
+        # the float64 sums are integers, adding is exact
+        self.adcValuesN[slot]  += adcValuesN
+        self.adcValuesNN[slot] += adcValuesNN
+        self.exact_sums = None
+
+
+    def get(self, gain):
+        self.flush()
+        slot = GAIN_SLOTS.index(gain)
+        numberFramesAverage = max(1, min(self.frames_average, self.counts[gain]))
+        mean  = self.adcValuesN[slot]  / numberFramesAverage
+        mean2 = self.adcValuesNN[slot] / numberFramesAverage
+        variance = mean2 - mean**2
+        stdDeviation = np.sqrt(variance)
+        return mean, stdDeviation
+
+
+
+class ShiftedSumsAccumulator:
+    """
+    the running sums of PedestalAccumulator in float32, but of the deviations from a per-pixel reference
+    (the first frame in each gain), the deviations are small, thus the sums stay precise and
+    the variance does not suffer from cancellation
+    """
+
+    name = "float32"
+
+    def __init__(self, shape, frames_average):
+        self.shape = shape
+        self.frames_average = frames_average
+        self.counts = [0] * N_GAINS
+        self.reference = np.zeros((len(GAIN_SLOTS), *shape), dtype=np.uint16)
+        self.sums      = np.zeros((len(GAIN_SLOTS), *shape), dtype=np.float32)
+        self.sums2     = np.zeros((len(GAIN_SLOTS), *shape), dtype=np.float32)
+
+
+    @staticmethod
+    def nbytes_per_pixel(_frames_average):
+        return (2 + 4 + 4) * len(GAIN_SLOTS)
+
+
+    @property
+    def nbytes(self):
+        return self.nbytes_per_pixel(self.frames_average) * int(np.prod(self.shape))
+
+
+    def arrays(self):
+        return self.reference, self.sums, self.sums2
+
+
+    def add(self, gain, frames, _wrong_gain):
+        if gain not in GAIN_SLOTS:
+            self.counts[gain] += len(frames)
+            return
+
+        slot = GAIN_SLOTS.index(gain)
+        frames_average = self.frames_average
+        reference = self.reference[slot]
+        sums  = self.sums[slot]
+        sums2 = self.sums2[slot]
+
+        for image in frames:
+            frameData = (image & 0b0011111111111111)
+            if self.counts[gain] == 0:
+                reference[:] = frameData
+
+            self.counts[gain] += 1
+            if self.counts[gain] > frames_average:
+                sums  -= sums  / frames_average
+                sums2 -= sums2 / frames_average
+
+            delta = np.subtract(frameData, reference, dtype=np.float32)
+            sums += delta
+            delta *= delta
+            sums2 += delta
+
+
+    def flush(self):
+        pass
+
+
+    def get(self, gain):
+        slot = GAIN_SLOTS.index(gain)
+        numberFramesAverage = max(1, min(self.frames_average, self.counts[gain]))
+        mean_delta = self.sums[slot].astype(np.float64) / numberFramesAverage
+        variance = self.sums2[slot] / numberFramesAverage - mean_delta**2
+        mean = self.reference[slot] + mean_delta
+        stdDeviation = np.sqrt(variance)
+        return mean, stdDeviation
+
+
+
+class WelfordAccumulator:
+    """
+    mean and variance in float32, updated per frame with Welford's method,
+    with weights 1/n for the first frames_average frames and 1/frames_average afterwards,
+    this is equivalent to the running sums of PedestalAccumulator, but numerically stable
+    """
+
+    name = "welford"
+
+    def __init__(self, shape, frames_average):
+        self.shape = shape
+        self.frames_average = frames_average
+        self.counts = [0] * N_GAINS
+        self.mean     = np.zeros((len(GAIN_SLOTS), *shape), dtype=np.float32)
+        self.variance = np.zeros((len(GAIN_SLOTS), *shape), dtype=np.float32)
+
+
+    @staticmethod
+    def nbytes_per_pixel(_frames_average):
+        return (4 + 4) * len(GAIN_SLOTS)
+
+
+    @property
+    def nbytes(self):
+        return self.nbytes_per_pixel(self.frames_average) * int(np.prod(self.shape))
+
+
+    def arrays(self):
+        return self.mean, self.variance
+
+
+    def add(self, gain, frames, _wrong_gain):
+        if gain not in GAIN_SLOTS:
+            self.counts[gain] += len(frames)
+            return
+
+        slot = GAIN_SLOTS.index(gain)
+        mean     = self.mean[slot]
+        variance = self.variance[slot]
+
+        for image in frames:
+            self.counts[gain] += 1
+            alpha = np.float32(1 / min(self.counts[gain], self.frames_average))
+
+            frameData = (image & 0b0011111111111111)
+            delta = np.subtract(frameData, mean, dtype=np.float32)
+            mean += alpha * delta
+
+            # variance = (1 - alpha) * (variance + alpha * delta^2)
+            delta *= delta
+            delta *= alpha
+            variance += delta
+            variance *= (1 - alpha)
+
+
+    def flush(self):
+        pass
+
+
+    def get(self, gain):
+        slot = GAIN_SLOTS.index(gain)
+        mean = self.mean[slot].astype(np.float64)
+        stdDeviation = np.sqrt(self.variance[slot], dtype=np.float64)
+        return mean, stdDeviation
+
+
+
+ACCUMULATORS = {acc.name: acc for acc in (PedestalAccumulator, ShiftedSumsAccumulator, WelfordAccumulator)}
+
+
+
+class ExactSums:
+    """
+    integer sums of raw frames (including the gain bits) and their squares for frames taken in one gain g,
+    for pixels that are always in gain g, the gain bits are a constant offset c = (g << 14) that is removed in get(),
+    for the (few) other pixels, sums over the deviation d of the gain bits from g are kept separately:
+    frameData = raw - c - (d << 14) and frameData^2 = (raw - c)^2 - 2 * (raw - c) * (d << 14) + (d << 14)^2
+    """
+
+    def __init__(self, shape, gain, frames_max):
+        self.gain = gain
+        self.n = 0
+        # raw values are 16 bits, sums of up to 2**16 frames fit into uint32
+        dtype = np.uint32 if frames_max <= 2**16 else np.uint64
+        self.sumRaw  = np.zeros(shape, dtype=dtype)
+        self.sumRaw2 = np.zeros(shape, dtype=np.uint64)
+        self.wrong_indices = np.empty(0, dtype=np.int64)
+        self.wrong_sums = np.empty((3, 0), dtype=np.int64) # sums of d, (raw - c) * d and d^2 for wrong_indices
+
+
+    @staticmethod
+    def nbytes_per_pixel(frames_max):
+        return (4 if frames_max <= 2**16 else 8) + 8
+
+
+    def add(self, frames, wrong_gain):
+        # in-place adds of single frames are faster than sum(axis=0) with casting
+        for image in frames:
+            self.sumRaw  += image
+            self.sumRaw2 += np.square(image, dtype=np.uint32) # the largest uint16 squared fits into uint32
+
+        self.n += len(frames)
+
+        indices = np.flatnonzero(wrong_gain)
+        if not len(indices):
+            return
+
+        raw = np.array([image.flat[indices] for image in frames], dtype=np.int64)
+        raw -= (self.gain << 14)
+        d = (raw >> 14) # arithmetic shift, i.e., floor division also for negative values
+        sums = np.stack((d.sum(axis=0), (raw * d).sum(axis=0), (d * d).sum(axis=0)))
+
+        merged_indices = np.union1d(self.wrong_indices, indices)
+        merged_sums = np.zeros((3, len(merged_indices)), dtype=np.int64)
+        merged_sums[:, np.searchsorted(merged_indices, self.wrong_indices)] += self.wrong_sums
+        merged_sums[:, np.searchsorted(merged_indices, indices)] += sums
+
+        self.wrong_indices = merged_indices
+        self.wrong_sums = merged_sums
+
+
+    def get(self):
+        n = self.n
+        offset = self.gain << 14
+
+        sumRaw  = self.sumRaw.astype(np.int64)
+        adcValuesNN = self.sumRaw2.astype(np.int64)
+
+        # sum((raw - c)^2) = sum(raw^2) - 2 * c * sum(raw) + n * c^2
+        adcValuesNN -= 2 * offset * sumRaw
+        adcValuesNN += offset * offset * n
+        adcValuesN = sumRaw
+        adcValuesN -= offset * n
+
+        indices = self.wrong_indices
+        sum_d, sum_raw_d, sum_d2 = self.wrong_sums
+        adcValuesN.flat[indices]  -= (sum_d << 14)
+        adcValuesNN.flat[indices] += (sum_d2 << 28) - 2 * (sum_raw_d << 14)
+
+        return adcValuesN.astype(np.float64), adcValuesNN.astype(np.float64)
+
+
+
+def check_gain(images, block):
+    """
+    pixels in the correct gain and their number for each good frame of block
+    """
+    correct_gain = np.empty((len(block.good), *images.shape[1:]), dtype=bool)
+    nFramesGain = np.empty(len(block.good), dtype=int)
+    for i, (j, gain) in enumerate(zip(block.good, block.trueGain)):
+        is_in_gain(images[j], gain, out=correct_gain[i])
+        nFramesGain[i] = np.count_nonzero(correct_gain[i])
+    return correct_gain, nFramesGain
+
+
+def is_in_gain(image, gain, out=None):
+    """
+    mask of pixels in the given gain, gain 0 and 3 need only one comparison
+    """
+    if gain == 0:
+        return np.less(image, 1 << 14, out=out)
+    if gain == 3:
+        return np.greater_equal(image, 3 << 14, out=out)
+    return np.equal(image >> 14, gain, out=out)
+
+
+
+def can_read_file(fname):
+    return os.path.isfile(fname) and os.access(fname, os.R_OK)
@@ -0,0 +1,159 @@
+import logging
+import os
+from queue import Queue
+from threading import Thread
+from time import sleep, time
+
+import h5py
+import numpy as np
+
+from sf_daq_broker import config
+from sf_daq_broker.utils import excfmt
+from sf_daq_broker.utils.h5read import ChunkedReader
+from sf_daq_broker.utils.pulseids import align_pulse_ids, expected_pulse_ids
+from sf_daq_broker.writer.detector_writer import get_pedestal_options, retrieve_from_buffer
+from sf_daq_broker.writer.pedestal import PedestalEngine, process_serially, write_pedestal_file
+
+
+_logger = logging.getLogger("broker_writer")
+
+
+
+class PedestalStream:
+    """
+    computes the pedestal of one detector while it is taken:
+    the pulse range is retrieved from the buffer in short segments, which are fed into a PedestalEngine in a background thread,
+    thus, the pedestal file is ready shortly after the last frame instead of after the retrieval of the whole raw file
+    """
+
+    def __init__(self, detector_name, raw_file_name, rate_multiplicator=1, accumulator="float64", delay=config.PEDESTAL_STREAM_DELAY):
+        self.detector_name = detector_name
+        self.raw_file_name = raw_file_name
+        self.res_file_name = raw_file_name[:-3] + ".res.h5"
+        self.segment_file_name = raw_file_name[:-3] + ".segment.h5"
+        self.rate_multiplicator = rate_multiplicator
+        self.delay = delay
+
+        self.add_pixel_mask, specific_kwargs = get_pedestal_options(detector_name)
+        self.engine_kwargs = dict(specific_kwargs, accumulator=accumulator)
+
+        self.engine = None
+        self.next_pulse_id = None
+        self.error = None
+
+        self.segments = Queue()
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+
+    def progress(self, start_pulse_id, pulse_id):
+        """
+        called while the pedestal is taken: all frames from start_pulse_id up to pulse_id are taken
+        """
+        if self.next_pulse_id is None:
+            self.next_pulse_id = start_pulse_id
+
+        det_start_pulse_id, det_stop_pulse_id = align_pulse_ids(self.next_pulse_id, pulse_id, self.rate_multiplicator)
+        if det_start_pulse_id == 0:
+            return
+
+        self.segments.put((det_start_pulse_id, det_stop_pulse_id, time()))
+        self.next_pulse_id = det_stop_pulse_id + 1
+
+
+    def finish(self, det_start_pulse_id, det_stop_pulse_id):
+        """
+        processes the remaining frames up to det_stop_pulse_id and writes the pedestal file
+        """
+        if self.next_pulse_id is None:
+            self.next_pulse_id = det_start_pulse_id
+
+        if self.next_pulse_id <= det_stop_pulse_id:
+            self.progress(self.next_pulse_id, det_stop_pulse_id)
+
+        self.segments.put(None)
+        self.thread.join()
+
+        if self.error is not None:
+            msg = f"streaming pedestal calculation for {self.detector_name} failed: {excfmt(self.error)}"
+            _logger.error(msg)
+            raise RuntimeError(msg)
+
+        if self.engine is None:
+            msg = f"streaming pedestal calculation for {self.detector_name} did not receive any frame"
+            _logger.error(msg)
+            raise RuntimeError(msg)
+
+        write_pedestal_file(self.engine, self.res_file_name, add_pixel_mask=self.add_pixel_mask)
+        return self.res_file_name
+
+
+    def stop(self):
+        """
+        ends the background thread without writing the pedestal file
+        """
+        self.segments.put(None)
+
+
+    def run(self):
+        while True:
+            segment = self.segments.get()
+            if segment is None:
+                break
+
+            # after an error, the remaining segments are ignored
+            if self.error is not None:
+                continue
+
+            start_pulse_id, stop_pulse_id, time_taken = segment
+
+            # the buffer lags behind the pulse id
+            wait_time = time_taken + self.delay - time()
+            if wait_time > 0:
+                sleep(wait_time)
+
+            try:
+                self.process_segment(start_pulse_id, stop_pulse_id)
+            except Exception as e:
+                _logger.exception(f"streaming pedestal calculation for {self.detector_name} failed for pulse ids {start_pulse_id}-{stop_pulse_id}")
+                self.error = e
+
+
+    def process_segment(self, start_pulse_id, stop_pulse_id):
+        fn = self.segment_file_name
+        try:
+            retrieve_from_buffer(self.detector_name, fn, start_pulse_id, stop_pulse_id, self.rate_multiplicator)
+            with h5py.File(fn, "r") as h5f:
+                check_segment(h5f, self.detector_name, start_pulse_id, stop_pulse_id, self.rate_multiplicator)
+                self.process_file(h5f)
+        finally:
+            if os.path.exists(fn):
+                os.remove(fn)
+
+
+    def process_file(self, h5f):
+        detector_name = self.detector_name
+        f_data          = ChunkedReader(h5f, f"data/{detector_name}/data")
+        f_is_good_frame = h5f[f"data/{detector_name}/is_good_frame"][:]
+        f_daq_recs      = h5f[f"data/{detector_name}/daq_rec"][:]
+
+        if self.engine is None:
+            self.engine = PedestalEngine(detector_name, f_data.shape[1:], **self.engine_kwargs)
+
+        process_serially(self.engine, f_data, f_is_good_frame, f_daq_recs)
+        _logger.debug(f"{detector_name}: streaming pedestal calculation: {self.engine.nFrames} frames analyzed so far")
+
+
+
+def check_segment(h5f, detector_name, start_pulse_id, stop_pulse_id, rate_multiplicator):
+    """
+    raises if frames of the segment are missing (e.g., the buffer did not have them yet),
+    such that the pedestal is computed from the full raw file instead
+    """
+    pulse_ids = h5f[f"data/{detector_name}/pulse_id"][:].ravel()
+    expected = expected_pulse_ids(start_pulse_id, stop_pulse_id, rate_multiplicator)
+    n_missing = len(np.setdiff1d(expected, pulse_ids))
+    if n_missing:
+        msg = f"{detector_name}: {n_missing} of {len(expected)} frames missing in segment {start_pulse_id}-{stop_pulse_id}"
+        _logger.error(msg)
+        raise RuntimeError(msg)
@@ -0,0 +1,133 @@
+import logging
+import os
+from time import sleep, time
+
+import requests
+
+from sf_daq_broker import config
+from sf_daq_broker.rabbitmq import broker_config
+from sf_daq_broker.utils import dueto, get_data_api_request, parse_det_name
+
+
+_logger = logging.getLogger("broker_writer")
+
+
+DETECTOR_BUFFER_DIRECTORY = "/gpfs/photonics/swissfel/buffer"
+
+
+
+def wait_until_ready(probe, time_to_wait, interval=config.READINESS_POLL_INTERVAL):
+    """
+    polls probe until it returns True, but waits at most time_to_wait seconds,
+    returns whether the data is ready (False if the time ran out)
+    """
+    deadline = time() + time_to_wait
+
+    while True:
+        if probe():
+            return True
+
+        remaining = deadline - time()
+        if remaining <= 0:
+            return False
+
+        sleep(min(interval, remaining))
+
+
+def get_probe(request, writer_type):
+    """
+    the readiness probe for the request (None if there is none for its writer type)
+    """
+    if writer_type == broker_config.TAG_DETECTOR_RETRIEVE:
+        channels = request.get("channels") or {}
+        detector_name = channels.get("detector_name")
+        stop_pulse_id = channels.get("det_stop_pulse_id")
+        if detector_name is None or stop_pulse_id is None:
+            return None
+        return lambda: detector_is_ready(detector_name, stop_pulse_id)
+
+    if writer_type == broker_config.TAG_DATA3BUFFER:
+        channels = request.get("channels")
+        stop_pulse_id = request.get("stop_pulse_id")
+        if not channels or stop_pulse_id is None:
+            return None
+        probe_channels = select_probe_channels(channels)
+        return lambda: bsdata_is_ready(probe_channels, stop_pulse_id)
+
+    return None
+
+
+def detector_is_ready(detector_name, stop_pulse_id, buffer_directory=DETECTOR_BUFFER_DIRECTORY):
+    """
+    all modules are written beyond stop_pulse_id:
+    the LATEST file of each module holds the name of the buffer file that is currently written,
+    which is named after its first pulse ID
+    """
+    n_modules = parse_det_name(detector_name).T
+
+    for i in range(n_modules):
+        latest_file = f"{buffer_directory}/{detector_name}/M{i:02}/LATEST"
+        latest_pulse_id = read_latest_pulse_id(latest_file)
+        if latest_pulse_id is None or latest_pulse_id <= stop_pulse_id:
+            return False
+
+    return True
+
+
+def read_latest_pulse_id(latest_file):
+    try:
+        with open(latest_file) as f:
+            latest = f.read().strip()
+        latest = os.path.basename(latest).split(".")[0]
+        return int(latest)
+    except (OSError, ValueError):
+        return None
+
+
+def select_probe_channels(channels, n_channels=config.BSDATA_READINESS_CHANNELS):
+    """
+    at most n_channels of the channels, spread over the list (image channels are not probed)
+    """
+    channels = [ch for ch in channels if not ch.endswith(":FPICTURE")]
+    if len(channels) <= n_channels:
+        return channels
+    step = len(channels) / n_channels
+    return [channels[int(i * step)] for i in range(n_channels)]
+
+
+def bsdata_is_ready(channels, stop_pulse_id, margin=config.BSDATA_READINESS_MARGIN):
+    """
+    the Data API 3 query endpoint returns data at or after stop_pulse_id for each of the channels,
+    the query ends margin pulses after stop_pulse_id to include channels with lower rates
+    """
+    if not channels:
+        return True
+
+    query = get_data_api_request(channels, stop_pulse_id, stop_pulse_id + margin)
+    url = f"{config.DATA_API3_QUERY_ADDRESS}/query"
+    try:
+        response = requests.post(url, json=query, headers={"Accept": "application/json"}, timeout=config.READINESS_POLL_INTERVAL)
+        response.raise_for_status()
+        ready = channels_have_data(response.json(), channels, stop_pulse_id)
+    except Exception as e:
+        _logger.debug(f"data of {len(channels)} channels is not ready for pulse ID {stop_pulse_id} {dueto(e)}")
+        return False
+
+    if not ready:
+        _logger.debug(f"data of {len(channels)} channels is not ready for pulse ID {stop_pulse_id}")
+    return ready
+
+
+def channels_have_data(response, channels, stop_pulse_id):
+    """
+    the JSON response (a list with the events of each channel) has an event at or after stop_pulse_id for each of the channels
+    """
+    latest = {}
+    for entry in response:
+        channel = entry["channel"]
+        name = channel["name"] if isinstance(channel, dict) else channel
+        pulse_ids = [event["pulseId"] for event in entry.get("data") or []]
+        if pulse_ids:
+            latest[name] = max(pulse_ids)
+
+    return all(latest.get(ch, -1) >= stop_pulse_id for ch in channels)
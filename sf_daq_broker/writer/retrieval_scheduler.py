@@ -0,0 +1,132 @@
+import logging
+from contextlib import contextmanager
+from threading import Condition
+from time import time
+
+from sf_daq_broker import config
+
+
+_logger = logging.getLogger("broker_writer")
+
+
+
+class RetrievalJob:
+
+    def __init__(self, name, nbytes, bandwidth, tmp_space):
+        self.name = name
+        self.nbytes = nbytes
+        self.bandwidth = bandwidth
+        self.tmp_space = tmp_space
+        self.time_submitted = time()
+
+
+    def __repr__(self):
+        return f"{self.name} ({self.nbytes / 1024**3:.1f} GB)"
+
+
+
+class RetrievalScheduler:
+    """
+    runs several detector retrievals at once, as long as they stay within the GPFS bandwidth and the SSD tmp space budgets,
+    waiting retrievals are started smallest first (a smaller one that does not fit yet does not hold back the larger ones that do),
+    unless one waits longer than max_wait, which is then started next,
+    a retrieval that exceeds a budget on its own runs alone
+    """
+
+    def __init__(self, bandwidth=config.DETECTOR_RETRIEVE_BANDWIDTH, tmp_space=config.DETECTOR_RETRIEVE_TMP_SPACE, module_bandwidth=config.DETECTOR_RETRIEVE_MODULE_BANDWIDTH, max_wait=config.DETECTOR_RETRIEVE_MAX_WAIT):
+        self.bandwidth = bandwidth
+        self.tmp_space = tmp_space
+        self.module_bandwidth = module_bandwidth
+        self.max_wait = max_wait
+
+        self.condition = Condition()
+        self.waiting = []
+        self.running = []
+
+
+    @contextmanager
+    def job(self, name, n_modules, nbytes, tmp_nbytes=0):
+        """
+        blocks until the retrieval may start, the resources are freed when the context is left,
+        tmp_nbytes is the SSD tmp space it uses (see schedule_retrieval)
+        """
+        job = RetrievalJob(name, nbytes, n_modules * self.module_bandwidth, tmp_nbytes)
+        self.acquire(job)
+        try:
+            yield job
+        finally:
+            self.release(job)
+
+
+    def acquire(self, job):
+        with self.condition:
+            self.waiting.append(job)
+            _logger.info(f"retrieval of {job} is waiting, running: {self.running}, waiting: {self.waiting}")
+
+            while self.next_job() is not job:
+                # a job that becomes overdue changes the order, even if nothing else happens
+                self.condition.wait(timeout=self.time_to_overdue())
+
+            self.waiting.remove(job)
+            self.running.append(job)
+            # the next waiting job might fit as well
+            self.condition.notify_all()
+
+        delta_time = time() - job.time_submitted
+        _logger.info(f"retrieval of {job} starts after waiting {delta_time} seconds")
+
+
+    def retrieval_done(self, job):
+        """
+        frees the bandwidth of job, its tmp space stays in use until the context is left (i.e., until the raw file is converted)
+        """
+        with self.condition:
+            job.bandwidth = 0
+            self.condition.notify_all()
+
+
+    def release(self, job):
+        with self.condition:
+            self.running.remove(job)
+            self.condition.notify_all()
+
+
+    def next_job(self):
+        """
+        the waiting job that is started next, None if it does not fit yet
+        """
+        if not self.waiting:
+            return None
+
+        now = time()
+        overdue = [j for j in self.waiting if now - j.time_submitted > self.max_wait]
+        if overdue:
+            # the others wait as well, otherwise the overdue job might never fit
+            job = min(overdue, key=lambda j: j.time_submitted)
+            return job if self.fits(job) else None
+
+        for job in sorted(self.waiting, key=lambda j: (j.nbytes, j.time_submitted)):
+            if self.fits(job):
+                return job
+
+        return None
+
+
+    def time_to_overdue(self):
+        """
+        seconds until the next waiting job becomes overdue, None if all are overdue already
+        """
+        now = time()
+        remaining = [self.max_wait - (now - j.time_submitted) for j in self.waiting]
+        remaining = [t for t in remaining if t >= 0]
+        return min(remaining, default=None)
+
+
+    def fits(self, job):
+        if not self.running:
+            return True
+
+        used_bandwidth = sum(j.bandwidth for j in self.running)
+        used_tmp_space = sum(j.tmp_space for j in self.running)
+
+        return used_bandwidth + job.bandwidth <= self.bandwidth and used_tmp_space + job.tmp_space <= self.tmp_space
@@ -1,8 +1,9 @@
 import argparse
 import logging
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from functools import partial
-from threading import Thread
 from time import sleep, time
 
 from pika import BasicProperties
@@ -11,9 +12,14 @@ from sf_daq_broker import config
 from sf_daq_broker.detector.power_on_detector import power_on_detector
 from sf_daq_broker.detector.take_pedestal import take_pedestal
 from sf_daq_broker.rabbitmq import broker_config, BrokerClient
-from sf_daq_broker.utils import get_data_api_request, get_writer_request, json_save, json_load, json_obj_to_str, json_str_to_obj
+from sf_daq_broker.utils import get_data_api_request, get_writer_request, json_save, json_load, json_obj_to_str, json_str_to_obj, parse_det_name
+from sf_daq_broker.utils.request_context import RequestFilter, current_request
 from sf_daq_broker.writer.bsread_writer import write_from_databuffer_api3, write_from_imagebuffer
-from sf_daq_broker.writer.detector_writer import detector_retrieve
+from sf_daq_broker.writer.convert_file import set_conversion_concurrency
+from sf_daq_broker.writer.detector_writer import detector_retrieve, estimate_raw_file_nbytes, get_segment_frames, plan_raw_file, publish_pedestal, remove_stale_staged_files
+from sf_daq_broker.writer.pedestal_stream import PedestalStream
+from sf_daq_broker.writer.readiness import get_probe, wait_until_ready
+from sf_daq_broker.writer.retrieval_scheduler import RetrievalScheduler
 
 
 _logger = logging.getLogger("broker_writer")
@@ -38,6 +44,16 @@ REQUEST_QUEUES = {
     WRITER_DETECTOR_PEDESTAL: broker_config.QUEUE_DETECTOR_PEDESTAL
 }
 
+# number of requests processed at once
+WORKERS = {
+    WRITER_DATA_API:          config.DATA_API_WRITER_WORKERS,
+    WRITER_DETECTOR_RETRIEVE: config.DETECTOR_RETRIEVE_CONCURRENCY,
+    WRITER_DETECTOR_CONVERT:  config.DETECTOR_CONVERT_WRITER_WORKERS,
+    WRITER_DETECTOR_PEDESTAL: 1
+}
+
+retrieval_scheduler = RetrievalScheduler()
+
 
 
 def run():
@@ -47,6 +63,7 @@ def run():
     parser.add_argument("--log_level", default=config.DEFAULT_LOG_LEVEL, choices=["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG"], help="log level")
     parser.add_argument("--writer_id", default=1, type=int, help="writer ID")
     parser.add_argument("--writer_type", default=0, type=int, choices=range(4), help="writer type (0: epics/BS/camera; 1: detector retrieve; 2: detector conversion; 3: detector pedestal)")
+    parser.add_argument("--workers", default=None, type=int, help="number of requests processed at once (default depends on the writer type)")
 
     clargs = parser.parse_args()
 
@@ -68,10 +85,21 @@ def run():
 
     _logger.info("starting data writer service")
 
-    start_service(broker_url=clargs.broker_url, writer_type=clargs.writer_type)
+    start_service(broker_url=clargs.broker_url, writer_type=clargs.writer_type, n_workers=clargs.workers)
+
+
+def start_service(broker_url, writer_type=0, n_workers=None):
+    if writer_type == WRITER_DETECTOR_PEDESTAL or n_workers is None:
+        n_workers = WORKERS[writer_type]
+
+    _logger.info(f"processing up to {n_workers} requests at once")
+
+    # the conversions running at once share the conversion memory budget
+    set_conversion_concurrency(n_workers)
 
+    if writer_type == WRITER_DETECTOR_RETRIEVE:
+        remove_stale_staged_files()
 
-def start_service(broker_url, writer_type=0):
     connection, channel = BrokerClient(broker_url=broker_url).open()
 
     routing_key   = ROUTING_KEYS[writer_type]
@@ -79,20 +107,25 @@ def start_service(broker_url, writer_type=0):
 
     channel.queue_declare(queue=request_queue, auto_delete=True)
     channel.queue_bind(queue=request_queue, exchange=broker_config.REQUEST_EXCHANGE, routing_key=routing_key)
-    channel.basic_qos(prefetch_count=1)
+    # the broker delivers only as many requests as can be processed, the others stay in the queue for other writers
+    channel.basic_qos(prefetch_count=n_workers)
 
     broker_client = BrokerClient(broker_url=broker_url)
+    executor = ThreadPoolExecutor(max_workers=n_workers, thread_name_prefix="broker_writer")
 
-    on_broker_message_cb = partial(on_broker_message, connection=connection, broker_client=broker_client)
+    on_broker_message_cb = partial(on_broker_message, connection=connection, broker_client=broker_client, executor=executor)
     channel.basic_consume(request_queue, on_broker_message_cb)
 
     try:
         channel.start_consuming()
     except KeyboardInterrupt:
         channel.stop_consuming()
+    finally:
+        # unacknowledged requests are redelivered by the broker
+        executor.shutdown(wait=False, cancel_futures=True)
 
 
-def on_broker_message(channel, method_frame, header_frame, body, connection, broker_client):
+def on_broker_message(channel, method_frame, header_frame, body, connection, broker_client, executor):
     try:
         request = json_str_to_obj(body.decode())
         output_file = request.get("output_file", None)
@@ -116,9 +149,7 @@ def on_broker_message(channel, method_frame, header_frame, body, connection, bro
 
             connection.add_callback_threadsafe(callback)
 
-        thread = Thread(target=process_async)
-        thread.daemon = True
-        thread.start()
+        executor.submit(process_async)
 
     except Exception as e:
         _logger.exception("failed to write requested data")
@@ -168,10 +199,17 @@ def process_request(request, broker_client):
     run_log_file = request.get("run_log_file", None)
     run_log_level = request.get("run_log_level", logging.INFO)
 
+    # the threads started for this request inherit it (see utils.request_context)
+    request_id = uuid.uuid4()
+    request_token = current_request.set(request_id)
+
     file_handler = None
     if run_log_file:
         file_handler = logging.FileHandler(run_log_file)
         file_handler.setLevel(run_log_level)
+        # several requests of these types run at once, the run log should only get the messages of its own request
+        if writer_type in (broker_config.TAG_DATA3BUFFER, broker_config.TAG_IMAGEBUFFER, broker_config.TAG_DETECTOR_RETRIEVE):
+            file_handler.addFilter(RequestFilter(request_id))
         _logger.addHandler(file_handler)
 
         logger_data_api = None
@@ -198,6 +236,7 @@ def process_request(request, broker_client):
             _logger.removeHandler(file_handler)
             if logger_data_api is not None:
                 logger_data_api.removeHandler(file_handler)
+        current_request.reset(request_token)
 
 
 def process_request_internal(request, broker_client):
@@ -220,7 +259,7 @@ def process_request_internal(request, broker_client):
         _logger.info("skipping request: no channels requested")
         return
 
-    wait_for_delay(request_timestamp, writer_type)
+    wait_for_delay(request_timestamp, writer_type, probe=get_probe(request, writer_type))
 
     start_time = time()
 
@@ -246,7 +285,12 @@ def process_request_internal(request, broker_client):
 
     elif writer_type == broker_config.TAG_DETECTOR_RETRIEVE:
         _logger.info("using detector retrieve writer")
-        detector_retrieve(channels, output_file)
+        # the same decision where the raw file goes is used for the scheduling and the retrieval
+        raw_file_plan = plan_raw_file(channels)
+        with schedule_retrieval(channels, raw_file_plan) as job:
+            # the bandwidth is freed once the data is retrieved, the conversion does not need it
+            on_retrieved = lambda: retrieval_scheduler.retrieval_done(job)
+            detector_retrieve(channels, output_file, on_retrieved=on_retrieved, raw_file_plan=raw_file_plan)
 
     elif writer_type == broker_config.TAG_DETECTOR_CONVERT:
         _logger.info("using detector convert writer")
@@ -256,7 +300,10 @@ def process_request_internal(request, broker_client):
     _logger.info(f"processing request took {delta_time} seconds")
 
 
-def wait_for_delay(request_timestamp, writer_type):
+def wait_for_delay(request_timestamp, writer_type, probe=None):
+    """
+    waits for the retrieval delay after the request timestamp, or until probe reports that the data is ready
+    """
     if request_timestamp is None:
         return
 
@@ -274,8 +321,42 @@ def wait_for_delay(request_timestamp, writer_type):
     adjusted_retrieval_delay = max(adjusted_retrieval_delay, 0)
 
     _logger.debug(f"request timestamp: {request_timestamp}, current timestamp: {current_timestamp}, adjusted retrieval delay: {adjusted_retrieval_delay}")
-    _logger.info(f"sleeping for {adjusted_retrieval_delay} seconds before continuing...")
-    sleep(adjusted_retrieval_delay)
+
+    if probe is None:
+        _logger.info(f"sleeping for {adjusted_retrieval_delay} seconds before continuing...")
+        sleep(adjusted_retrieval_delay)
+        return
+
+    _logger.info(f"waiting at most {adjusted_retrieval_delay} seconds for the data to be ready...")
+    ready = wait_until_ready(probe, adjusted_retrieval_delay)
+    delta_time = time() - current_timestamp
+    if ready:
+        _logger.info(f"data is ready after {delta_time} seconds")
+    else:
+        _logger.info(f"data readiness not confirmed after {delta_time} seconds, continuing anyway")
+
+
+def schedule_retrieval(request, raw_file_plan):
+    """
+    SSD tmp space is reserved only if the raw file is written there (see plan_raw_file),
+    in segments, only the raw segments that are not converted yet are there at the same time
+    """
+    detector_name = request["detector_name"]
+    rate_multiplicator = request["rate_multiplicator"]
+    n_modules = parse_det_name(detector_name).T
+    nbytes = estimate_raw_file_nbytes(detector_name, request["det_start_pulse_id"], request["det_stop_pulse_id"], rate_multiplicator)
+
+    use_tmp, use_shm, _raw_file_nbytes = raw_file_plan
+    tmp_nbytes = 0
+    if use_tmp and not use_shm:
+        tmp_nbytes = nbytes
+        segment_frames = get_segment_frames(request)
+        if segment_frames:
+            # one segment is converted, one waits for its conversion, one is retrieved
+            segment_nbytes = estimate_raw_file_nbytes(detector_name, 0, (segment_frames - 1) * rate_multiplicator, rate_multiplicator)
+            tmp_nbytes = min(nbytes, 3 * segment_nbytes)
+
+    return retrieval_scheduler.job(detector_name, n_modules, nbytes, tmp_nbytes)
 
 
 def audit_failed_write_request(write_request):
@@ -307,7 +388,25 @@ def detector_pedestal_retrieve(broker_client, request):
     detectors = request.get("detectors", [])
     rate_multiplicator = request.get("rate_multiplicator", 1)
     pedestalmode = request.get("pedestalmode", False)
-    det_start_pulse_id, det_stop_pulse_id = take_pedestal(detectors, rate=rate_multiplicator, pedestalmode=pedestalmode)
+    pedestal_accumulator = request.get("pedestal_accumulator", "float64")
+
+    # compute the pedestals already while they are taken
+    streams = {}
+    if request.get("pedestal_streaming", False):
+        for detector in detectors:
+            streams[detector] = PedestalStream(detector, f"{output_file_prefix}.{detector}.h5", rate_multiplicator=rate_multiplicator, accumulator=pedestal_accumulator)
+
+    on_progress = partial(report_pedestal_progress, streams) if streams else None
+
+    try:
+        det_start_pulse_id, det_stop_pulse_id = take_pedestal(detectors, rate=rate_multiplicator, pedestalmode=pedestalmode, on_progress=on_progress)
+    except Exception:
+        for stream in streams.values():
+            stream.stop()
+        raise
+
+    request_time = request.get("request_time", str(datetime.now()))
+    pedestal_ready = finish_pedestal_streams(streams, det_start_pulse_id, det_stop_pulse_id, request_time)
 
     # overwrite start/stop pulse IDs in run_info json file
     run_file_json = request.get("run_file_json", None)
@@ -328,24 +427,28 @@ def detector_pedestal_retrieve(broker_client, request):
         "path_to_pgroup":     request.get("path_to_pgroup", None),
         "run_info_directory": request.get("run_info_directory", None),
         "directory_name":     request.get("directory_name"),
-        "request_time":       request.get("request_time", str(datetime.now()))
+        "request_time":       request_time,
+        "pedestal_workers":   request.get("pedestal_workers", 1),
+        "pedestal_accumulator": pedestal_accumulator
     }
 
     run_log_file = request.get("run_log_file", "/tmp/pedestal.log")
     run_log_file_prefix = run_log_file.rsplit(".", 1)[0]
 
-    broker_client.open()
+    write_requests = []
 
     for detector in detectors:
-        channels["detector_name"] = detector
-        channels["detectors"] = {detector: {}}
+        det_channels = dict(channels)
+        det_channels["detector_name"] = detector
+        det_channels["detectors"] = {detector: {}}
+        det_channels["pedestal_ready"] = pedestal_ready.get(detector, False)
 
         det_output_file = f"{output_file_prefix}.{detector}.h5"
         det_run_log_file = f"{run_log_file_prefix}.{detector}.log"
 
         write_request = get_writer_request(
             broker_config.TAG_DETECTOR_RETRIEVE,
-            channels,
+            det_channels,
             det_output_file,
             None,
             det_start_pulse_id,
@@ -353,9 +456,37 @@ def detector_pedestal_retrieve(broker_client, request):
             det_run_log_file
         )
 
-        broker_client.send(write_request, broker_config.TAG_DETECTOR_RETRIEVE)
+        write_requests.append((write_request, broker_config.TAG_DETECTOR_RETRIEVE))
+
+    unrouted = broker_client.send_batch(write_requests)
+    if unrouted:
+        raise RuntimeError(f"no writer received {len(unrouted)} of {len(write_requests)} detector retrieve requests")
+
+
+def report_pedestal_progress(streams, start_pulse_id, pulse_id):
+    for stream in streams.values():
+        stream.progress(start_pulse_id, pulse_id)
+
+
+def finish_pedestal_streams(streams, det_start_pulse_id, det_stop_pulse_id, request_time):
+    """
+    writes and publishes the pedestal files of the streams,
+    for failed streams, the pedestal is computed from the retrieved raw file as usual
+    """
+    pedestal_ready = {}
+
+    for detector, stream in streams.items():
+        try:
+            res_file_name = stream.finish(det_start_pulse_id, det_stop_pulse_id)
+            publish_pedestal(request_time, res_file_name, detector, stream.add_pixel_mask)
+        except Exception:
+            _logger.exception(f"streaming pedestal calculation for {detector} failed, the pedestal will be computed from the retrieved raw file")
+            continue
+
+        _logger.info(f"pedestal of {detector} is ready: {res_file_name}")
+        pedestal_ready[detector] = True
 
-    broker_client.close()
+    return pedestal_ready
 
 
 def unwind_exception(exc):
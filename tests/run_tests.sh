@@ -3,6 +3,4 @@
 dn=$(dirname $0)
 cd "$dn/.."
 
-PYTHONPATH=$PWD python -m unittest tests/test_broker.py
-
-
+PYTHONPATH=$PWD python -m unittest discover -s tests
@@ -0,0 +1,95 @@
+import multiprocessing
+import os
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from sf_daq_broker.broker_manager import get_current_step_in_scan
+from sf_daq_broker.utils import counter as counter_module
+from sf_daq_broker.utils.counter import FileCounter, get_counter
+
+
+N_INCREMENTS = 50
+
+
+
+def increment_many(fname, n):
+    counter = FileCounter(fname)
+    return [counter.increment() for _ in range(n)]
+
+
+
+class TestFileCounter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.fname = f"{self.tmpdir.name}/LAST_RUN"
+
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+
+    def test_get_and_increment(self):
+        counter = FileCounter(self.fname)
+        self.assertEqual(counter.get(), 0)
+        self.assertFalse(os.path.exists(self.fname))
+
+        with open(self.fname, "w") as f:
+            f.write("41")
+        self.assertEqual(counter.get(), 41)
+        self.assertEqual(counter.increment(), 42)
+        self.assertEqual(counter.get(), 42)
+
+        with open(self.fname) as f:
+            self.assertEqual(f.read(), "42")
+
+
+    def test_sees_other_writers(self):
+        counter = FileCounter(self.fname)
+        other = FileCounter(self.fname)
+        counter.increment()
+        self.assertEqual(counter.get(), 1)
+        other.increment()
+        self.assertEqual(counter.get(), 2)
+
+
+    def test_counters_are_not_kept(self):
+        counter = get_counter(self.fname)
+        self.assertIs(get_counter(self.fname), counter)
+        self.assertIn(self.fname, counter_module._counters)
+        del counter
+        self.assertNotIn(self.fname, counter_module._counters)
+
+
+    def test_concurrent_increments(self):
+        ctx = multiprocessing.get_context("spawn")
+        with ctx.Pool(2) as pool:
+            results = pool.starmap(increment_many, [(self.fname, N_INCREMENTS)] * 2)
+
+        counter = FileCounter(self.fname)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results += list(executor.map(lambda _: counter.increment(), range(N_INCREMENTS)))
+
+        values = [v for res in results[:2] for v in res] + results[2:]
+        self.assertEqual(sorted(values), list(range(1, 3 * N_INCREMENTS + 1)))
+        self.assertEqual(counter.get(), 3 * N_INCREMENTS)
+
+
+
+class TestAcquisitionNumber(unittest.TestCase):
+
+    def test_new_run(self):
+        with tempfile.TemporaryDirectory() as meta_directory:
+            self.assertEqual(get_current_step_in_scan(meta_directory), 1)
+            self.assertEqual(get_current_step_in_scan(meta_directory), 2)
+
+
+    def test_run_without_counter(self):
+        with tempfile.TemporaryDirectory() as meta_directory:
+            for fname in ("acq0001.json", "acq0002.json", "scan.json", "notes.txt"):
+                open(f"{meta_directory}/{fname}", "w").close()
+
+            self.assertEqual(get_current_step_in_scan(meta_directory), 3)
+            open(f"{meta_directory}/other.txt", "w").close()
+            self.assertEqual(get_current_step_in_scan(meta_directory), 4)
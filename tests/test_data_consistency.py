@@ -0,0 +1,50 @@
+import tempfile
+import unittest
+
+import h5py
+import numpy as np
+
+from sf_daq_broker.writer.data_consistency import check_data_consistency, is_consistent
+
+
+
+class TestDataConsistency(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.output_file = f"{self.tmpdir.name}/acq0001.BSDATA.h5"
+
+        good = np.arange(100, 201, 2)
+        bad = np.r_[98, np.arange(100, 150, 2), 150, 150, 151, 151, 146, np.arange(160, 203, 2)]
+
+        with h5py.File(self.output_file, "w") as h5f:
+            h5f.create_dataset("SAR:GOOD/pulse_id", data=good.reshape(-1, 1), chunks=(4, 1))
+            h5f.create_dataset("SAR:BAD/pulse_id", data=bad, chunks=(4,))
+
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+
+    def test_report(self):
+        channels = ["SAR:GOOD", "SAR:BAD", "SAR:MISSING"]
+        with self.assertLogs("broker_writer", level="ERROR"):
+            report = check_data_consistency(100, 200, 2, channels, self.output_file, n_threads=2)
+
+        self.assertEqual(list(report), channels)
+
+        self.assertTrue(is_consistent(report["SAR:GOOD"]))
+        self.assertEqual(report["SAR:GOOD"]["matched"], 51)
+
+        self.assertEqual(report["SAR:MISSING"], {"present": False})
+
+        bad = report["SAR:BAD"]
+        self.assertFalse(is_consistent(bad))
+        self.assertEqual(bad["before"], 1)
+        self.assertEqual(bad["after"], 1)
+        self.assertEqual(bad["missing"], 4) # 152, 154, 156, 158
+        self.assertEqual(bad["duplicates"], 3) # 150, 151 and 146
+        self.assertEqual(bad["unexpected"], 1) # 151
+        self.assertEqual(bad["decreasing"], 1) # 151 -> 146
+        self.assertEqual(bad["first_matched_pulse_id"], 100)
+        self.assertEqual(bad["last_matched_pulse_id"], 200)
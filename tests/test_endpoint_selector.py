@@ -0,0 +1,91 @@
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+from time import sleep
+
+from sf_daq_broker.writer.endpoint_selector import EndpointSelector
+
+
+ADDRESSES = ["http://node1", "http://node2"]
+
+
+
+class TestEndpointSelector(unittest.TestCase):
+
+    def test_least_loaded(self):
+        selector = EndpointSelector(ADDRESSES, cooldown=60)
+        release = Event()
+        started = Event()
+
+        def slow(address):
+            started.set()
+            release.wait(5)
+            return address
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            busy = executor.submit(selector.request, slow)
+            started.wait(5)
+            # the address with a request in flight is avoided
+            other = selector.request(lambda address: address)
+            release.set()
+            self.assertNotEqual(busy.result(), other)
+
+        self.assertEqual(sum(stats["requests"] for stats in selector.snapshot().values()), 2)
+
+
+    def test_failover(self):
+        selector = EndpointSelector(ADDRESSES, cooldown=60)
+        tried = []
+
+        def func(address):
+            tried.append(address)
+            if address == ADDRESSES[0]:
+                raise OSError("node down")
+            return address
+
+        for _ in range(3):
+            self.assertEqual(selector.request(func), ADDRESSES[1])
+
+        # the failed address is avoided during the cooldown
+        self.assertEqual(tried.count(ADDRESSES[0]), 1)
+        snapshot = selector.snapshot()
+        self.assertFalse(snapshot[ADDRESSES[0]]["healthy"])
+        self.assertEqual(snapshot[ADDRESSES[0]]["failures"], 1)
+
+
+    def test_all_fail(self):
+        selector = EndpointSelector(ADDRESSES, cooldown=60)
+
+        def func(address):
+            raise OSError(f"{address} down")
+
+        with self.assertRaises(OSError):
+            selector.request(func)
+
+        self.assertEqual(sum(stats["failures"] for stats in selector.snapshot().values()), 2)
+        self.assertEqual(sum(stats["in_flight"] for stats in selector.snapshot().values()), 0)
+
+
+    def test_latency_per_size(self):
+        selector = EndpointSelector(ADDRESSES, cooldown=60)
+        selector.request(lambda address: sleep(0.1), size=100)
+        selector.request(lambda address: sleep(0.02), size=1)
+
+        latencies = sorted(stats["latency"] for stats in selector.snapshot().values())
+        # the large request is not considered slow
+        self.assertLess(latencies[0], 0.01)
+        self.assertGreaterEqual(latencies[1], 0.02)
+
+
+    def test_failure_keeps_latency(self):
+        selector = EndpointSelector(ADDRESSES[:1], cooldown=0)
+        selector.request(lambda address: address)
+        latency = selector.snapshot()[ADDRESSES[0]]["latency"]
+
+        def func(address):
+            raise OSError("node down")
+
+        with self.assertRaises(OSError):
+            selector.request(func)
+
+        self.assertEqual(selector.snapshot()[ADDRESSES[0]]["latency"], latency)
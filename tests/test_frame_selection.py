@@ -0,0 +1,53 @@
+import unittest
+
+import numpy as np
+
+from sf_daq_broker.detector.frame_selection import DAQ_REC_DARKSHOT, DAQ_REC_LASER, DAQ_REC_PPICKER, filter_events, select_frames, split_laser_events
+
+
+N_FRAMES = 1000
+START_PULSE_ID = 11_000_000_000
+
+
+
+class TestFrameSelection(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.is_good_frame = (rng.random(N_FRAMES) > 0.1).astype(np.uint64)
+        self.pulse_ids = (START_PULSE_ID + 2 * np.arange(N_FRAMES, dtype=np.uint64)).reshape(-1, 1)
+        self.daq_recs = rng.integers(0, 1 << 20, size=(N_FRAMES, 2), dtype=np.int64)
+
+
+    def test_selected_pulse_ids(self):
+        selected_pulse_ids = [int(p) for p in self.pulse_ids[::7, 0]] + [START_PULSE_ID + 1, START_PULSE_ID - 10]
+        selected_pulse_ids.reverse()
+
+        expected = [i for i in range(N_FRAMES) if self.is_good_frame[i] != 0 and self.pulse_ids[i][0] in selected_pulse_ids]
+        result = select_frames(self.is_good_frame, self.pulse_ids, selected_pulse_ids)
+        np.testing.assert_array_equal(result, expected)
+
+        expected = np.nonzero(self.is_good_frame)[0]
+        for selected_pulse_ids in (None, []):
+            result = select_frames(self.is_good_frame, self.pulse_ids, selected_pulse_ids)
+            np.testing.assert_array_equal(result, expected)
+
+
+    def test_pulse_picker_events(self):
+        good_frames = select_frames(self.is_good_frame)
+        expected = [i for i in good_frames if (self.daq_recs[i][0] >> 19) & 1]
+        result = filter_events(good_frames, self.daq_recs, DAQ_REC_PPICKER)
+        np.testing.assert_array_equal(result, expected)
+
+
+    def test_laser_events(self):
+        good_frames = select_frames(self.is_good_frame)
+        expected_dark, expected_light = [], []
+        for i in good_frames:
+            daq_rec = self.daq_recs[i][0]
+            laser_on = bool(daq_rec & DAQ_REC_LASER) and not bool(daq_rec & DAQ_REC_DARKSHOT)
+            (expected_light if laser_on else expected_dark).append(i)
+
+        dark, light = split_laser_events(good_frames, self.daq_recs)
+        np.testing.assert_array_equal(dark, expected_dark)
+        np.testing.assert_array_equal(light, expected_light)
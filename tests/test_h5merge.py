@@ -0,0 +1,137 @@
+import os
+import tempfile
+import unittest
+
+import h5py
+import numpy as np
+
+from sf_daq_broker.utils.h5merge import combine_files, concatenate_files, merge_files
+
+
+DETECTOR_NAME = "JF01T01V01"
+FRAME_DATASETS = [f"data/{DETECTOR_NAME}/pulse_id", f"data/{DETECTOR_NAME}/data"]
+
+
+
+class TestMergeFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.segment_dir = f"{self.tmpdir.name}/segments"
+        os.makedirs(self.segment_dir)
+
+        self.file_names = []
+        self.pulse_ids = []
+        self.data = []
+        start = 0
+        for i, n in enumerate((5, 3, 7)):
+            fn = f"{self.segment_dir}/{i:04}.h5"
+            pulse_ids = np.arange(start, start + n, dtype=np.uint64).reshape(-1, 1)
+            data = np.random.default_rng(i).random((n, 4, 6)).astype(np.float32)
+            with h5py.File(fn, "w") as h5f:
+                h5f.attrs["detector_name"] = DETECTOR_NAME
+                h5f[f"data/{DETECTOR_NAME}/pulse_id"] = pulse_ids
+                h5f.create_dataset(f"data/{DETECTOR_NAME}/data", data=data, chunks=(1, 4, 6), compression="gzip")
+                h5f[f"data/{DETECTOR_NAME}/pixel_mask"] = np.full((4, 6), i)
+                # not per frame, even though its length matches the number of frames of the first file
+                h5f[f"data/{DETECTOR_NAME}/gains"] = np.full(5, i)
+                h5f[f"data/{DETECTOR_NAME}/data"].attrs["units"] = "keV"
+            self.file_names.append(fn)
+            self.pulse_ids.append(pulse_ids)
+            self.data.append(data)
+            start += n
+
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+
+    def test_merge(self):
+        output_file = f"{self.tmpdir.name}/run/acq0001.{DETECTOR_NAME}.h5"
+        os.makedirs(os.path.dirname(output_file))
+        n_frames = merge_files(self.file_names, output_file, FRAME_DATASETS)
+        self.assertEqual(n_frames, 15)
+
+        # the virtual datasets resolve the segments relative to the output file
+        cwd = os.getcwd()
+        os.chdir("/")
+        try:
+            with h5py.File(output_file, "r") as h5f:
+                self.assertEqual(h5f.attrs["detector_name"], DETECTOR_NAME)
+                dataset = h5f[f"data/{DETECTOR_NAME}/data"]
+                self.assertTrue(dataset.is_virtual)
+                self.assertEqual(dataset.attrs["units"], "keV")
+                np.testing.assert_array_equal(dataset[:], np.concatenate(self.data))
+                np.testing.assert_array_equal(h5f[f"data/{DETECTOR_NAME}/pulse_id"][:], np.concatenate(self.pulse_ids))
+                np.testing.assert_array_equal(h5f[f"data/{DETECTOR_NAME}/pixel_mask"][:], 0)
+                self.assertFalse(h5f[f"data/{DETECTOR_NAME}/gains"].is_virtual)
+                np.testing.assert_array_equal(h5f[f"data/{DETECTOR_NAME}/gains"][:], 0)
+        finally:
+            os.chdir(cwd)
+
+
+    def test_different_layout(self):
+        with h5py.File(self.file_names[1], "a") as h5f:
+            del h5f[f"data/{DETECTOR_NAME}/data"]
+        output_file = f"{self.tmpdir.name}/merged.h5"
+        with self.assertRaises(RuntimeError):
+            merge_files(self.file_names, output_file, FRAME_DATASETS)
+
+
+
+class TestCombineFiles(unittest.TestCase):
+
+    def test_combine(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file_names = []
+            for i, channels in enumerate((["SAR:CH1", "SAR:CH2"], ["SAR:CH3"])):
+                fn = f"{tmpdir}/shard{i}.h5"
+                with h5py.File(fn, "w") as h5f:
+                    h5f.attrs["shard"] = i
+                    for channel in channels:
+                        h5f[f"{channel}/pulse_id"] = np.arange(10)
+                        h5f.create_dataset(f"{channel}/data", data=np.arange(10) * i, compression="gzip")
+                file_names.append(fn)
+
+            output_file = f"{tmpdir}/combined.h5"
+            combine_files(file_names, output_file)
+
+            with h5py.File(output_file, "r") as h5f:
+                self.assertEqual(sorted(h5f), ["SAR:CH1", "SAR:CH2", "SAR:CH3"])
+                self.assertEqual(h5f.attrs["shard"], 0)
+                self.assertEqual(h5f["SAR:CH3/data"].compression, "gzip")
+                np.testing.assert_array_equal(h5f["SAR:CH3/data"][:], np.arange(10))
+
+            with self.assertRaises(RuntimeError):
+                combine_files([file_names[0], file_names[0]], output_file)
+
+
+
+class TestConcatenateFiles(unittest.TestCase):
+
+    def test_concatenate(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file_names = []
+            for i, n in enumerate((4, 0, 6)):
+                fn = f"{tmpdir}/{i:04}.h5"
+                with h5py.File(fn, "w") as h5f:
+                    h5f.attrs["segment"] = i
+                    h5f[f"SAR:CH1/pulse_id"] = np.arange(n) + 10 * i
+                    h5f.create_dataset(f"SAR:CH1/data", data=np.ones((n, 3)) * i, chunks=(2, 3), maxshape=(None, 3), compression="gzip")
+                    h5f[f"SAR:CH1/data"].attrs["units"] = "mm"
+                    h5f[f"SAR:CH1/scalar"] = i
+                    if i == 2:
+                        h5f[f"SAR:CH2/pulse_id"] = np.arange(n)
+                file_names.append(fn)
+
+            output_file = f"{tmpdir}/concatenated.h5"
+            concatenate_files(file_names, output_file, max_nbytes=50)
+
+            with h5py.File(output_file, "r") as h5f:
+                self.assertEqual(h5f.attrs["segment"], 0)
+                np.testing.assert_array_equal(h5f["SAR:CH1/pulse_id"][:], np.r_[np.arange(4), np.arange(6) + 20])
+                np.testing.assert_array_equal(h5f["SAR:CH1/data"][:, 0], [0] * 4 + [2] * 6)
+                self.assertEqual(h5f["SAR:CH1/data"].compression, "gzip")
+                self.assertEqual(h5f["SAR:CH1/data"].attrs["units"], "mm")
+                self.assertEqual(h5f["SAR:CH1/scalar"][()], 0)
+                np.testing.assert_array_equal(h5f["SAR:CH2/pulse_id"][:], np.arange(6))
@@ -0,0 +1,77 @@
+import tempfile
+import unittest
+
+import h5py
+import numpy as np
+
+from sf_daq_broker.utils.h5read import ChunkedReader, n_chunks, next_prime
+
+
+SHAPE = (50, 16, 32)
+
+
+
+class TestChunkedReader(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = f"{self.tmpdir.name}/data.h5"
+        self.data = np.arange(np.prod(SHAPE), dtype=np.uint16).reshape(SHAPE)
+        with h5py.File(self.filename, "w") as h5f:
+            h5f.create_dataset("chunked", data=self.data, chunks=(4, 8, 32))
+            h5f.create_dataset("contiguous", data=self.data)
+
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+
+    def test_batches_are_aligned_to_chunks(self):
+        with h5py.File(self.filename, "r") as h5f:
+            reader = ChunkedReader(h5f, "chunked", batch_size=10)
+            self.assertEqual(reader.batch_size, 8)
+
+            batches = list(reader.batches())
+            self.assertEqual(batches[0], (0, 8))
+            self.assertEqual(batches[-1], (48, 50))
+            for start, _stop in batches:
+                self.assertEqual(start % reader.chunk_frames, 0)
+
+            batches = list(reader.batches(start=3, stop=20))
+            self.assertEqual(batches, [(3, 8), (8, 16), (16, 20)])
+
+            data = np.concatenate([reader[start:stop] for start, stop in reader.batches()])
+            np.testing.assert_array_equal(data, self.data)
+
+
+    def test_chunk_cache_holds_one_layer_of_chunks(self):
+        with h5py.File(self.filename, "r") as h5f:
+            reader = ChunkedReader(h5f, "chunked")
+            nslots, nbytes, w0 = reader.dataset.id.get_access_plist().get_chunk_cache()
+            self.assertGreaterEqual(nbytes, 2 * 4 * 8 * 32 * 2)
+            self.assertGreater(nslots, 100)
+            self.assertEqual(w0, 1.0)
+
+
+    def test_contiguous_and_small_batches(self):
+        with h5py.File(self.filename, "r") as h5f:
+            reader = ChunkedReader(h5f, "contiguous", batch_size=7)
+            self.assertIsNone(reader.chunks)
+            self.assertEqual(reader.batch_size, 7)
+
+            reader = ChunkedReader(h5f, "chunked", batch_size=3)
+            self.assertEqual(reader.batch_size, 3)
+            np.testing.assert_array_equal(reader[5, 2:4], self.data[5, 2:4])
+
+
+
+class TestHelpers(unittest.TestCase):
+
+    def test_next_prime(self):
+        self.assertEqual(next_prime(100), 101)
+        self.assertEqual(next_prime(1), 2)
+
+
+    def test_n_chunks(self):
+        self.assertEqual(n_chunks((512, 1024), (512, 1024)), 1)
+        self.assertEqual(n_chunks((1024, 1024), (300, 1024)), 4)
@@ -0,0 +1,60 @@
+import os
+import tempfile
+import unittest
+from time import time
+
+from sf_daq_broker.detector.liveness import LivenessMonitor
+
+
+
+class TestLivenessMonitor(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.buffer_location = self.tmpdir.name
+        self.monitor = LivenessMonitor(buffer_location=self.buffer_location, interval=60, max_age=30)
+
+
+    def tearDown(self):
+        self.monitor.stop()
+        self.tmpdir.cleanup()
+
+
+    def touch(self, detector, i_module, age):
+        module_directory = f"{self.buffer_location}/{detector}/M{i_module:02}"
+        os.makedirs(module_directory, exist_ok=True)
+        fname = f"{module_directory}/LATEST"
+        with open(fname, "w"):
+            pass
+        mtime = time() - age
+        os.utime(fname, (mtime, mtime))
+
+
+    def test_status(self):
+        for i in range(2):
+            self.touch("JF01T02V01", i, age=1)
+        self.touch("JF02T03V01", 0, age=1)
+        self.touch("JF02T03V01", 1, age=100)
+        self.touch("JF03T01V01", 0, age=100)
+
+        running, limping, missing, snapshot_time = self.monitor.get_status(["JF01T02V01", "JF02T03V01", "JF03T01V01", "JF04T01V01"])
+        self.assertEqual(running, ["JF01T02V01"])
+        self.assertEqual(limping, {"JF02T03V01": {"running_modules": [0], "missing_modules": [1, 2]}})
+        self.assertEqual(missing, ["JF03T01V01", "JF04T01V01"])
+        self.assertLessEqual(snapshot_time, time())
+
+
+    def test_answers_from_snapshot(self):
+        self.touch("JF01T02V01", 0, age=1)
+        _running, _limping, missing, snapshot_time = self.monitor.get_status(["JF01T02V01"])
+        self.assertEqual(missing, [])
+
+        # not visible until the next refresh
+        self.touch("JF01T02V01", 1, age=1)
+        running, _limping, _missing, snapshot_time_cached = self.monitor.get_status(["JF01T02V01"])
+        self.assertEqual(running, [])
+        self.assertEqual(snapshot_time_cached, snapshot_time)
+
+        self.monitor.refresh()
+        running, _limping, _missing, _snapshot_time = self.monitor.get_status(["JF01T02V01"])
+        self.assertEqual(running, ["JF01T02V01"])
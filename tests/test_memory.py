@@ -0,0 +1,31 @@
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from sf_daq_broker.utils.memory import Reservations
+
+
+
+class TestReservations(unittest.TestCase):
+
+    def test_reserve_and_release(self):
+        reservations = Reservations()
+        fits = lambda nbytes: nbytes <= 100
+
+        self.assertTrue(reservations.reserve(60, fits))
+        self.assertFalse(reservations.reserve(60, fits))
+        self.assertTrue(reservations.reserve(40, fits))
+
+        reservations.release(60)
+        self.assertEqual(reservations.nbytes, 40)
+        self.assertTrue(reservations.reserve(60, fits))
+
+
+    def test_concurrent(self):
+        reservations = Reservations()
+        fits = lambda nbytes: nbytes <= 10
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            reserved = list(executor.map(lambda _: reservations.reserve(1, fits), range(100)))
+
+        self.assertEqual(sum(reserved), 10)
+        self.assertEqual(reservations.nbytes, 10)
@@ -0,0 +1,145 @@
+import tempfile
+import unittest
+from unittest import mock
+
+import h5py
+import numpy as np
+
+from sf_daq_broker.writer import pedestal
+from sf_daq_broker.writer.pedestal import create_pedestal_file
+
+
+DETECTOR_NAME = "JF99T{:02}V01"
+MODULE_SHAPE = (512, 1024)
+GAINS = (0, 1, 3)
+N_FRAMES_PER_GAIN = 12
+FRAMES_AVERAGE = 8
+
+
+
+def make_raw_file(filename, n_modules=1):
+    rng = np.random.default_rng(42)
+    n_frames = len(GAINS) * N_FRAMES_PER_GAIN
+    detector_name = DETECTOR_NAME.format(n_modules)
+    shape = (MODULE_SHAPE[0] * n_modules, MODULE_SHAPE[1])
+
+    pedestal = rng.integers(1000, 3000, size=shape, dtype=np.uint16)
+    data = np.empty((n_frames, *shape), dtype=np.uint16)
+    daq_recs = np.zeros((n_frames, n_modules), dtype=np.int64)
+    is_good_frame = np.ones(n_frames, dtype=np.int64)
+
+    for n in range(n_frames):
+        gain = GAINS[n // N_FRAMES_PER_GAIN]
+        daq_recs[n] = gain << 12
+        gains = np.full(shape, gain, dtype=np.uint16)
+        gains[rng.random(shape) < 1e-3] = (gain + 1) % 4
+        data[n] = (pedestal + rng.integers(0, 100, size=shape, dtype=np.uint16)) | (gains << 14)
+
+    is_good_frame[[3, 20]] = 0
+
+    # one frame with most pixels in a wrong gain and one with mismatching module settings
+    data[10, :MODULE_SHAPE[0]] ^= (1 << 14)
+    daq_recs[30, -1] ^= 1
+
+    with h5py.File(filename, "w") as h5f:
+        h5f["general/detector_name"] = detector_name.encode()
+        h5f[f"data/{detector_name}/data"] = data
+        h5f[f"data/{detector_name}/daq_rec"] = daq_recs
+        h5f[f"data/{detector_name}/is_good_frame"] = is_good_frame
+
+    return data, daq_recs, is_good_frame
+
+
+def make_reference(data, daq_recs, is_good_frame):
+    shape = data.shape[1:]
+    n_modules = daq_recs.shape[1]
+    adcValuesN  = np.zeros((4, *shape))
+    adcValuesNN = np.zeros((4, *shape))
+    pixelMask = np.zeros(shape, dtype=int)
+    nMgain = [0] * 4
+
+    for image, daq_rec, good in zip(data, daq_recs, is_good_frame):
+        if not good or np.any(daq_rec != daq_rec[0]):
+            continue
+        gain = int(daq_rec[0] >> 12)
+        highG0 = int(daq_rec[0] & 1)
+        correct_gain = ((image >> 14) == gain)
+        if np.sum(correct_gain) < (n_modules - 0.5) * MODULE_SHAPE[0] * MODULE_SHAPE[1]:
+            continue
+        frameData = image & 0x3FFF
+        pixelMask[~correct_gain] |= (1 << (1 + gain + 4 * highG0))
+        nMgain[gain] += 1
+        if nMgain[gain] > FRAMES_AVERAGE:
+            adcValuesN[gain]  -= adcValuesN[gain]  / FRAMES_AVERAGE
+            adcValuesNN[gain] -= adcValuesNN[gain] / FRAMES_AVERAGE
+        adcValuesN[gain]  += frameData
+        adcValuesNN[gain] += np.square(frameData, dtype=np.uint32)
+
+    gains = []
+    gainsRMS = []
+    for gain in GAINS:
+        n = max(1, min(FRAMES_AVERAGE, nMgain[gain]))
+        mean = adcValuesN[gain] / n
+        std = np.sqrt(adcValuesNN[gain] / n - mean**2)
+        gains.append(mean)
+        gainsRMS.append(std)
+        pixelMask[np.isclose(std, 0)] |= (1 << (9 + gain))
+
+    return pixelMask, np.array(gains), np.array(gainsRMS)
+
+
+
+class TestPedestal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.directory = self.tmpdir.name
+        self.filename = f"{self.directory}/pedestal.h5"
+
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+
+    def create(self, **kwargs):
+        create_pedestal_file(filename=self.filename, directory=self.directory, frames_average=FRAMES_AVERAGE, **kwargs)
+        with h5py.File(f"{self.directory}/pedestal.res.h5", "r") as h5f:
+            return h5f["pixel_mask"][:], h5f["gains"][:], h5f["gainsRMS"][:]
+
+
+    def test_matches_frame_by_frame_reference(self):
+        expected = make_reference(*make_raw_file(self.filename))
+        for batch_size in (None, 1, 5):
+            result = self.create(batch_size=batch_size)
+            for res, exp in zip(result, expected):
+                np.testing.assert_array_equal(res, exp)
+
+
+    def test_parallel_matches_serial(self):
+        expected = make_reference(*make_raw_file(self.filename, n_modules=3))
+        for n_workers in (1, 2):
+            result = self.create(batch_size=7, n_workers=n_workers, Y_test_pixel=1000)
+            for res, exp in zip(result, expected):
+                np.testing.assert_array_equal(res, exp)
+
+
+    def test_float32_and_welford_accumulators(self):
+        make_raw_file(self.filename)
+        mask64, gains64, rms64 = self.create()
+        for accumulator in ("float32", "welford"):
+            mask, gains, rms = self.create(accumulator=accumulator)
+            np.testing.assert_allclose(gains, gains64, rtol=1e-6)
+            np.testing.assert_allclose(rms, rms64, rtol=1e-3, atol=1e-3)
+            np.testing.assert_array_equal(mask, mask64)
+
+
+    def test_memory_check(self):
+        make_raw_file(self.filename)
+        with mock.patch.object(pedestal, "get_available_memory", return_value=1024**2):
+            with self.assertRaises(RuntimeError):
+                self.create()
+
+        engine = pedestal.PedestalEngine(DETECTOR_NAME.format(1), MODULE_SHAPE)
+        available = pedestal.estimate_memory(engine, 10) / pedestal.MEMORY_FRACTION
+        with mock.patch.object(pedestal, "get_available_memory", return_value=available):
+            self.assertEqual(pedestal.check_memory(engine, 100), 6)
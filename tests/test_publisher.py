@@ -0,0 +1,174 @@
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from pika.exceptions import StreamLostError
+from pika.spec import Basic
+
+from sf_daq_broker.rabbitmq import broker_config
+from sf_daq_broker.rabbitmq.broker_client import BrokerClient
+from sf_daq_broker.rabbitmq.publisher import PooledConnection, Publisher
+
+
+
+class FakeChannel:
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.declared = []
+        self.published = []
+        self.on_return = None
+
+    @property
+    def is_open(self):
+        return self.connection.is_open
+
+    def exchange_declare(self, exchange, exchange_type):
+        self.declared.append(exchange)
+
+    def add_on_return_callback(self, callback):
+        self.on_return = callback
+
+    def tx_select(self):
+        self.pending = []
+        self.returns = []
+
+    def tx_commit(self):
+        if not self.connection.is_open:
+            raise StreamLostError("connection lost")
+        self.published.extend(self.pending)
+        self.pending = []
+
+    def basic_publish(self, exchange, routing_key, body, properties, mandatory=False):
+        if mandatory and routing_key in self.connection.unroutable:
+            method = Basic.Return(reply_code=312, reply_text="NO_ROUTE", exchange=exchange, routing_key=routing_key)
+            self.returns.append((method, properties, body))
+            return
+        self.pending.append((exchange, routing_key, body))
+
+    def dispatch_returns(self):
+        for method, properties, body in self.returns:
+            self.on_return(self, method, properties, body)
+        self.returns = []
+
+
+
+class FakeConnection:
+
+    def __init__(self):
+        self.is_open = True
+        self.channels = []
+        self.unroutable = set()
+
+    def channel(self):
+        channel = FakeChannel(self)
+        self.channels.append(channel)
+        return channel
+
+    def process_data_events(self, time_limit):
+        if not self.is_open:
+            raise StreamLostError("connection lost")
+        for channel in self.channels:
+            channel.dispatch_returns()
+
+    def close(self):
+        self.is_open = False
+
+
+
+class FakePublisher(Publisher):
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.connections = []
+
+    def connect(self):
+        conn = PooledConnection(FakeConnection())
+        self.connections.append(conn)
+        return conn
+
+
+
+class TestPublisher(unittest.TestCase):
+
+    def test_connections_are_reused(self):
+        publisher = FakePublisher(pool_size=2)
+        for i in range(5):
+            publisher.publish(broker_config.REQUEST_EXCHANGE, "detector.retrieve", f"{i}".encode())
+            publisher.publish(broker_config.STATUS_EXCHANGE, "", f"{i}".encode())
+
+        self.assertEqual(len(publisher.connections), 1)
+        channel = publisher.connections[0].channel
+        self.assertEqual(channel.declared, [broker_config.REQUEST_EXCHANGE, broker_config.STATUS_EXCHANGE])
+        self.assertEqual(len(channel.published), 10)
+
+
+    def test_reconnect(self):
+        publisher = FakePublisher(pool_size=2)
+        publisher.publish(broker_config.REQUEST_EXCHANGE, "bs.data", b"a")
+        publisher.connections[0].connection.is_open = False # e.g., missed heartbeats
+
+        publisher.publish(broker_config.REQUEST_EXCHANGE, "bs.data", b"b")
+        self.assertEqual(len(publisher.connections), 2)
+        self.assertEqual(publisher.connections[1].channel.published, [(broker_config.REQUEST_EXCHANGE, "bs.data", b"b")])
+        self.assertEqual(publisher.n_connections, 1)
+
+
+    def test_batch_is_committed_together(self):
+        publisher = FakePublisher(pool_size=2)
+        messages = [(broker_config.REQUEST_EXCHANGE, "detector.retrieve", f"{i}".encode(), None) for i in range(6)]
+        publisher.publish_batch(messages)
+        publisher.connections[0].connection.is_open = False
+
+        # the lost connection is detected before publishing, the whole batch goes to a new connection
+        publisher.publish_batch(messages)
+        self.assertEqual([len(conn.channel.published) for conn in publisher.connections], [6, 6])
+
+
+    def test_unroutable_request_is_returned(self):
+        publisher = FakePublisher(pool_size=2)
+        publisher.publish(broker_config.REQUEST_EXCHANGE, "bs.data", b"a")
+        publisher.connections[0].connection.unroutable.add("detector.retrieve")
+
+        messages = [
+            (broker_config.REQUEST_EXCHANGE, "detector.retrieve", b"b", None),
+            (broker_config.REQUEST_EXCHANGE, "bs.data", b"b", None),
+            (broker_config.STATUS_EXCHANGE, "", b"b", None)
+        ]
+        returned = publisher.publish_batch(messages)
+        self.assertEqual(returned, [(broker_config.REQUEST_EXCHANGE, "detector.retrieve", "NO_ROUTE")])
+
+        # the other messages are delivered, the connection stays usable, status messages are not mandatory
+        self.assertEqual(publisher.connections[0].channel.published[-2:], [(broker_config.REQUEST_EXCHANGE, "bs.data", b"b"), (broker_config.STATUS_EXCHANGE, "", b"b")])
+        publisher.publish(broker_config.REQUEST_EXCHANGE, "bs.data", b"c")
+        self.assertEqual(len(publisher.connections), 1)
+
+
+    def test_client_returns_unrouted_requests(self):
+        client = BrokerClient()
+        client.publisher = FakePublisher(pool_size=1)
+        client.publisher.publish(broker_config.REQUEST_EXCHANGE, "bs.data", b"a")
+        client.publisher.connections[0].connection.unroutable.add("epics_alvra")
+
+        requests = [
+            ({"output_file": "acq0001.PVDATA.h5"}, "epics_alvra"),
+            ({"output_file": "acq0001.BSDATA.h5"}, broker_config.TAG_DATA3BUFFER)
+        ]
+        unrouted = client.send_batch(requests)
+        self.assertEqual(unrouted, requests[:1])
+
+        with self.assertRaises(RuntimeError):
+            client.send(*requests[0])
+
+
+    def test_pool_size_is_bounded(self):
+        publisher = FakePublisher(pool_size=3)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            for i in range(200):
+                executor.submit(publisher.publish, broker_config.REQUEST_EXCHANGE, "bs.data", b"x")
+
+        self.assertLessEqual(len(publisher.connections), 3)
+        n_published = sum(len(conn.channel.published) for conn in publisher.connections)
+        self.assertEqual(n_published, 200)
+
+        publisher.close()
+        self.assertEqual(publisher.n_connections, 0)
@@ -0,0 +1,47 @@
+import unittest
+
+import numpy as np
+
+from sf_daq_broker.utils.pulseids import align_pulse_ids, expected_pulse_ids, split_pulse_range
+
+
+
+def align_pulse_ids_loop(start_pulse_id, stop_pulse_id, rate_multiplicator):
+    """
+    the loop used before align_pulse_ids
+    """
+    det_start_pulse_id = 0
+    det_stop_pulse_id = stop_pulse_id
+    for p in range(start_pulse_id, stop_pulse_id+1):
+        if p % rate_multiplicator == 0:
+            det_stop_pulse_id = p
+            if det_start_pulse_id == 0:
+                det_start_pulse_id = p
+    return det_start_pulse_id, det_stop_pulse_id
+
+
+
+class TestPulseIDs(unittest.TestCase):
+
+    def test_align_pulse_ids(self):
+        for rate_multiplicator in (1, 2, 4, 10, 100):
+            for start_pulse_id in range(1000, 1012):
+                for stop_pulse_id in range(start_pulse_id, start_pulse_id + 25):
+                    args = (start_pulse_id, stop_pulse_id, rate_multiplicator)
+                    self.assertEqual(align_pulse_ids(*args), align_pulse_ids_loop(*args), args)
+
+
+    def test_expected_pulse_ids(self):
+        for rate_multiplicator in (1, 2, 4, 10, 100):
+            for start_pulse_id in range(1000, 1012):
+                for stop_pulse_id in range(start_pulse_id, start_pulse_id + 25):
+                    pids = np.arange(start_pulse_id, stop_pulse_id + 1)
+                    expected = pids[pids % rate_multiplicator == 0]
+                    res = expected_pulse_ids(start_pulse_id, stop_pulse_id, rate_multiplicator)
+                    np.testing.assert_array_equal(res, expected)
+
+
+    def test_split_pulse_range(self):
+        self.assertEqual(split_pulse_range(100, 120, 10), [(100, 109), (110, 119), (120, 120)])
+        self.assertEqual(split_pulse_range(100, 130, 20, 2), [(100, 118), (120, 130)])
+        self.assertEqual(split_pulse_range(100, 100, 10), [(100, 100)])
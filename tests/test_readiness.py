@@ -0,0 +1,111 @@
+import os
+import tempfile
+import unittest
+from time import time
+from unittest import mock
+
+from sf_daq_broker.rabbitmq import broker_config
+from sf_daq_broker.writer import readiness
+from sf_daq_broker.writer.readiness import bsdata_is_ready, channels_have_data, detector_is_ready, get_probe, read_latest_pulse_id, select_probe_channels, wait_until_ready
+
+
+DETECTOR_NAME = "JF01T03V01"
+
+
+
+class TestReadiness(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.buffer_directory = self.tmpdir.name
+
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+
+    def write_latest(self, module, pulse_id):
+        module_directory = f"{self.buffer_directory}/{DETECTOR_NAME}/M{module:02}"
+        os.makedirs(module_directory, exist_ok=True)
+        with open(f"{module_directory}/LATEST", "w") as f:
+            f.write(f"{module_directory}/{pulse_id // 100000 * 100000}/{pulse_id}.bin\n")
+
+
+    def test_detector_is_ready(self):
+        stop_pulse_id = 11_000_012_345
+        self.assertFalse(detector_is_ready(DETECTOR_NAME, stop_pulse_id, self.buffer_directory))
+
+        for i in range(3):
+            self.write_latest(i, 11_000_013_000)
+        self.write_latest(1, 11_000_012_000)
+        self.assertFalse(detector_is_ready(DETECTOR_NAME, stop_pulse_id, self.buffer_directory))
+
+        self.write_latest(1, 11_000_013_000)
+        self.assertTrue(detector_is_ready(DETECTOR_NAME, stop_pulse_id, self.buffer_directory))
+
+
+    def test_read_latest_pulse_id(self):
+        self.write_latest(0, 11_000_013_000)
+        latest_file = f"{self.buffer_directory}/{DETECTOR_NAME}/M00/LATEST"
+        self.assertEqual(read_latest_pulse_id(latest_file), 11_000_013_000)
+
+        with open(latest_file, "w") as f:
+            f.write("")
+        self.assertIsNone(read_latest_pulse_id(latest_file))
+        self.assertIsNone(read_latest_pulse_id(f"{self.buffer_directory}/missing"))
+
+
+    def test_wait_until_ready(self):
+        calls = []
+        def probe():
+            calls.append(time())
+            return len(calls) == 3
+
+        start = time()
+        self.assertTrue(wait_until_ready(probe, 10, interval=0.01))
+        self.assertLess(time() - start, 1)
+        self.assertEqual(len(calls), 3)
+
+        start = time()
+        self.assertFalse(wait_until_ready(lambda: False, 0.05, interval=0.01))
+        self.assertGreaterEqual(time() - start, 0.05)
+
+
+    def test_get_probe(self):
+        request = {"channels": {"detector_name": DETECTOR_NAME, "det_stop_pulse_id": 123}}
+        self.assertIsNotNone(get_probe(request, broker_config.TAG_DETECTOR_RETRIEVE))
+        self.assertIsNotNone(get_probe({"channels": ["SAR:CH1"], "stop_pulse_id": 123}, broker_config.TAG_DATA3BUFFER))
+        self.assertIsNone(get_probe({"stop_pulse_id": 123}, broker_config.TAG_DATA3BUFFER))
+        self.assertIsNone(get_probe({"stop_pulse_id": 123}, broker_config.TAG_IMAGEBUFFER))
+        self.assertIsNone(get_probe({}, broker_config.TAG_DETECTOR_RETRIEVE))
+
+
+    def test_select_probe_channels(self):
+        channels = [f"SAR:CH{i}" for i in range(25)] + ["SAR:CAM:FPICTURE"]
+        selected = select_probe_channels(channels, n_channels=5)
+        self.assertEqual(selected, ["SAR:CH0", "SAR:CH5", "SAR:CH10", "SAR:CH15", "SAR:CH20"])
+        self.assertEqual(select_probe_channels(["SAR:CH1", "SAR:CAM:FPICTURE"]), ["SAR:CH1"])
+
+
+    def test_channels_have_data(self):
+        response = [
+            {"channel": {"name": "SAR:CH1", "backend": "sf-databuffer"}, "data": [{"pulseId": 100}, {"pulseId": 101}]},
+            {"channel": {"name": "SAR:CH2", "backend": "sf-databuffer"}, "data": [{"pulseId": 99}]},
+            {"channel": {"name": "SAR:CH3", "backend": "sf-databuffer"}, "data": []}
+        ]
+        self.assertTrue(channels_have_data(response, ["SAR:CH1"], 100))
+        self.assertFalse(channels_have_data(response, ["SAR:CH1", "SAR:CH2"], 100))
+        self.assertFalse(channels_have_data(response, ["SAR:CH3"], 100))
+        self.assertFalse(channels_have_data(response, ["SAR:CH4"], 100))
+
+
+    def test_bsdata_is_ready(self):
+        response = mock.Mock()
+        response.json.return_value = [{"channel": {"name": "SAR:CH1"}, "data": [{"pulseId": 150}]}]
+        with mock.patch.object(readiness.requests, "post", return_value=response) as post:
+            self.assertTrue(bsdata_is_ready(["SAR:CH1"], 100, margin=50))
+            query = post.call_args.kwargs["json"]
+            self.assertEqual(query["range"], {"startPulseId": 100, "endPulseId": 150})
+
+            post.side_effect = OSError("unreachable")
+            self.assertFalse(bsdata_is_ready(["SAR:CH1"], 100))
@@ -0,0 +1,62 @@
+import logging
+import unittest
+from threading import Thread
+
+from sf_daq_broker.utils.request_context import ContextThreadPoolExecutor, RequestFilter, current_request, run_in_context
+
+
+_logger = logging.getLogger("test_request_context")
+
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+
+class TestRequestContext(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = ListHandler()
+        self.handler.addFilter(RequestFilter("a"))
+        _logger.addHandler(self.handler)
+        _logger.setLevel(logging.INFO)
+
+
+    def tearDown(self):
+        _logger.removeHandler(self.handler)
+
+
+    def work_on(self, request_id):
+        token = current_request.set(request_id)
+        try:
+            _logger.info(f"{request_id} main")
+            with ContextThreadPoolExecutor(max_workers=2) as executor:
+                list(executor.map(lambda i: _logger.info(f"{request_id} executor {i}"), range(2)))
+            thread = Thread(target=run_in_context(_logger.info), args=(f"{request_id} thread",))
+            thread.start()
+            thread.join()
+        finally:
+            current_request.reset(token)
+
+
+    def test_threads_inherit_the_request(self):
+        threads = [Thread(target=self.work_on, args=(request_id,)) for request_id in ("a", "b")]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(self.handler.messages), ["a executor 0", "a executor 1", "a main", "a thread"])
+
+
+    def test_outside_of_requests(self):
+        _logger.info("no request")
+        self.assertIsNone(current_request.get())
+        self.assertEqual(self.handler.messages, [])
@@ -0,0 +1,70 @@
+import json
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Thread
+from time import time
+from urllib.request import urlopen
+
+import bottle
+
+from sf_daq_broker.rest_api.server import RequestMetrics, make_threadpool_server, register_metrics_endpoint
+
+
+
+class TestThreadPoolServer(unittest.TestCase):
+
+    def setUp(self):
+        self.release = Event()
+
+        app = bottle.Bottle()
+
+        @app.get("/slow")
+        def slow():
+            self.release.wait(5)
+            return {"message": "slow"}
+
+        @app.get("/fast")
+        def fast():
+            return {"message": "fast"}
+
+        self.metrics = RequestMetrics(app)
+        register_metrics_endpoint(app, self.metrics)
+
+        self.server = make_threadpool_server("127.0.0.1", 0, self.metrics, n_threads=4)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+
+    def tearDown(self):
+        self.release.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+    def get(self, path):
+        with urlopen(self.url + path, timeout=10) as response:
+            return json.load(response)
+
+
+    def test_slow_request_does_not_block(self):
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            slow = executor.submit(self.get, "/slow")
+
+            time_start = time()
+            self.assertEqual(self.get("/fast"), {"message": "fast"})
+            self.assertLess(time() - time_start, 2)
+            self.assertFalse(slow.done())
+
+            metrics = self.get("/get_server_metrics")["message"]
+            self.assertEqual(metrics["in_flight"], 2) # the slow request and this one
+            self.assertEqual(metrics["endpoints"]["/fast"]["count"], 1)
+
+            self.release.set()
+            self.assertEqual(slow.result(), {"message": "slow"})
+
+        metrics = self.metrics.snapshot()
+        self.assertEqual(metrics["in_flight"], 0)
+        self.assertEqual(metrics["max_in_flight"], 2)
+        self.assertEqual(metrics["endpoints"]["/slow"]["count"], 1)
+        self.assertGreaterEqual(metrics["endpoints"]["/slow"]["max_latency"], metrics["endpoints"]["/fast"]["max_latency"])
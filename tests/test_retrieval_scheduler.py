@@ -0,0 +1,94 @@
+import unittest
+from threading import Thread
+from time import sleep
+
+from sf_daq_broker.writer.retrieval_scheduler import RetrievalJob, RetrievalScheduler
+
+
+GB = 1024**3
+
+
+
+class TestRetrievalScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = RetrievalScheduler(bandwidth=4, tmp_space=10 * GB, module_bandwidth=1, max_wait=60)
+        self.started = []
+
+
+    def submit(self, name, n_modules, nbytes, tmp_nbytes=0, duration=0.05):
+        def run():
+            with self.scheduler.job(name, n_modules, nbytes, tmp_nbytes):
+                self.started.append(name)
+                sleep(duration)
+
+        thread = Thread(target=run)
+        thread.start()
+        sleep(0.01) # keep the submission order
+        return thread
+
+
+    def test_small_detectors_first(self):
+        threads = [
+            self.submit("JF07T32V01", 32, 32 * GB, duration=0.2), # exceeds the bandwidth, thus runs alone
+            self.submit("JF06T08V02", 8, 8 * GB),
+            self.submit("JF02T09V02", 4, 4 * GB),
+            self.submit("JF03T01V02", 1, 1 * GB),
+            self.submit("JF10T01V01", 1, 1 * GB),
+        ]
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.started, ["JF07T32V01", "JF03T01V02", "JF10T01V01", "JF02T09V02", "JF06T08V02"])
+
+
+    def test_job_that_fits_goes_ahead(self):
+        with self.scheduler.job("running", 2, 1 * GB, tmp_nbytes=1 * GB):
+            threads = [
+                self.submit("many_modules", 4, 1 * GB),             # exceeds the bandwidth left
+                self.submit("few_modules", 2, 2 * GB, tmp_nbytes=2 * GB) # fits, although it is larger
+            ]
+            sleep(0.05)
+            self.assertEqual(self.started, ["few_modules"])
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.started, ["few_modules", "many_modules"])
+
+
+    def test_bandwidth_freed_after_retrieval(self):
+        scheduler = self.scheduler
+        with scheduler.job("a", 4, 2 * GB, tmp_nbytes=2 * GB) as job:
+            self.assertFalse(scheduler.fits(RetrievalJob("b", 1 * GB, 1, 0)))
+            scheduler.retrieval_done(job)
+            self.assertTrue(scheduler.fits(RetrievalJob("b", 1 * GB, 4, 0)))
+            self.assertFalse(scheduler.fits(RetrievalJob("b", 9 * GB, 1, 9 * GB)))
+
+
+    def test_budgets(self):
+        scheduler = self.scheduler
+        with scheduler.job("a", 2, 6 * GB, tmp_nbytes=6 * GB):
+            self.assertTrue(scheduler.fits(RetrievalJob("b", 1 * GB, 2, 0)))
+            self.assertFalse(scheduler.fits(RetrievalJob("b", 1 * GB, 3, 0)))
+            self.assertFalse(scheduler.fits(RetrievalJob("b", 5 * GB, 1, 5 * GB)))
+            self.assertTrue(scheduler.fits(RetrievalJob("b", 5 * GB, 1, 0)))
+        self.assertEqual(scheduler.running, [])
+
+
+    def test_overdue_job_is_next(self):
+        self.scheduler.max_wait = 0.1
+        with self.scheduler.job("running", 4, 1 * GB):
+            big = self.submit("big", 4, 16 * GB)
+            sleep(0.15)
+            small = self.submit("small", 1, 1 * GB)
+        for thread in (big, small):
+            thread.join()
+        self.assertEqual(self.started, ["big", "small"])
+
+
+    def test_time_to_overdue(self):
+        scheduler = self.scheduler
+        self.assertIsNone(scheduler.time_to_overdue())
+        scheduler.waiting.append(RetrievalJob("a", 1 * GB, 1, 0))
+        self.assertAlmostEqual(scheduler.time_to_overdue(), 60, delta=1)
+        scheduler.max_wait = 0
+        self.assertIsNone(scheduler.time_to_overdue())
@@ -0,0 +1,73 @@
+import tempfile
+import unittest
+
+from sf_daq_broker.utils import json_load, json_save
+from sf_daq_broker.utils.scan_journal import ScanInfoMaterializer, append_scan_step, is_outdated, read_scan_info
+
+
+SCAN_INFO_1 = {
+    "scan_name": "delay",
+    "Id": ["SLAAR:DELAY"],
+    "scan_readbacks": [1.0],
+    "scan_values": [1],
+    "scan_step_info": {"step": 1}
+}
+
+SCAN_INFO_2 = {
+    "scan_name": "delay (changed)",
+    "Id": ["SLAAR:DELAY"],
+    "scan_readbacks": [2.0],
+    "scan_values": [2]
+}
+
+SCAN_INFO_FULL = {
+    "scan_files": [["acq0001.BSDATA.h5"], ["acq0002.BSDATA.h5"]],
+    "pulseIds": [[100, 200], [300, 400]],
+    "scan_parameters": {"scan_name": "delay", "Id": ["SLAAR:DELAY"]},
+    "scan_readbacks": [[1.0], [2.0]],
+    "scan_step_info": [{"step": 1}, []],
+    "scan_values": [[1], [2]],
+    "scan_readbacks_raw": [[], []]
+}
+
+
+
+class TestScanJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.meta_directory = self.tmpdir.name
+
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+
+    def test_same_content_as_scan_json(self):
+        append_scan_step(self.meta_directory, SCAN_INFO_1, ["acq0001.BSDATA.h5"], [100, 200])
+        append_scan_step(self.meta_directory, SCAN_INFO_2, ["acq0002.BSDATA.h5"], [300, 400])
+        self.assertEqual(read_scan_info(self.meta_directory), SCAN_INFO_FULL)
+
+
+    def test_existing_scan_json_is_continued(self):
+        scan_info = dict(SCAN_INFO_FULL)
+        for key in ("scan_files", "pulseIds", "scan_readbacks", "scan_step_info", "scan_values", "scan_readbacks_raw"):
+            scan_info[key] = scan_info[key][:1]
+        json_save(scan_info, f"{self.meta_directory}/scan.json")
+
+        append_scan_step(self.meta_directory, SCAN_INFO_2, ["acq0002.BSDATA.h5"], [300, 400])
+        self.assertEqual(read_scan_info(self.meta_directory), SCAN_INFO_FULL)
+
+
+    def test_materializer(self):
+        materializer = ScanInfoMaterializer(interval=100)
+        self.assertFalse(is_outdated(self.meta_directory))
+
+        append_scan_step(self.meta_directory, SCAN_INFO_1, ["acq0001.BSDATA.h5"], [100, 200])
+        append_scan_step(self.meta_directory, SCAN_INFO_2, ["acq0002.BSDATA.h5"], [300, 400])
+        materializer.mark(self.meta_directory)
+        self.assertTrue(is_outdated(self.meta_directory))
+
+        materializer.stop()
+        self.assertEqual(json_load(f"{self.meta_directory}/scan.json"), SCAN_INFO_FULL)
+        self.assertFalse(is_outdated(self.meta_directory))
@@ -0,0 +1,99 @@
+import tempfile
+import unittest
+
+from sf_daq_broker.utils import pulseids
+from sf_daq_broker.utils.timestamp_cache import PULSE_PERIOD_NS, TimestampCache
+
+
+T0 = 1_700_000_000_000_000_000
+
+
+
+def timestamp(pulse_id):
+    return T0 + pulse_id * PULSE_PERIOD_NS
+
+
+
+class TestTimestampCache(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        cache = TimestampCache(capacity=3)
+        for pulse_id in (10, 20, 30):
+            cache.put(pulse_id, timestamp(pulse_id))
+        cache.get(10)
+        cache.put(40, timestamp(40))
+
+        self.assertEqual(len(cache), 3)
+        self.assertIsNone(cache.get(20))
+        self.assertEqual(cache.get(10), timestamp(10))
+        self.assertEqual(cache.sorted_pulse_ids, [10, 30, 40])
+
+
+    def test_interpolation(self):
+        cache = TimestampCache(capacity=10, max_gap=100, tolerance=1000)
+        cache.put(100, timestamp(100))
+        cache.put(150, timestamp(150) + 500)
+        cache.put(300, timestamp(300))
+
+        self.assertEqual(cache.get(110), timestamp(110) + 100)
+        self.assertIsNone(cache.get(200)) # gap too large
+        self.assertIsNone(cache.get(50))  # no anchor before
+
+        cache.put(160, timestamp(160) + 5000) # not on the grid
+        self.assertIsNone(cache.get(155))
+
+
+    def test_persistence(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = f"{tmpdir}/pulseids.txt"
+            cache = TimestampCache(capacity=2, filename=fname)
+            for pulse_id in (10, 20, 30, 40, 50):
+                cache.put(pulse_id, timestamp(pulse_id))
+
+            with open(fname, "a") as f:
+                f.write("60 ") # incomplete line
+
+            loaded = TimestampCache(capacity=2, filename=fname)
+            self.assertEqual(loaded.sorted_pulse_ids, [40, 50])
+            with open(fname) as f:
+                self.assertEqual(len(f.readlines()), 2) # compacted
+
+
+
+class TestBatchLookup(unittest.TestCase):
+
+    def setUp(self):
+        self.requested = []
+        self.original_request_timestamp = pulseids.request_timestamp
+        pulseids.request_timestamp = self.request_timestamp
+
+
+    def tearDown(self):
+        pulseids.request_timestamp = self.original_request_timestamp
+
+
+    def request_timestamp(self, pulse_id, n_tries, wait_time):
+        self.requested.append(pulse_id)
+        return timestamp(pulse_id)
+
+
+    def test_inner_pulse_ids_are_interpolated(self):
+        cache = TimestampCache(capacity=100, max_gap=1000, tolerance=1000)
+        pulse_ids = [500, 100, 300, 200, 100]
+        res = pulseids.pulse_ids_to_timestamps(pulse_ids, cache=cache)
+
+        self.assertEqual(res, [timestamp(pulse_id) for pulse_id in pulse_ids])
+        self.assertEqual(sorted(self.requested), [100, 500])
+
+        pulseids.pulse_ids_to_timestamps([100, 400], cache=cache)
+        self.assertEqual(len(self.requested), 2)
+
+
+    def test_exact_pulse_ids_are_requested(self):
+        cache = TimestampCache(capacity=100, max_gap=1000, tolerance=1000)
+        pulseids.pulse_ids_to_timestamps([100, 500], cache=cache)
+
+        # the outer boundaries of a new range are within the cached ones, but must not be interpolated
+        res = pulseids.pulse_ids_to_timestamps([200, 300, 401], cache=cache, exact=[200, 401])
+        self.assertEqual(res, [timestamp(pulse_id) for pulse_id in (200, 300, 401)])
+        self.assertEqual(sorted(self.requested), [100, 200, 401, 500])
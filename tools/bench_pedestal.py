@@ -0,0 +1,194 @@
+import argparse
+import os
+import tempfile
+from time import time
+
+import h5py
+import numpy as np
+
+from sf_daq_broker.writer.pedestal import create_pedestal_file, MODULE_NPIXELS
+
+
+DETECTOR_NAME = "JF99T{:02}V01"
+GAINS = (0, 1, 3)
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the legacy frame-by-frame loop against the batched pedestal engine on a synthetic raw file")
+
+    parser.add_argument("-m", "--modules", type=int, default=4, help="number of modules")
+    parser.add_argument("-n", "--frames", type=int, default=300, help="number of frames per gain")
+    parser.add_argument("-b", "--batch_size", type=int, default=None, help="number of frames read at once by the batched path (default: automatic)")
+    parser.add_argument("-a", "--frames_average", type=int, default=1000, help="frames_average passed to create_pedestal_file")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="number of worker processes of the batched path")
+    parser.add_argument("-c", "--accumulator", default="float64", help="accumulator of the batched path (float64, float32, welford)")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="number of repetitions, the best time is reported")
+    parser.add_argument("-d", "--directory", default=None, help="working directory (default: temporary directory)")
+
+    clargs = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=clargs.directory) as tmpdir:
+        fn_raw = f"{tmpdir}/pedestal.h5"
+
+        print(f"writing synthetic raw file with {clargs.modules} modules and {clargs.frames} frames per gain...")
+        make_synthetic_raw_file(fn_raw, clargs.modules, clargs.frames)
+
+        fn_legacy  = f"{tmpdir}/legacy.res.h5"
+        fn_batched = f"{tmpdir}/pedestal.res.h5"
+
+        time_legacy = best_time(clargs.repeat, legacy_create_pedestal_file, fn_raw, fn_legacy, frames_average=clargs.frames_average)
+        print(f"frame-by-frame: {time_legacy:.2f} seconds")
+
+        time_batched = best_time(clargs.repeat, create_pedestal_file, filename=fn_raw, directory=tmpdir, frames_average=clargs.frames_average, batch_size=clargs.batch_size, n_workers=clargs.workers, accumulator=clargs.accumulator)
+        print(f"       batched: {time_batched:.2f} seconds")
+
+        speedup = time_legacy / time_batched
+        print(f"       speedup: {speedup:.2f}x")
+
+        identical = compare_results(fn_legacy, fn_batched)
+        print(f"     identical: {identical}")
+
+        if not identical:
+            deviation = max_deviation(fn_legacy, fn_batched)
+            print(f" max deviation: {deviation}")
+
+
+
+def best_time(repeat, func, *args, **kwargs):
+    timings = []
+    for _ in range(repeat):
+        start = time()
+        func(*args, **kwargs)
+        timings.append(time() - start)
+    return min(timings)
+
+
+def make_synthetic_raw_file(filename, n_modules, n_frames_per_gain, seed=0):
+    """
+    writes a raw Jungfrau file with n_frames_per_gain frames for each of the gains 0, 1 and 3,
+    with a few bad frames, frames with mismatching module settings and pixels in wrong gain
+    """
+    rng = np.random.default_rng(seed)
+
+    detector_name = DETECTOR_NAME.format(n_modules)
+    sh_y, sh_x = 512 * n_modules, 1024
+    n_frames = len(GAINS) * n_frames_per_gain
+
+    with h5py.File(filename, "w") as h5f:
+        h5f["general/detector_name"] = detector_name.encode()
+
+        data = h5f.create_dataset(f"data/{detector_name}/data", (n_frames, sh_y, sh_x), dtype=np.uint16, chunks=(1, sh_y, sh_x))
+        daq_recs = np.zeros((n_frames, n_modules), dtype=np.int64)
+        is_good_frame = np.ones(n_frames, dtype=np.uint64)
+
+        pedestal = rng.integers(1000, 3000, size=(sh_y, sh_x), dtype=np.uint16)
+
+        for n in range(n_frames):
+            gain = GAINS[n // n_frames_per_gain]
+            daq_recs[n] = gain << 12
+
+            frame = pedestal + rng.integers(0, 50, size=(sh_y, sh_x), dtype=np.uint16)
+            gains = np.full((sh_y, sh_x), gain, dtype=np.uint16)
+            wrong = rng.random((sh_y, sh_x)) < 1e-4
+            gains[wrong] = (gain + 1) % 4
+            data[n] = frame | (gains << 14)
+
+        is_good_frame[rng.choice(n_frames, size=max(1, n_frames // 100), replace=False)] = 0
+        if n_modules > 1:
+            daq_recs[rng.choice(n_frames, size=max(1, n_frames // 100), replace=False), -1] ^= (1 << 12)
+
+        h5f[f"data/{detector_name}/daq_rec"] = daq_recs
+        h5f[f"data/{detector_name}/is_good_frame"] = is_good_frame
+
+
+def legacy_create_pedestal_file(fn_in, fn_out, frames_average=1000, number_bad_modules=0):
+    """
+    the frame-by-frame loop of create_pedestal_file before the batched engine (without logging)
+    """
+    with h5py.File(fn_in, "r") as h5f:
+        detector_name = h5f["general/detector_name"][()].decode()
+        f_data          = h5f[f"data/{detector_name}/data"]
+        f_is_good_frame = h5f[f"data/{detector_name}/is_good_frame"][:]
+        f_daq_recs      = h5f[f"data/{detector_name}/daq_rec"][:]
+
+        sh_y, sh_x = f_data.shape[1:]
+        nModules = (sh_x * sh_y) // MODULE_NPIXELS
+
+        pixelMask = np.zeros((sh_y, sh_x), dtype=int)
+        adcValuesN  = np.zeros((4, sh_y, sh_x))
+        adcValuesNN = np.zeros((4, sh_y, sh_x))
+        nMgain = [0] * 4
+
+        for n in range(len(f_data)):
+            if not f_is_good_frame[n]:
+                continue
+
+            image = f_data[n]
+            frameData = (image & 0b0011111111111111)
+            gainData  = (image & 0b1100000000000000) >> 14
+
+            daq_rec = f_daq_recs[n][0]
+            trueGain = (daq_rec & 0b11000000000000) >> 12
+            highG0 = (daq_rec & 0b1)
+
+            gainGoodAllModules = True
+            for dr in f_daq_recs[n]:
+                if trueGain != (dr & 0b11000000000000) >> 12 or highG0 != (dr & 0b1):
+                    gainGoodAllModules = False
+            if not gainGoodAllModules:
+                continue
+
+            correct_gain = (gainData == trueGain)
+            if np.sum(correct_gain) < (nModules - 0.5 - number_bad_modules) * MODULE_NPIXELS:
+                continue
+
+            pixelMask[~correct_gain] |= (1 << int(1 + trueGain + 4 * highG0))
+            nMgain[trueGain] += 1
+
+            if nMgain[trueGain] > frames_average:
+                adcValuesN[trueGain]  -= adcValuesN[trueGain]  / frames_average
+                adcValuesNN[trueGain] -= adcValuesNN[trueGain] / frames_average
+
+            adcValuesN[trueGain]  += frameData
+            adcValuesNN[trueGain] += np.square(frameData, dtype=np.uint32)
+
+    gains    = []
+    gainsRMS = []
+
+    for gain in (0, 1, 3):
+        numberFramesAverage = max(1, min(frames_average, nMgain[gain]))
+        mean  = adcValuesN[gain]  / numberFramesAverage
+        mean2 = adcValuesNN[gain] / numberFramesAverage
+        stdDeviation = np.sqrt(mean2 - mean**2)
+        gains.append(mean)
+        gainsRMS.append(stdDeviation)
+        pixelMask[np.isclose(stdDeviation, 0)] |= (1 << (9 + gain))
+
+    with h5py.File(fn_out, "w") as outFile:
+        outFile.create_dataset("pixel_mask", data=pixelMask)
+        outFile.create_dataset("gains",      data=gains)
+        outFile.create_dataset("gainsRMS",   data=gainsRMS)
+
+
+def compare_results(fn1, fn2):
+    with h5py.File(fn1, "r") as f1, h5py.File(fn2, "r") as f2:
+        for name in ("pixel_mask", "gains", "gainsRMS"):
+            if not np.array_equal(f1[name][:], f2[name][:], equal_nan=True):
+                return False
+    return True
+
+
+
+def max_deviation(fn1, fn2):
+    res = {}
+    with h5py.File(fn1, "r") as f1, h5py.File(fn2, "r") as f2:
+        for name in ("gains", "gainsRMS"):
+            res[name] = float(np.nanmax(np.abs(f1[name][:] - f2[name][:])))
+    return res
+
+
+
+
+if __name__ == "__main__":
+    main()
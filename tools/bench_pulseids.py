@@ -0,0 +1,62 @@
+import argparse
+from time import time
+
+import numpy as np
+
+from sf_daq_broker.utils.pulseids import align_pulse_ids, expected_pulse_ids
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the pulse-ID loops against the closed-form/NumPy helpers of sf_daq_broker.utils.pulseids")
+
+    parser.add_argument("-s", "--start", type=int, default=18_000_000_001, help="start pulse ID")
+    parser.add_argument("-n", "--pulses", type=int, default=60_001, help="number of pulses in the range")
+    parser.add_argument("-m", "--rate_multiplicator", type=int, default=1, help="rate multiplicator")
+    parser.add_argument("-r", "--repeat", type=int, default=10, help="number of repetitions, the best time is reported")
+
+    clargs = parser.parse_args()
+
+    args = (clargs.start, clargs.start + clargs.pulses - 1, clargs.rate_multiplicator)
+
+    report("align", clargs.repeat, align_pulse_ids_loop, align_pulse_ids, args)
+    report("expected", clargs.repeat, expected_pulse_ids_mask, expected_pulse_ids, args)
+
+
+
+def report(name, repeat, func_old, func_new, args):
+    time_old = best_time(repeat, func_old, *args)
+    time_new = best_time(repeat, func_new, *args)
+    identical = np.array_equal(func_old(*args), func_new(*args))
+    print(f"{name:>8}: {time_old * 1e3:.3f} ms -> {time_new * 1e3:.3f} ms ({time_old / time_new:.0f}x), identical: {identical}")
+
+
+def best_time(repeat, func, *args):
+    timings = []
+    for _ in range(repeat):
+        start = time()
+        func(*args)
+        timings.append(time() - start)
+    return min(timings)
+
+
+def align_pulse_ids_loop(start_pulse_id, stop_pulse_id, rate_multiplicator):
+    det_start_pulse_id = 0
+    det_stop_pulse_id = stop_pulse_id
+    for p in range(start_pulse_id, stop_pulse_id+1):
+        if p % rate_multiplicator == 0:
+            det_stop_pulse_id = p
+            if det_start_pulse_id == 0:
+                det_start_pulse_id = p
+    return det_start_pulse_id, det_stop_pulse_id
+
+
+def expected_pulse_ids_mask(start_pulse_id, stop_pulse_id, rate_multiplicator):
+    pulse_ids = np.arange(start_pulse_id, stop_pulse_id + 1)
+    return pulse_ids[pulse_ids % rate_multiplicator == 0]
+
+
+
+
+if __name__ == "__main__":
+    main()
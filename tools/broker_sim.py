@@ -117,9 +117,7 @@ def send(broker_url=broker_config.DEFAULT_BROKER_URL):
         }
 
         _logger.info(f"send {counter}: {tag}")
-        broker_client.open()
         broker_client.send(request, tag)
-        broker_client.close()
         _logger.info(f"sent {counter}: {tag}")
 
 